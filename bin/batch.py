@@ -3,13 +3,18 @@
 
 """A collection of methods for interacting with AWS Batch."""
 
+import os
 import re
+import json
+import time
+import threading
 from pprint import pprint
+from concurrent import futures
 
-import boto3
 from botocore.exceptions import ClientError
 
 import clienterror
+import clientpool
 
 ################################################################
 
@@ -44,13 +49,162 @@ def abort(msg1, msg2=None, data=None, verbose=False):
 
 ################################################################
 
+JOB_STATUSES = ['SUBMITTED', 'PENDING', 'RUNNABLE',
+                'STARTING', 'RUNNING', 'SUCCEEDED', 'FAILED']
+
+# A complete job id, and a literal job name (no regexp operators)
+JOB_ID_PATTERN = re.compile(r'^[0-9a-f]{8}(-[0-9a-f]{4}){3}-[0-9a-f]{12}$')
+JOB_NAME_PATTERN = re.compile(r'^[A-Za-z0-9_-]+$')
+
+# A single describe_jobs call accepts at most 100 job ids
+DESCRIBE_BATCH = 100
+DESCRIBE_WORKERS = 8
+
+def job_summary(job):
+    """The job id, job name, and status of a job."""
+
+    return {'jobId': job['jobId'],
+            'jobName': job['jobName'],
+            'status': job['status']}
+
+################################################################
+# Job queues and job definitions found to exist are remembered for
+# VALIDATION_TTL seconds, within the process and, if a cache file is
+# given, across processes.  Only successful validations are remembered.
+
+VALIDATION_TTL = 3600
+VALIDATION_CACHE = os.environ.get('CBMC_BATCH_VALIDATION_CACHE')
+VALIDATED = {}
+VALIDATED_LOCK = threading.Lock()
+
+def validation_key(kind, region, name):
+    """The key for a validated job queue or job definition."""
+
+    return '{}:{}:{}'.format(kind, region or '', name)
+
+def is_validated(kind, region, name, cachefile=None):
+    """The job queue or job definition was recently found to exist."""
+
+    key = validation_key(kind, region, name)
+    with VALIDATED_LOCK:
+        if key not in VALIDATED and cachefile:
+            VALIDATED.update(read_validation_cache(cachefile))
+        return VALIDATED.get(key, 0) + VALIDATION_TTL > time.time()
+
+def validate(kind, region, name, cachefile=None):
+    """Remember that the job queue or job definition exists."""
+
+    key = validation_key(kind, region, name)
+    with VALIDATED_LOCK:
+        VALIDATED[key] = time.time()
+        if cachefile:
+            cache = read_validation_cache(cachefile)
+            cache[key] = VALIDATED[key]
+            write_validation_cache(cachefile, cache)
+
+def read_validation_cache(cachefile):
+    """Read the unexpired validations from a cache file."""
+
+    try:
+        with open(cachefile) as handle:
+            cache = json.load(handle)
+    except (IOError, OSError, ValueError):
+        return {}
+    now = time.time()
+    return dict((key, stamp) for key, stamp in cache.items()
+                if stamp + VALIDATION_TTL > now)
+
+def write_validation_cache(cachefile, cache):
+    """Write validations to a cache file (atomically replacing it)."""
+
+    tmpfile = '{}.{}'.format(cachefile, os.getpid())
+    try:
+        directory = os.path.dirname(cachefile)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(tmpfile, 'w') as handle:
+            json.dump(cache, handle, indent=2, sort_keys=True)
+        os.rename(tmpfile, cachefile)
+    except (IOError, OSError) as exc:
+        print("Failed to write validation cache {}: {}".format(cachefile, exc))
+
+################################################################
+# Job submission is limited by a token bucket shared by every Batch
+# object for a region.  When Batch throttles a submission, the rate is
+# halved and the submission is retried; each successful submission
+# then recovers the rate additively up to its original value.
+
+SUBMIT_RATE = 20.0
+SUBMIT_BURST = 20
+SUBMIT_MINIMUM_RATE = 1.0
+SUBMIT_RECOVERY = 0.5
+SUBMIT_ATTEMPTS = 8
+SUBMIT_WORKERS = 16
+
+class RateLimiter:
+    """A token bucket with additive-increase, multiplicative-decrease rate."""
+
+    def __init__(self, rate=SUBMIT_RATE, burst=SUBMIT_BURST):
+        self.maximum = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = time.time()
+        self.throttles = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Wait for a token."""
+
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens +
+                                  (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+    def throttled(self):
+        """Slow down after a request was throttled."""
+
+        with self.lock:
+            self.throttles += 1
+            self.rate = max(self.rate / 2, SUBMIT_MINIMUM_RATE)
+            self.tokens = min(self.tokens, 0)
+
+    def succeeded(self):
+        """Speed back up after a request succeeded."""
+
+        with self.lock:
+            self.rate = min(self.rate + SUBMIT_RECOVERY, self.maximum)
+
+LIMITERS = {}
+LIMITERS_LOCK = threading.Lock()
+
+def rate_limiter(region):
+    """The rate limiter shared by job submissions to a region."""
+
+    with LIMITERS_LOCK:
+        if region not in LIMITERS:
+            LIMITERS[region] = RateLimiter()
+        return LIMITERS[region]
+
+################################################################
+
 class Batch:
     """An AWS Batch environment with methods to inspect and submit jobs."""
 
-    def __init__(self, jobname=None, queuename=None, region=None):
+    def __init__(self, jobname=None, queuename=None, region=None,
+                 cachefile=VALIDATION_CACHE):
         # Client is used to submit, kill, and query jobs
-        self.client = boto3.client('batch', region_name=region)
+        self.client = clientpool.client('batch', region)
         self.region = region
+        self.cachefile = cachefile
+        self.limiter = rate_limiter(region)
 
         # Job queue is used to submit and query jobs
         self.jobqueue = queuename
@@ -66,16 +220,19 @@ class Batch:
         """Job definition exists (a unique, active definition of jobname)"""
         if jobdef is None:
             return False
+        if is_validated('jobdef', self.region, jobdef, self.cachefile):
+            return True
 
-        # Get all job definitions
+        # Get the active revisions of the job definition
+        jobdefs = []
+        paginator = self.client.get_paginator('describe_job_definitions')
         try:
-            jobdefs_response = self.client.describe_job_definitions()
+            for page in paginator.paginate(jobDefinitionName=jobdef,
+                                           status='ACTIVE'):
+                # Discard meta data returned with job definitions
+                jobdefs.extend(page['jobDefinitions'])
         except ClientError as exc:
             abort("Failed to get job definitions from Batch", data=exc)
-
-        # Discard meta data returned with job definitions
-        try:
-            jobdefs = jobdefs_response['jobDefinitions']
         except KeyError:
             abort("Job definitions from Batch contained no actual definitions")
 
@@ -90,16 +247,21 @@ class Batch:
                           'multiple active definitions of {}'
                           .format(jobdef))
                 found = True
+        if found:
+            validate('jobdef', self.region, jobdef, self.cachefile)
         return found
 
     def job_queue_exists(self, jobqueue=None):
         """Job queue exists (a unique definition of jobqueue)"""
         if jobqueue is None:
             return False
+        if is_validated('jobqueue', self.region, jobqueue, self.cachefile):
+            return True
 
-        # Get all job queues
+        # Get the job queue
         try:
-            jobqueue_response = self.client.describe_job_queues()
+            jobqueue_response = self.client.describe_job_queues(
+                jobQueues=[jobqueue])
         except ClientError as exc:
             abort("Failed to get job queues from Batch", data=exc)
 
@@ -119,13 +281,22 @@ class Batch:
                           'multiple definitions of {}'
                           .format(jobqueue))
                 found = True
+        if found:
+            validate('jobqueue', self.region, jobqueue, self.cachefile)
         return found
 
     def submit_job(self, jobname=None, jobqueue=None, jobdefinition=None,
-                   command=None, memory=None, dependson=None):
-        """Run the job given by cmd in the batch environment."""
+                   command=None, memory=None, dependson=None,
+                   arraysize=None, deptype=None, vcpus=None):
+        """Run the job given by cmd in the batch environment.
+
+        With an arraysize, run an array job with that many child jobs.
+        The deptype of the dependencies of an array job on other array
+        jobs of the same size is N_TO_N or SEQUENTIAL.
+        """
 
         # pylint: disable=too-many-arguments
+        # pylint: disable=too-many-locals
 
         jobname = jobname or "cbmc"
         jobqueue = jobqueue or self.jobqueue
@@ -133,64 +304,234 @@ class Batch:
         # Should test that command is a list of strings
         overrides = {}
         if command is not None:
-            overrides['command'] = command
-            overrides['command'].extend(['--region', self.region])
+            overrides['command'] = list(command) + ['--region', self.region]
         if memory is not None:
             overrides['memory'] = memory
+        if vcpus is not None:
+            overrides['vcpus'] = vcpus
         # Should test that depends is a list of strings
-        dependson = [{'jobId': jid} for jid in dependson or []]
-
-        try:
-            result = self.client.submit_job(jobName=jobname,
-                                            jobQueue=jobqueue,
-                                            jobDefinition=jobdefinition,
-                                            dependsOn=dependson,
-                                            containerOverrides=overrides)
-        except ClientError as exc:
-            abort("Failed to run cbmc ('{}')".format(' '.join(command)),
-                  data=exc)
+        dependson = [dict([('jobId', jid)] +
+                          ([('type', deptype)] if deptype else []))
+                     for jid in dependson or []]
+        array = {'arrayProperties': {'size': arraysize}} if arraysize else {}
+
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            try:
+                result = self.client.submit_job(jobName=jobname,
+                                                jobQueue=jobqueue,
+                                                jobDefinition=jobdefinition,
+                                                dependsOn=dependson,
+                                                containerOverrides=overrides,
+                                                **array)
+                self.limiter.succeeded()
+                break
+            except ClientError as exc:
+                attempt += 1
+                if (clienterror.is_too_many_requests(exc) and
+                        attempt < SUBMIT_ATTEMPTS):
+                    self.limiter.throttled()
+                    continue
+                abort("Failed to run cbmc ('{}')"
+                      .format(' '.join(command or [])), data=exc)
 
         jobid = result.get('jobId', None)
         jobname = result.get('jobName', None)
         return {'jobid': jobid, 'jobname': jobname}
 
-    def job_status(self, jobid=None, jobname=None):
+    def submit_many(self, specs, workers=SUBMIT_WORKERS):
+        """Submit many jobs concurrently, respecting their dependencies.
+
+        Each spec is a dictionary of submit_job arguments together with
+        a 'key' naming the spec, and its 'dependson' lists the keys of
+        the specs that must run before it.  A job is submitted as soon
+        as the jobs it depends on have been submitted.  Return the
+        submit_job result for each key submitted, the error for each
+        key that could not be submitted, and submission statistics.
+        """
+
+        start = time.time()
+        throttled = self.limiter.throttles
+        pending = dict((spec['key'], spec) for spec in specs)
+        order = [spec['key'] for spec in specs]
+        results = {}
+        errors = {}
+
+        def submit(spec, jobids):
+            """Submit a spec given the job ids of its dependencies."""
+            args = dict((key, val) for key, val in spec.items()
+                        if key != 'key')
+            args['dependson'] = jobids
+            return self.submit_job(**args)
+
+        with futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            running = {}
+            while True:
+                for key in [key for key in order if key in pending]:
+                    deps = pending[key].get('dependson') or []
+                    failed = [dep for dep in deps
+                              if dep in errors or
+                              (dep not in pending and dep not in results and
+                               dep not in running.values())]
+                    if failed:
+                        del pending[key]
+                        errors[key] = ("Dependency not submitted: {}"
+                                       .format(', '.join(str(dep)
+                                                         for dep in failed)))
+                    elif all(dep in results for dep in deps):
+                        jobids = [results[dep]['jobid'] for dep in deps]
+                        running[pool.submit(submit, pending.pop(key),
+                                            jobids)] = key
+                if not running:
+                    break
+                done, _ = futures.wait(running,
+                                       return_when=futures.FIRST_COMPLETED)
+                for job in done:
+                    key = running.pop(job)
+                    try:
+                        results[key] = job.result()
+                    except BatchException as exc:
+                        errors[key] = str(exc)
+
+        for key in pending:
+            errors[key] = "Circular dependency"
+
+        seconds = time.time() - start
+        stats = {'submitted': len(results),
+                 'failed': len(errors),
+                 'seconds': round(seconds, 3),
+                 'jobs_per_second': round(len(results) / max(seconds, 1e-3),
+                                          2),
+                 'throttled': self.limiter.throttles - throttled}
+        return {'results': results, 'errors': errors, 'stats': stats}
+
+    def job_status(self, jobid=None, jobname=None, jobids=None, after=None,
+                   prefix=False):
         """
         Get the job status of every job matching a given job id or job name.
+
+        The job id and job name are regular expressions searched for
+        in the ids and names of jobs on the job queue.  With prefix,
+        the job name is matched as a prefix of the job names instead,
+        and a job name that is a literal name is found with a
+        server-side filter.  A job id that
+        is a complete job id, and a list of jobids, are looked up
+        directly.  The after time (seconds since the epoch) restricts
+        the search to jobs created after that time.
         """
 
+        if jobids is not None:
+            return [job_summary(job) for job in self.describe_jobs(jobids)]
+        if jobid and JOB_ID_PATTERN.match(jobid) and not jobname:
+            return [job_summary(job) for job in self.describe_jobs([jobid])]
+
+        id_pattern = re.compile(jobid) if jobid else None
+        name_pattern = re.compile(jobname) if jobname else None
+        name_match = name_pattern and (name_pattern.match if prefix
+                                       else name_pattern.search)
+
+        def matches(job):
+            """Job matches the job id or job name."""
+            if after is not None and job.get('createdAt', 0) <= after * 1000:
+                return False
+            return bool(id_pattern and id_pattern.search(job['jobId']) or
+                        name_match and name_match(job['jobName']))
+
+        if prefix and jobname and JOB_NAME_PATTERN.match(jobname):
+            query = {'filters': [{'name': 'JOB_NAME',
+                                  'values': [jobname + '*']}]}
+            jobs = self.list_jobs(query)
+            if jobid:
+                jobs += self.list_jobs_by_status()
+        elif after is not None:
+            query = {'filters': [{'name': 'AFTER_CREATED_AT',
+                                  'values': [str(int(after * 1000))]}]}
+            jobs = self.list_jobs(query)
+        else:
+            jobs = self.list_jobs_by_status()
+
         results = []
-        for status in ['SUBMITTED', 'PENDING', 'RUNNABLE',
-                       'STARTING', 'RUNNING', 'SUCCEEDED', 'FAILED']:
+        found = set()
+        for job in jobs:
+            if job['jobId'] in found or not matches(job):
+                continue
+            found.add(job['jobId'])
+            results.append(job_summary(job))
+        return results
+
+    def list_jobs(self, query, status=None):
+        """List every job on the job queue matching a list_jobs query.
+
+        The query is a dictionary of list_jobs arguments, and the
+        status is used for jobs whose summaries do not include one.
+        """
+
+        jobs = []
+        paginator = self.client.get_paginator('list_jobs')
+        try:
+            for page in paginator.paginate(jobQueue=self.jobqueue, **query):
+                for job in page['jobSummaryList']:
+                    job.setdefault('status', status)
+                    jobs.append(job)
+        except ClientError as exc:
+            abort("Failed to list jobs on queue: {}".format(self.jobqueue),
+                  data=exc)
+        except KeyError as exc:
+            abort("Failed to list {} jobs on queue: {}"
+                  .format(status or "filtered", self.jobqueue),
+                  data=exc)
+        return jobs
+
+    def list_jobs_by_status(self, statuses=None):
+        """List every job on the job queue with one query per status.
+
+        The queries for the statuses are run concurrently.
+        """
+
+        statuses = statuses or JOB_STATUSES
+        with futures.ThreadPoolExecutor(max_workers=len(statuses)) as pool:
+            pages = pool.map(lambda status: self.list_jobs(
+                {'jobStatus': status}, status), statuses)
+            return [job for page in pages for job in page]
+
+    def describe_jobs(self, jobids):
+        """Describe the jobs with the given job ids.
+
+        Jobs are described in batches of at most DESCRIBE_BATCH ids
+        run concurrently.  Unknown job ids are omitted.
+        """
+
+        def describe(batch):
+            """Describe a batch of jobs."""
             try:
-                response = self.client.list_jobs(
-                    jobQueue=self.jobqueue,
-                    jobStatus=status,
-                    maxResults=1000
-                    )
-                for job in response['jobSummaryList']:
-                    job_id = job['jobId']
-                    job_name = job['jobName']
-                    if (jobid and re.search(jobid, job_id) or
-                            jobname and re.search(jobname, job_name)):
-                        results.append({'jobId': job_id,
-                                        'jobName': job_name,
-                                        'status': status})
+                return self.client.describe_jobs(jobs=batch)['jobs']
             except ClientError as exc:
-                abort("Failed to list jobs on queue: {}".format(self.jobqueue),
+                abort("Failed to describe jobs: {}".format(', '.join(batch)),
                       data=exc)
             except KeyError as exc:
-                abort("Failed to list {} jobs on queue: {}"
-                      .format(status, self.jobqueue),
+                abort("Failed to describe jobs: {}".format(', '.join(batch)),
                       data=exc)
-        return results
 
-    def kill_job(self, jobid=None, jobname=None):
+        jobids = list(jobids)
+        batches = [jobids[idx:idx+DESCRIBE_BATCH]
+                   for idx in range(0, len(jobids), DESCRIBE_BATCH)]
+        if not batches:
+            return []
+        with futures.ThreadPoolExecutor(
+                max_workers=min(len(batches), DESCRIBE_WORKERS)) as pool:
+            return [job for jobs in pool.map(describe, batches)
+                    for job in jobs]
+
+    def kill_job(self, jobid=None, jobname=None, jobids=None, prefix=False):
         """
         Kill every job matching a given job id or job name.
+
+        A list of jobids kills exactly those jobs.  The job name is
+        matched as for job_status.
         """
 
-        jobs = self.job_status(jobid, jobname)
+        jobs = self.job_status(jobid, jobname, jobids, prefix=prefix)
         jids = [job['jobId'] for job in jobs]
         try:
             for jid in jids:
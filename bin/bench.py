@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+"""Micro-benchmarks for the AWS helper methods used by cbmc-batch."""
+
+import argparse
+import re
+import time
+
+import boto3
+
+import clientpool
+import s3
+
+################################################################
+
+def per_call(function, iterations):
+    """Average latency in milliseconds of a call to function."""
+
+    start = time.time()
+    for _ in range(iterations):
+        function()
+    return 1000.0 * (time.time() - start) / iterations
+
+def report(name, before, after):
+    """Print the latency of a benchmark before and after an optimization."""
+
+    print("{:<24} before {:9.3f} ms/call  after {:9.3f} ms/call  ({:.1f}x)"
+          .format(name, before, after, before / max(after, 1e-9)))
+
+################################################################
+
+def bench_clients(iterations, region=None, bucket=None):
+    """Compare constructing a client per call with the client pool.
+
+    With a bucket, each call also tests the existence of the bucket,
+    so the comparison includes connection reuse.
+    """
+
+    def fresh():
+        """A call constructing its own client."""
+        client = boto3.client('s3', region_name=region)
+        if bucket:
+            s3.bucket_exists(bucket, client=client)
+
+    def pooled():
+        """A call using the pooled client."""
+        client = clientpool.client('s3', region)
+        if bucket:
+            s3.bucket_exists(bucket, client=client)
+
+    pooled()
+    report('s3 client', per_call(fresh, iterations),
+           per_call(pooled, iterations))
+
+def bench_paths(iterations, region=None, bucket=None):
+    """Compare path handling in the container checkpoint loop.
+
+    Each checkpoint copies the stdout, stderr and ps files to the
+    output bucket, and each copy validates the object path and
+    extracts its bucket and key.  Before paths were memoized, each of
+    those steps parsed the path again with an uncompiled regexp.
+    """
+    # pylint: disable=unused-argument
+
+    outbucket = 's3://{}/cbmc-20190101-000000/out'.format(bucket or 'cbmc')
+    names = ['cbmc-chkpt.txt', 'cbmc-err-chkpt.txt', 'cbmc-ps.txt']
+
+    def parse(path):
+        """Parse a path as s3.parse_path did without memoization."""
+        match = re.match(s3.PATH_REGEXP, path.strip(), re.IGNORECASE)
+        if match is None:
+            return None
+        return (match.group(s3.BUCKET_NAME_GROUP),
+                match.group(s3.KEY_NAME_GROUP))
+
+    def before():
+        """Path handling in a checkpoint before memoization."""
+        for name in names:
+            path = '{}/{}'.format(outbucket, name)
+            pair = parse(path)
+            if pair is None or pair[1] is None:
+                return
+            parse(path)
+            parse(path)
+
+    def after():
+        """Path handling in a checkpoint with memoization."""
+        for name in names:
+            path = '{}/{}'.format(outbucket, name)
+            spath = s3.s3_path(path)
+            if spath is None or not spath.is_object():
+                return
+            _ = (spath.bucket, spath.key)
+
+    report('checkpoint paths', per_call(before, iterations),
+           per_call(after, iterations))
+
+################################################################
+
+BENCHMARKS = {
+    'clients': bench_clients,
+    'paths': bench_paths,
+}
+
+def main():
+    """Run the benchmarks."""
+
+    parser = argparse.ArgumentParser(
+        description='Micro-benchmarks for the cbmc-batch AWS helpers')
+    parser.add_argument('benchmark', nargs='*',
+                        help='Benchmarks to run: {} (default: all)'
+                        .format(', '.join(sorted(BENCHMARKS))))
+    parser.add_argument('--iterations', type=int, default=100,
+                        help='Calls per measurement (default: %(default)s)')
+    parser.add_argument('--region', metavar='REGION',
+                        help='AWS region for the clients')
+    parser.add_argument('--bucket', metavar='BKT',
+                        help='S3 bucket to query in each call (optional)')
+    args = parser.parse_args()
+    for name in args.benchmark:
+        if name not in BENCHMARKS:
+            parser.error("Unknown benchmark: {}".format(name))
+
+    for name in args.benchmark or sorted(BENCHMARKS):
+        BENCHMARKS[name](args.iterations, region=args.region,
+                         bucket=args.bucket)
+
+if __name__ == "__main__":
+    main()
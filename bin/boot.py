@@ -6,6 +6,8 @@
 """Copy cbmc-batch package from S3 and launch it"""
 
 import json
+import subprocess
+import sys
 
 import options
 import package
@@ -15,9 +17,14 @@ def boot():
     opts = options.docker_options()
     print("Booting with options " + json.dumps(opts))
 
-    package.copy('cbmc-batch', opts['pkgbucket'], opts['batchpkg'])
-    package.install('cbmc-batch', opts['batchpkg'], 'cbmc-batch')
-    package.launch('cbmc-batch', 'docker.py', ['--jsons', json.dumps(opts)])
+    package.install_package('cbmc-batch', opts['pkgbucket'], opts['batchpkg'],
+                            'cbmc-batch', region=opts['region'])
+    try:
+        package.launch('cbmc-batch', 'docker.py',
+                       ['--jsons', json.dumps(opts)])
+    except subprocess.CalledProcessError as exc:
+        # Exit with the status of the job (like RESOURCE_EXHAUSTED_EXIT)
+        sys.exit(exc.returncode)
 
 if __name__ == "__main__":
     boot()
@@ -7,7 +7,8 @@ from pprint import pprint
 import json
 
 import clienterror
-from batch import Batch
+import s3
+from batch import Batch, SUBMIT_WORKERS
 
 ################################################################
 
@@ -44,6 +45,35 @@ def abort(msg1, msg2=None, data=None, verbose=False):
 
 ################################################################
 
+PHASES = ['build', 'property', 'coverage', 'report']
+
+# The phases that must finish before each phase can start
+DEPENDS = {
+    'build': [],
+    'property': ['build'],
+    'coverage': ['build'],
+    'report': ['property', 'coverage'],
+}
+
+# A fused job does every phase in one container.  It is named like the
+# report job since, like the report job, it finishes the CBMC job.
+FUSED = 'fused'
+
+# A sharded property phase is a shard job for each set of properties
+# and a merge job combining their results.  The merge job is named
+# like the property job since, like the property job, it writes the
+# CBMC results.
+SHARD = 'shard'
+MERGE = 'merge'
+
+JOB_SUFFIX = {FUSED: 'report', MERGE: 'property'}
+
+# The phase whose memory is used for shard and merge jobs
+MEMORY_PHASE = {SHARD: 'property', MERGE: 'report'}
+
+# The phases checking properties with the portfolio, given the vcpus
+VCPUS_PHASES = ['property', FUSED]
+
 class CBMC:
     """A running instance of CBMC"""
 
@@ -69,91 +99,221 @@ class CBMC:
         self.property = opts['property']
         self.coverage = opts['coverage']
         self.report = opts['report']
+        self.fused = bool(opts.get('fused'))
+        self.shards = opts.get('property_shards') or 1
 
         self.opts = opts
         self.batch = Batch(
             jobname=self.jobdef, queuename=self.jobqueue,
             region=opts['region'])
 
-    def launch_build(self, flags=None, dependson=None):
-        """Build the goto program from source"""
+    def phase_job(self, phase, flags=None, dependson=None, shard=None):
+        """The submit_job arguments for a phase of the CBMC job"""
 
         flags = flags or []
-        jobname = "{}-build".format(self.jobname)
-        full_flags = flags +  ['--dobuild', '--jobname', jobname]
-        memory = self.opts['build_memory']
+        suffix = JOB_SUFFIX.get(phase, phase)
+        if shard is not None:
+            suffix = "{}{}".format(suffix, shard)
+            flags = flags + ['--shard', str(shard)]
+        jobname = "{}-{}".format(self.jobname, suffix)
+        full_flags = flags +  ['--do{}'.format(phase), '--jobname', jobname]
+        memory = self.opts.get('{}_memory'.format(
+            MEMORY_PHASE.get(phase, phase)))
+        if memory is None and phase == FUSED:
+            # Property and coverage run concurrently in a fused job
+            memory = max(self.opts['build_memory'],
+                         self.opts['property_memory'] +
+                         self.opts['coverage_memory'],
+                         self.opts['report_memory'])
+
+        vcpus = self.opts.get('vcpus') if phase in VCPUS_PHASES else None
+
+        return {'jobname': jobname, 'command': full_flags,
+                'memory': memory, 'dependson': dependson, 'vcpus': vcpus}
 
-        return self.batch.submit_job(jobname=jobname, command=full_flags,
-                                     memory=memory, dependson=dependson)
+    def launch_build(self, flags=None, dependson=None):
+        """Build the goto program from source"""
+
+        return self.batch.submit_job(
+            **self.phase_job('build', flags, dependson))
 
     def launch_property(self, flags=None, dependson=None):
         """Run CBMC to check program properties"""
 
-        flags = flags or []
-        jobname = "{}-property".format(self.jobname)
-        full_flags = flags +  ['--doproperty', '--jobname', jobname]
-        memory = self.opts['property_memory']
-
-        return self.batch.submit_job(jobname=jobname, command=full_flags,
-                                     memory=memory, dependson=dependson)
+        return self.batch.submit_job(
+            **self.phase_job('property', flags, dependson))
 
     def launch_coverage(self, flags=None, dependson=None):
         """Run CBMC to compute coverage statistics"""
 
-        flags = flags or []
-        jobname = "{}-coverage".format(self.jobname)
-        full_flags = flags +  ['--docoverage', '--jobname', jobname]
-        memory = self.opts['coverage_memory']
-
-        return self.batch.submit_job(jobname=jobname, command=full_flags,
-                                     memory=memory, dependson=dependson)
+        return self.batch.submit_job(
+            **self.phase_job('coverage', flags, dependson))
 
     def launch_report(self, flags=None, dependson=None):
         """Run cbmc-viewer to construct the final CBMC report"""
 
-        flags = flags or []
-        jobname = "{}-report".format(self.jobname)
-        full_flags = flags +  ['--doreport', '--jobname', jobname]
-        memory = self.opts['report_memory']
+        return self.batch.submit_job(
+            **self.phase_job('report', flags, dependson))
+
+    def launch_fused(self, flags=None, dependson=None):
+        """Build the goto program, run CBMC, and construct the report"""
 
-        return self.batch.submit_job(jobname=jobname, command=full_flags,
-                                     memory=memory, dependson=dependson)
+        return self.batch.submit_job(
+            **self.phase_job(FUSED, flags, dependson))
+
+    def job_specs(self):
+        """
+        Specifications of the CBMC jobs for Batch.submit_many
+
+        Each spec is keyed by the pair (jobname, phase), and the
+        dependencies of a phase are the phases that must finish first.
+        A fused CBMC job is a single job doing every phase.
+        """
+
+        command = ['--jsons', json.dumps(self.opts)]
+        phases = [phase for phase in PHASES if getattr(self, phase)]
+        if self.fused and phases:
+            spec = self.phase_job(FUSED, command)
+            spec['key'] = (self.jobname, FUSED)
+            spec['jobqueue'] = self.jobqueue
+            spec['jobdefinition'] = self.jobdef
+            spec['dependson'] = []
+            return [spec]
+
+        specs = []
+        for phase in phases:
+            dependson = [(self.jobname, dep)
+                         for dep in DEPENDS[phase] if dep in phases]
+            if phase == 'property' and self.shards > 1:
+                specs += self.shard_specs(command, dependson)
+                continue
+            spec = self.phase_job(phase, command)
+            spec['key'] = (self.jobname, phase)
+            spec['jobqueue'] = self.jobqueue
+            spec['jobdefinition'] = self.jobdef
+            spec['dependson'] = dependson
+            specs.append(spec)
+        return specs
+
+    def shard_specs(self, command, dependson):
+        """
+        Specifications of the jobs for a sharded property phase
+
+        Each shard depends on the dependencies of the property phase,
+        and the merge job depends on the shards.  The merge job has the
+        key of the property phase, so later phases depend on the merge.
+        """
+
+        specs = []
+        for index in range(self.shards):
+            spec = self.phase_job(SHARD, command, shard=index)
+            spec['key'] = (self.jobname, "{}{}".format(SHARD, index))
+            spec['jobqueue'] = self.jobqueue
+            spec['jobdefinition'] = self.jobdef
+            spec['dependson'] = dependson
+            specs.append(spec)
+        spec = self.phase_job(MERGE, command)
+        spec['key'] = (self.jobname, 'property')
+        spec['jobqueue'] = self.jobqueue
+        spec['jobdefinition'] = self.jobdef
+        spec['dependson'] = [shard['key'] for shard in specs]
+        return specs + [spec]
+
+    def job_results(self, results):
+        """Summarize the jobs submitted for this CBMC job"""
+
+        summary = {'jobname': self.jobname}
+        for phase in PHASES + [FUSED]:
+            summary[phase] = results.get(
+                (self.jobname, phase), {'jobid': None, 'jobname': None})
+        summary['shards'] = [
+            results[(self.jobname, "{}{}".format(SHARD, index))]
+            for index in range(self.shards)
+            if (self.jobname, "{}{}".format(SHARD, index)) in results]
+        return summary
 
     def submit_jobs(self):
         """
         Submit CBMC jobs to CBMC patch
         """
 
-        command = ['--jsons', json.dumps(self.opts)]
+        submission = self.batch.submit_many(self.job_specs())
+        if submission['errors']:
+            abort("Failed to submit jobs for {}".format(self.jobname),
+                  data=submission['errors'])
+        return self.job_results(submission['results'])
 
-        build_job = {'jobid': None, 'jobname': None}
-        property_job = {'jobid': None, 'jobname': None}
-        coverage_job = {'jobid': None, 'jobname': None}
-        report_job = {'jobid': None, 'jobname': None}
-        buildjob = []
-        propertyjob = []
-        coveragejob = []
-        if self.build:
-            build_job = self.launch_build(command)
-            buildjob = [build_job['jobid']]
-        if self.property:
-            property_job = self.launch_property(command, dependson=buildjob)
-            propertyjob = [property_job['jobid']]
-        if self.coverage:
-            coverage_job = self.launch_coverage(command, dependson=buildjob)
-            coveragejob = [coverage_job['jobid']]
-        if self.report:
-            report_job = self.launch_report(command,
-                                            dependson=(propertyjob+coveragejob))
-
-        results = {
-            'jobname': self.jobname,
-            'build': build_job,
-            'property': property_job,
-            'coverage': coverage_job,
-            'report': report_job,
-            }
+    @staticmethod
+    def submit_all(opts_list, quiet=True, workers=SUBMIT_WORKERS):
+        """
+        Submit the CBMC jobs for many proofs concurrently
+
+        Return the results of submit_jobs for each proof submitted, the
+        errors for each proof that failed, and submission statistics.
+        Proofs share the Batch client, validation, and rate limiter.
+        """
+
+        cbmcs = [CBMC(opts, quiet) for opts in opts_list]
+        if not cbmcs:
+            return {'results': [], 'errors': {}, 'stats': {}}
+        specs = [spec for cbmc in cbmcs for spec in cbmc.job_specs()]
+        submission = cbmcs[0].batch.submit_many(specs, workers)
+
+        errors = {}
+        for ((jobname, phase), error) in submission['errors'].items():
+            errors.setdefault(jobname, {})[phase] = error
+        results = [cbmc.job_results(submission['results'])
+                   for cbmc in cbmcs if cbmc.jobname not in errors]
+        return {'results': results, 'errors': errors,
+                'stats': submission['stats']}
+
+    @staticmethod
+    def submit_array(opts_list, jobname, quiet=True):
+        """
+        Submit the CBMC jobs for many proofs as one array job per phase
+
+        The options for the proofs are written to a manifest in S3, and
+        child i of each array job runs the phase for proof i in the
+        manifest.  Each phase depends on the phases it follows with an
+        N_TO_N dependency, so child i starts when child i of the
+        earlier phases is done.
+        """
 
+        if not opts_list:
+            abort("No proofs to submit as array job {}".format(jobname))
+        cbmc = CBMC(opts_list[0], quiet)
+
+        manifest = s3.path_url("{}/{}/manifest.json".format(
+            opts_list[0]['bucket'], jobname))
+        s3.write_object(manifest, json.dumps(opts_list, indent=2),
+                        region=opts_list[0]['region'])
+
+        # Batch array jobs have at least two children
+        size = len(opts_list)
+        arraysize = size if size > 1 else None
+        deptype = 'N_TO_N' if size > 1 else None
+
+        command = ['--jsons', json.dumps(opts_list[0]),
+                   '--manifest', manifest]
+        phases = [phase for phase in PHASES
+                  if any(opts[phase] for opts in opts_list)]
+
+        results = {'jobname': jobname, 'manifest': manifest, 'size': size}
+        for phase in PHASES:
+            results[phase] = {'jobid': None, 'jobname': None}
+        for phase in phases:
+            phasename = "{}-{}".format(jobname, phase)
+            memory = max(opts['{}_memory'.format(phase)] for opts in opts_list)
+            vcpus = max([opts.get('vcpus') or 0 for opts in opts_list]
+                        if phase in VCPUS_PHASES else [0]) or None
+            dependson = [results[dep]['jobid'] for dep in DEPENDS[phase]
+                         if dep in phases]
+            results[phase] = cbmc.batch.submit_job(
+                jobname=phasename,
+                command=command + ['--do{}'.format(phase),
+                                   '--jobname', phasename],
+                memory=memory, dependson=dependson,
+                arraysize=arraysize, deptype=deptype, vcpus=vcpus)
         return results
 
 ################################################################
@@ -33,6 +33,11 @@ def is_nosuchbucket(exc):
 
     return code(exc) == 'NoSuchBucket'
 
+def is_nosuchkey(exc):
+    """ClientError is NoSuchKey."""
+
+    return code(exc) == 'NoSuchKey'
+
 def is_bucketnotfound(exc):
     """ClientError is BucketNotFound."""
 
@@ -53,5 +58,20 @@ def is_forbidden(exc):
 
     return code(exc) == '403'
 
+def is_too_many_requests(exc):
+    """ClientError is TooManyRequestsException (throttling)."""
+
+    return code(exc) in ['TooManyRequestsException', 'ThrottlingException']
+
+def is_precondition_failed(exc):
+    """ClientError is 412 (PreconditionFailed)."""
+
+    return code(exc) in ['PreconditionFailed', '412']
+
+def is_conditional_conflict(exc):
+    """ClientError is 409 (ConditionalRequestConflict)."""
+
+    return code(exc) in ['ConditionalRequestConflict', '409']
+
 if __name__ == "__main__":
     print(code(None))
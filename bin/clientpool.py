@@ -0,0 +1,71 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+"""A shared pool of boto3 sessions and clients keyed by service and region.
+
+Constructing a boto3 client loads the service model and resolves the
+endpoint, and each client owns its own connection pool.  Clients are
+thread safe once constructed, so every method in this package that
+would otherwise construct a fresh client uses the client for its
+service and region from this pool instead.
+"""
+
+import threading
+
+import boto3
+from botocore.config import Config
+
+################################################################
+
+# Enough connections for the thread pools used for S3 transfers
+MAX_POOL_CONNECTIONS = 50
+
+# Adaptive retries add client-side rate limiting to standard retries
+RETRY_MODE = 'adaptive'
+MAX_ATTEMPTS = 10
+
+CONFIG = Config(max_pool_connections=MAX_POOL_CONNECTIONS,
+                retries={'mode': RETRY_MODE, 'max_attempts': MAX_ATTEMPTS})
+
+# Session and client construction are not thread safe
+LOCK = threading.Lock()
+SESSIONS = {}
+CLIENTS = {}
+
+################################################################
+
+def session(region=None):
+    """The shared boto3 session for a region."""
+
+    with LOCK:
+        return get_session(region)
+
+def client(service, region=None):
+    """The shared boto3 client for a service in a region."""
+
+    key = (service, region)
+    try:
+        return CLIENTS[key]
+    except KeyError:
+        pass
+    with LOCK:
+        if key not in CLIENTS:
+            CLIENTS[key] = get_session(region).client(
+                service, region_name=region, config=CONFIG)
+        return CLIENTS[key]
+
+def get_session(region):
+    """The shared boto3 session for a region (with LOCK held)."""
+
+    if region not in SESSIONS:
+        SESSIONS[region] = boto3.session.Session(region_name=region)
+    return SESSIONS[region]
+
+def clear():
+    """Discard all pooled sessions and clients."""
+
+    with LOCK:
+        SESSIONS.clear()
+        CLIENTS.clear()
+
+################################################################
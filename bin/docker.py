@@ -3,23 +3,63 @@
 
 """Entry point for CBMC job on AWS Batch docker container image"""
 
-import datetime
+import itertools
 import json
 import subprocess
 import os
 import sys
 from pprint import pprint
 import time
+import shlex
 import shutil
+import signal
 import re
+import threading
 
-import boto3
+from botocore.exceptions import ClientError
+from concurrent import futures
 
+import clientpool
+import history
+import procstat
+import resultcache
 import s3
+import shards
 import options
 import package
 
 PUBLIC_WEBSITE_METADATA = {"public-website-contents": "True"}
+
+# Seconds between tests for the exit of a command between checkpoints
+WAIT_INTERVAL = 0.5
+
+# Checkpoints of files are uploaded as segments under NAME.parts
+CHECKPOINT_SEGMENTS = 'parts'
+SEGMENT_MAXIMUM = 64 * s3.MB
+
+# The interval between checkpoints is a fraction of the running time
+# of the command so far, up to a maximum in seconds
+CHECKPOINT_FRACTION = 0.1
+CHECKPOINT_MAXIMUM = 300
+
+# The consolidated checkpoints whose segments are deleted once the
+# checkpoint file is copied to the output bucket: file name and prefix
+CONSOLIDATED = []
+CONSOLIDATED_LOCK = threading.Lock()
+
+# The file describing a phase stopped because memory ran out, and the
+# exit status of the container (EX_TEMPFAIL) so the phase can be rerun
+# with more memory instead of failing the proof
+EXHAUSTED_FILE = 'resource-exhausted.json'
+RESOURCE_EXHAUSTED_EXIT = 75
+
+# The phase whose history sizes the memory of shard and merge jobs (as
+# in cbmc.MEMORY_PHASE)
+HISTORY_PHASE = {'shard': 'property', 'merge': 'report'}
+
+# Identifiers for the groups of commands run together by run_commands
+GROUPS = itertools.count()
+
 def abort(msg):
     """Abort a docker container"""
     sys.stdout.flush()
@@ -27,190 +67,801 @@ def abort(msg):
     sys.stdout.flush()
     raise UserWarning(msg)
 
+class ResourceExhausted(Exception):
+    """The container nearly ran out of memory running commands."""
+
+    def __init__(self, details):
+        super(ResourceExhausted, self).__init__(
+            "Memory exhausted: {} of {} MB".format(details['usage_mb'],
+                                                  details['limit_mb']))
+        self.details = details
+
+# The packages installed in the container: package directory and option
+PACKAGES = {'cbmc': 'cbmcpkg', 'cbmc-viewer': 'viewerpkg'}
+
+def install_packages(opts, pkgs):
+    """Install packages concurrently"""
+    package.install_packages([(pkg, opts['pkgbucket'], opts[PACKAGES[pkg]], pkg)
+                              for pkg in pkgs],
+                             region=opts['region'])
+
 def install_cbmc(opts):
     """Install CBMC binaries"""
-    package.copy('cbmc', opts['pkgbucket'], opts['cbmcpkg'])
-    package.install('cbmc', opts['cbmcpkg'], 'cbmc')
+    install_packages(opts, ['cbmc'])
 
 def install_viewer(opts):
     """Install the cbmc-viewer tool"""
-    package.copy('cbmc-viewer', opts['pkgbucket'], opts['viewerpkg'])
-    package.install('cbmc-viewer', opts['viewerpkg'], 'cbmc-viewer')
+    install_packages(opts, ['cbmc-viewer'])
 
-def get_buckets(opts, copysrc=True):
-    """Copy input buckets to container."""
+# The artifacts of each phase: whether it needs the source tree, the
+# files it reads from the workspace and output buckets, and the files
+# it writes to the output bucket.  Files are patterns for names
+# relative to the workspace (see s3.name_selected), GOTO stands for
+# the goto binary, SHARD for the name of a property shard, and None
+# stands for every file.  A phase reads its inputs from the workspace
+# bucket, too, since the build phase may be skipped for a goto binary
+# (and property list) uploaded with the workspace.
+GOTO = '{goto}'
+SHARD = '{shard}'
+PHASE_ARTIFACTS = {
+    'build': {'source': True, 'workspace': None, 'output': [],
+              'results': None},
+    'property': {'source': False, 'workspace': [GOTO], 'output': [GOTO],
+                 'results': ['cbmc*.txt', 'property*']},
+    'coverage': {'source': False, 'workspace': [GOTO], 'output': [GOTO],
+                 'results': ['coverage*']},
+    'shard': {'source': False, 'workspace': [GOTO, 'property.xml'],
+              'output': [GOTO, 'property.xml'], 'results': [SHARD + '-*']},
+    'merge': {'source': False, 'workspace': ['property.xml'],
+              'output': ['property.xml', 'shard*-cbmc.txt'],
+              'results': ['cbmc.txt']},
+    'report': {'source': True,
+               'workspace': [GOTO, 'cbmc.txt', 'property.xml',
+                             'coverage.xml'],
+               'output': [GOTO, 'cbmc.txt', 'property.xml', 'coverage.xml'],
+               'results': ['report*', 'summary.json', 'html/*']},
+    'fused': {'source': True, 'workspace': None, 'output': None,
+              'results': None},
+}
 
-    if copysrc:
+# Checkpoint copies of files are never copied into the container
+CHECKPOINT_EXCLUDE = ['*-chkpt.*', '*.{}/*'.format(CHECKPOINT_SEGMENTS)]
+
+def phase_artifacts(opts, phase, kind):
+    """The patterns for a kind of artifact of a phase (None for all)"""
+
+    patterns = PHASE_ARTIFACTS[phase][kind]
+    if patterns is None:
+        return None
+    shard = shards.shard_name(opts.get('shard'))
+    return [pattern.replace(GOTO, opts['goto']).replace(SHARD, shard)
+            for pattern in patterns]
+
+def get_buckets(opts, phase):
+    """Copy the input artifacts of a phase to the container."""
+
+    if PHASE_ARTIFACTS[phase]['source']:
         if opts['srctarfile']:
-            tarfile = s3.key_name(opts['srctarfile'])
             tardir = os.path.dirname(opts['srcdir'].rstrip('/'))
-            s3.copy_object_to_file(
-                opts['srctarfile'], tarfile, region=opts['region'])
             try:
-                os.makedirs(tardir)
+                if not os.path.isdir(tardir):
+                    os.makedirs(tardir)
             except OSError:
                 abort("Failed to make directory {}".format(tardir))
-            cmd = ['tar', 'fx', tarfile, '-C', tardir]
-            try:
-                subprocess.check_call(cmd)
-            except subprocess.CalledProcessError:
-                abort("Failed to run command {}".format(' '.join(cmd)))
+            count = s3.extract_object(opts['srctarfile'], tardir,
+                                      members=opts.get('srctarmembers'),
+                                      region=opts['region'])
+            print("Extracted {} files from {} into {}"
+                  .format(count, opts['srctarfile'], tardir))
             if not os.path.isdir(opts['srcdir']):
                 abort("Failed to create {} by untarring {}"
                       .format(opts['srcdir'], opts['srctarfile']))
         else:
-            s3.sync_bucket_to_directory(opts['srcbucket'], opts['srcdir'])
+            s3.sync_bucket_to_directory(opts['srcbucket'], opts['srcdir'],
+                                        region=opts['region'])
             # make scripts in the source tree executable
             subprocess.check_call(['chmod', '+x', '-R', opts['srcdir']])
-    s3.sync_bucket_to_directory(opts['wsbucket'], opts['wsdir'])
-    s3.sync_bucket_to_directory(opts['outbucket'], opts['wsdir'])
+    for (bucket, kind) in [(opts['wsbucket'], 'workspace'),
+                           (opts['outbucket'], 'output')]:
+        include = phase_artifacts(opts, phase, kind)
+        if include == []:
+            continue
+        s3.sync_bucket_to_directory(bucket, opts['wsdir'],
+                                    region=opts['region'], include=include,
+                                    exclude=CHECKPOINT_EXCLUDE)
+
+def put_buckets(opts, phase):
+    """Copy the output artifacts of a phase to the output bucket.
 
-def put_buckets(opts):
-    """Copy container output to bucket."""
+    The segments of the checkpoints copied are deleted after the copy.
+    """
 
-    s3.sync_directory_to_bucket(opts['wsdir'], opts['outbucket'], metadata=PUBLIC_WEBSITE_METADATA)
+    include = phase_artifacts(opts, phase, 'results')
+    s3.sync_directory_to_bucket(opts['wsdir'], opts['outbucket'],
+                                metadata=PUBLIC_WEBSITE_METADATA,
+                                region=opts['region'],
+                                include=include)
+    delete_segments(opts, include)
 
-def checkpoint_file(filename, fileobj, s3path, region):
-    """Write a checkpoint of an open file to a bucket"""
+def delete_segments(opts, include):
+    """Delete the segments of the consolidated checkpoints copied.
 
-    ckptname = "chkpt-{}".format(filename)
-    match = re.match(r'(.+)\.([^.]+)', filename)
+    The checkpoints copied are those whose names match include (every
+    checkpoint if include is None).
+    """
+
+    with CONSOLIDATED_LOCK:
+        copied = [(name, prefix) for (name, prefix) in CONSOLIDATED
+                  if s3.name_selected(name, include)]
+        for checkpoint in copied:
+            CONSOLIDATED.remove(checkpoint)
+    for (_, prefix) in copied:
+        s3.delete_object(prefix + '/', recursive=True, region=opts['region'])
+
+def checkpoint_name(filename):
+    """The name of the checkpoint of a file: cbmc.txt => cbmc-chkpt.txt"""
+
+    basename = os.path.basename(filename)
+    match = re.match(r'(.+)\.([^.]+)', basename)
     if match:
-        ckptname = "{}-chkpt.{}".format(match.group(1), match.group(2))
-
-    fileobj.flush()
-    shutil.copyfile(filename, ckptname)
-    s3.copy_file_to_object(
-        ckptname, "{}/{}".format(s3path, ckptname), region=region)
-
-def checkpoint_performance(logfile, s3path, taskname, region):
-    """Write performance information to a logfile in a bucket"""
-
-    gmt = time.gmtime()
-    timestamp = ("{:04d}{:02d}{:02d}-{:02d}{:02d}{:02d}"
-                 .format(gmt.tm_year, gmt.tm_mon, gmt.tm_mday,
-                         gmt.tm_hour, gmt.tm_min, gmt.tm_sec))
-    output = subprocess.check_output(['ps', 'ux'])
-    cbmc_ps_line = None
-    with open(logfile, "a") as logobj:
-        logobj.write("\n{}\n".format(timestamp))
-        for line in output.split('\n'):
-            if 'USER' in line:
-                logobj.write(line[:80]+'\n')
-            elif 'cbmc' in line:
-                logobj.write(line[:80]+'\n')
-                cbmc_ps_line = line.split()
-    s3.copy_file_to_object(
-        logfile, "{}/{}".format(s3path, logfile), region=region)
-
-    if not cbmc_ps_line:
-        return
+        return "{}-chkpt.{}".format(match.group(1), match.group(2))
+    return "chkpt-{}".format(basename)
 
-    client = boto3.client('cloudwatch', region_name=region)
-    cloudwatch_timestamp = str(
-        datetime.datetime.fromtimestamp(time.mktime(gmt)))
-    client.put_metric_data(
-        Namespace='CBMC-Batch',
-        MetricData=[
-            {
-                'MetricName': 'CPU [%]',
-                'Dimensions': [{'Name': 'Job', 'Value': taskname}],
-                'Timestamp': cloudwatch_timestamp,
-                'Value': float(cbmc_ps_line[2]),
-                'Unit': 'Percent'
-            },
-            {
-                'MetricName': 'Memory [%]',
-                'Dimensions': [{'Name': 'Job', 'Value': taskname}],
-                'Timestamp': cloudwatch_timestamp,
-                'Value': float(cbmc_ps_line[3]),
-                'Unit': 'Percent'
-            },
-            {
-                'MetricName': 'Memory [MB]',
-                'Dimensions': [{'Name': 'Job', 'Value': taskname}],
-                'Timestamp': cloudwatch_timestamp,
-                'Value': float(cbmc_ps_line[4]) / 1024.0,
-                'Unit': 'Megabytes'
-            }
-        ])
+def checkpoint_interval(elapsed, delay):
+    """The seconds until the next checkpoint of a command.
 
+    The interval grows with the running time of the command from delay
+    up to CHECKPOINT_MAXIMUM seconds.
+    """
 
-def run_command(command, outfile, errfile, psfile, opts, delay=10):
-    """Run command in container"""
+    return min(max(delay, elapsed * CHECKPOINT_FRACTION),
+               max(delay, CHECKPOINT_MAXIMUM))
 
-    # pylint: disable=too-many-arguments
+class Checkpoint(object):
+    """Incremental checkpoints of a file written by a running command.
+
+    Each checkpoint uploads only the bytes written to the file since
+    the last checkpoint, as the next numbered segment under the prefix
+    NAME.parts in the bucket, so concatenating the segments in order
+    gives the file.  When the command is done, consolidate writes the
+    checkpoint file NAME to the workspace, for the final copy of the
+    workspace to the bucket, and put_buckets deletes the segments once
+    the file is in the bucket.
+    """
+
+    def __init__(self, filename, fileobj, s3path, region, name=None):
+        # pylint: disable=too-many-arguments
+        self.filename = filename
+        self.fileobj = fileobj
+        self.name = name
+        self.basename = name or os.path.basename(filename)
+        self.prefix = "{}/{}.{}".format(
+            s3path, self.basename, CHECKPOINT_SEGMENTS)
+        self.region = region
+        self.offset = 0
+        self.segment = 0
+
+    def checkpoint(self):
+        """Upload the bytes written since the last checkpoint."""
+
+        if self.fileobj is not None:
+            self.fileobj.flush()
+        try:
+            size = os.path.getsize(self.filename)
+        except OSError:
+            return
+        if size <= self.offset:
+            return
+        with open(self.filename, 'rb') as handle:
+            handle.seek(self.offset)
+            while self.offset < size:
+                data = handle.read(min(size - self.offset, SEGMENT_MAXIMUM))
+                if not data:
+                    break
+                s3.write_object(
+                    "{}/{:06d}".format(self.prefix, self.segment), data,
+                    region=self.region)
+                self.segment += 1
+                self.offset += len(data)
+
+    def consolidate(self):
+        """Write the checkpoint file, keeping the segments until it is copied."""
+
+        if self.fileobj is not None:
+            self.fileobj.flush()
+        if self.name is not None:
+            shutil.copyfile(self.filename, os.path.join(
+                os.path.dirname(self.filename), self.name))
+        if self.segment:
+            with CONSOLIDATED_LOCK:
+                CONSOLIDATED.append((self.basename, self.prefix))
+
+def wait(runs, delay, cancel=None, watchdog=None):
+    """Wait delay seconds for commands, returning early if they all exit.
 
-    cwd = os.getcwd()
-    os.chdir(opts['wsdir'])
+    Return early, too, if the cancel event is set or the memory
+    watchdog reports exhaustion.  Return the report of the watchdog
+    (None if memory is not exhausted).
+    """
+
+    deadline = time.time() + delay
+    while (any([run.running() for run in runs]) and
+           time.time() < deadline):
+        if cancel is not None and cancel.is_set():
+            return None
+        exhausted = watchdog.check() if watchdog is not None else None
+        if exhausted is not None:
+            return exhausted
+        time.sleep(min(WAIT_INTERVAL, max(deadline - time.time(), 0)))
+    return None
+
+class Run(object):
+    """A command running in the workspace with its output files.
+
+    The output of the command goes to outfile and errfile, samples of
+    its process tree go to psfile, and the three files are
+    checkpointed to the output bucket.  The command runs in its own
+    session so that all of its processes (like the compiler run by
+    make, or an external solver run by CBMC) can be killed.
+    """
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, command, outfile, errfile, psfile, opts):
+        # pylint: disable=too-many-arguments
+        cwd = opts['wsdir']
+        path = opts['outbucket']
+        region = opts['region']
+        self.command = command
+        self.end = None
+        self.files = []
+        try:
+            outobj = self.open(os.path.join(cwd, outfile), "w")
+            errobj = self.open(os.path.join(cwd, errfile), "w")
+            psobj = self.open(os.path.join(cwd, psfile), "a")
+            print("Running command: {}".format(' '.join(command)))
+            self.popen = subprocess.Popen(
+                command, universal_newlines=True, cwd=cwd,
+                stdout=outobj, stderr=errobj,
+                preexec_fn=os.setsid)
+        except BaseException:
+            self.close()
+            raise
+        self.psobj = psobj
+        self.sampler = procstat.Sampler(self.popen.pid)
+        self.checkpoints = [
+            Checkpoint(outobj.name, outobj, path, region,
+                       checkpoint_name(outobj.name)),
+            Checkpoint(errobj.name, errobj, path, region,
+                       checkpoint_name(errobj.name)),
+            Checkpoint(psobj.name, psobj, path, region)
+        ]
+
+    def open(self, filename, mode):
+        """Open an output file of the command."""
+        fileobj = open(filename, mode)
+        self.files.append(fileobj)
+        return fileobj
+
+    def running(self):
+        """The command is running (noting the time it exits)."""
+        if self.end is None and self.popen.poll() is not None:
+            self.end = time.time()
+        return self.end is None
+
+    def sample(self):
+        """Sample the process tree of the command and log the sample."""
+        sample = self.sampler.sample()
+        self.sampler.log(self.psobj, sample)
+        return sample
+
+    def checkpoint(self):
+        """Checkpoint the output files of the command."""
+        for ckpt in self.checkpoints:
+            ckpt.checkpoint()
+
+    def consolidate(self):
+        """Write the final checkpoints of the output files."""
+        for ckpt in self.checkpoints:
+            ckpt.consolidate()
+
+    def kill(self):
+        """Kill the command and all of its processes."""
+        print("Killing command: {}".format(' '.join(self.command)))
+        try:
+            os.killpg(self.popen.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        self.popen.wait()
+        self.running()
+
+    def close(self):
+        """Close the output files of the command."""
+        for fileobj in self.files:
+            fileobj.close()
+
+    def usage(self):
+        """The command, its return code, and the resources it used."""
+        usage = self.sampler.summary(self.end)
+        usage['command'] = ' '.join(self.command)
+        usage['returncode'] = self.popen.returncode
+        usage['start'] = round(self.sampler.start, 3)
+        usage['end'] = round(self.end or time.time(), 3)
+        return usage
+
+def run_commands(commands, opts, delay=10, cancel=None):
+    """Run commands concurrently in container
+
+    Each command is a tuple (command, outfile, errfile, psfile) of
+    arguments to run_command.  One loop supervises every command: the
+    process tree of each running command is sampled every delay
+    seconds, the sample is logged to the psfile of the command, the
+    samples of all the commands together are published as metrics, and
+    the files of all the commands are checkpointed.  If the cancel
+    event is set while the commands run, the commands and all of their
+    processes are killed.  If the container nearly runs out of memory,
+    the commands are killed, the final checkpoints are written, and
+    ResourceExhausted is raised.  Return the usage of each command as
+    for run_command.  The usage of commands run together names their
+    group and gives the peak memory of the group: the peak of the
+    samples of all the commands together, and at least the peak of
+    each command.
+    """
+
+    # Run in the workspace without changing the working directory of
+    # this process, since commands may be run concurrently in threads
+    cwd = opts['wsdir']
 
     sys.stdout.flush()
-    print("command = "+" ".join(command))
-    print("outfile = "+outfile)
-    print("errfile = "+errfile)
-    print("psfile = "+psfile)
+    for (command, outfile, errfile, psfile) in commands:
+        print("command = "+" ".join(command))
+        print("outfile = "+os.path.join(cwd, outfile))
+        print("errfile = "+os.path.join(cwd, errfile))
+        print("psfile = "+os.path.join(cwd, psfile))
     print("options = ")
     pprint(opts)
-    print("cwd = "+os.getcwd())
+    print("cwd = "+cwd)
     print("PATH = "+os.environ['PATH'])
     sys.stdout.flush()
 
-    print("Running command: {}".format(' '.join(command)))
+    metrics = procstat.MetricBuffer(opts['taskname'], opts['region'])
+    watchdog = procstat.MemoryWatchdog()
+    exhausted = None
+    group_peak_mb = 0.0
+    runs = []
+    try:
+        for (command, outfile, errfile, psfile) in commands:
+            runs.append(Run(command, outfile, errfile, psfile, opts))
+        start = time.time()
+        next_checkpoint = start
+        while any([run.running() for run in runs]):
+            if cancel is not None and cancel.is_set():
+                for run in runs:
+                    if run.running():
+                        run.kill()
+                break
+            samples = [run.sample() for run in runs if run.running()]
+            if samples:
+                combined = procstat.combine(samples)
+                metrics.add(combined)
+                group_peak_mb = max(group_peak_mb,
+                                    combined.get('rss_mb', 0.0))
+            now = time.time()
+            if now >= next_checkpoint:
+                for run in runs:
+                    run.checkpoint()
+                next_checkpoint = now + checkpoint_interval(now - start, delay)
+            exhausted = wait(runs, delay, cancel, watchdog)
+            if exhausted is not None:
+                print("Memory exhausted: {usage_mb} of {limit_mb} MB"
+                      .format(**exhausted))
+                for run in runs:
+                    if run.running():
+                        run.kill()
+                break
+        metrics.flush()
+        for run in runs:
+            run.consolidate()
+    except BaseException:
+        for run in runs:
+            if run.running():
+                run.kill()
+        raise
+    finally:
+        for run in runs:
+            run.close()
 
-    with open(outfile, "w") as outobj, open(errfile, "w") as errobj:
-        popen = subprocess.Popen(command, universal_newlines=True,
-                                 stdout=outobj, stderr=errobj)
+    usages = [run.usage() for run in runs]
+    if len(usages) > 1:
+        group = next(GROUPS)
+        group_peak_mb = round(max([group_peak_mb] +
+                                  [usage['peak_mb'] for usage in usages]), 1)
+        for usage in usages:
+            usage['group'] = group
+            usage['group_peak_mb'] = group_peak_mb
+    for usage in usages:
+        print("Command returned error code {} after {:.1f}s: {}"
+              .format(usage['returncode'], usage['seconds'],
+                      usage['command']))
+    if exhausted is not None:
+        exhausted['commands'] = usages
+        raise ResourceExhausted(exhausted)
+    return usages
 
-        path = opts['outbucket']
-        taskname = opts['taskname']
-        region = opts['region']
-        while popen.poll() is None:
-            checkpoint_file(outfile, outobj, path, region)
-            checkpoint_file(errfile, errobj, path, region)
-            checkpoint_performance(psfile, path, taskname, region)
-            time.sleep(delay)
+def run_command(command, outfile, errfile, psfile, opts, delay=10,
+                cancel=None):
+    """Run command in container
 
-    print("Command returned error code {}: {}".format(popen.returncode,
-                                                      ' '.join(command)))
-    os.chdir(cwd)
+    The process tree of the command is sampled every delay seconds,
+    and the samples are logged to psfile and published as metrics.
+    If the cancel event is set while the command runs, the command and
+    all of its processes are killed.  Return the command, its return
+    code, its start and end times, and a summary of the resources it
+    used, including its peak memory in MB and its running time in
+    seconds.
+    """
 
-def launch_build(opts):
-    """Launch the build step"""
+    # pylint: disable=too-many-arguments
+
+    return run_commands([(command, outfile, errfile, psfile)], opts,
+                        delay, cancel)[0]
+
+def elapsed(usages):
+    """The seconds from the start of the first command to the end of the last.
+
+    Commands run concurrently count once.
+    """
+
+    if not usages:
+        return 0
+    if not all('start' in usage for usage in usages):
+        return sum(usage['seconds'] for usage in usages)
+    return (max(usage['end'] for usage in usages) -
+            min(usage['start'] for usage in usages))
+
+def peak_memory(usages):
+    """The peak memory in MB of commands, counting concurrent commands together.
+
+    A group of commands run together by run_commands counts as the
+    peak memory of the group.  The peak is the largest sum of the peak
+    memory of the groups and other commands whose running times
+    overlap.
+    """
+
+    if not all('start' in usage for usage in usages):
+        return max([usage.get('group_peak_mb', usage['peak_mb'])
+                    for usage in usages] or [0])
+    spans = {}
+    for usage in usages:
+        key = usage.get('group', ('command', id(usage)))
+        span = spans.setdefault(key, {
+            'peak_mb': usage.get('group_peak_mb', usage['peak_mb']),
+            'start': usage['start'], 'end': usage['end']})
+        span['start'] = min(span['start'], usage['start'])
+        span['end'] = max(span['end'], usage['end'])
+    spans = list(spans.values())
+    return max([sum(other['peak_mb'] for other in spans
+                    if other['start'] <= span['start'] < other['end'] or
+                    other is span)
+                for span in spans] or [0])
+
+def write_resources(opts, phase, usages):
+    """Write a summary of the resources used by a phase to the workspace.
+
+    The summary PHASE-resources.json is copied to the output bucket
+    with the other outputs of the phase.
+    """
+
+    summary = {
+        'phase': phase,
+        'taskname': opts['taskname'],
+        'memory': opts.get('{}_memory'.format(phase)),
+        'seconds': round(elapsed(usages), 3),
+        'command_seconds': round(sum(usage['seconds'] for usage in usages),
+                                 3),
+        'cpu_seconds': round(sum(usage['cpu_seconds'] for usage in usages),
+                             3),
+        'peak_mb': peak_memory(usages),
+        'read_mb': round(sum(usage['read_mb'] for usage in usages), 3),
+        'write_mb': round(sum(usage['write_mb'] for usage in usages), 3),
+        'commands': usages
+    }
+    filename = os.path.join(opts['wsdir'], '{}-resources.json'.format(phase))
+    with open(filename, 'w') as handle:
+        json.dump(summary, handle, indent=2, sort_keys=True)
+
+def record_history(opts, phase, usages, seconds=None):
+    """Record the resources used by the commands of a phase in the history.
+
+    The seconds default to the running time of the commands.
+    Nothing is recorded for a phase that ran no commands because its
+    results came from the result cache.  A failure to record the
+    history does not fail the phase.
+    """
+
+    if not usages:
+        return
+    if seconds is None:
+        seconds = elapsed(usages)
+    fields = {}
+    solvers = [usage['solver'] for usage in usages if usage.get('won')]
+    if solvers:
+        fields['solver'] = solvers[0]
+        fields['won'] = True
+    try:
+        entry = history.record(
+            opts['bucket'], opts['taskname'], phase,
+            peak_mb=peak_memory(usages),
+            seconds=seconds,
+            memory=opts.get('{}_memory'.format(phase)),
+            region=opts['region'], **fields)
+        print("Recorded {} history: {}".format(phase, entry))
+    except s3.S3Exception as error:
+        print("Failed to record {} history: {}".format(phase, error))
+
+def record_exhausted(opts, phase, details):
+    """Record that a phase was stopped because memory ran out.
+
+    The details of the exhaustion are written to EXHAUSTED_FILE, the
+    outputs of the phase so far are copied to the output bucket with
+    it, and the history records the memory in use as the peak memory
+    of a run that ran out, so that memory sized from the history grows
+    when the phase is run again.
+    """
+
+    sized = HISTORY_PHASE.get(phase, phase)
+    usages = details.pop('commands', [])
+    summary = dict(details,
+                   phase=phase,
+                   taskname=opts['taskname'],
+                   memory=opts.get('{}_memory'.format(sized)),
+                   time=int(time.time()),
+                   exitcode=RESOURCE_EXHAUSTED_EXIT,
+                   commands=usages)
+    filename = os.path.join(opts['wsdir'], EXHAUSTED_FILE)
+    with open(filename, 'w') as handle:
+        json.dump(summary, handle, indent=2, sort_keys=True)
+
+    try:
+        s3.copy_file_to_object(filename, "{}/{}".format(opts['outbucket'],
+                                                        EXHAUSTED_FILE),
+                               region=opts['region'])
+        put_buckets(opts, phase)
+    except s3.S3Exception as error:
+        print("Failed to copy the outputs of {}: {}".format(phase, error))
+
+    try:
+        entry = history.record(
+            opts['bucket'], opts['taskname'], sized,
+            peak_mb=details['usage_mb'],
+            seconds=elapsed(usages),
+            memory=summary['memory'],
+            region=opts['region'], exhausted=True)
+        print("Recorded {} history: {}".format(sized, entry))
+    except s3.S3Exception as error:
+        print("Failed to record {} history: {}".format(sized, error))
+
+def run_build(opts):
+    """Run the build step in the workspace"""
 
-    install_cbmc(opts)
-    get_buckets(opts)
     print("Launching Build")
     cmd = ['make', 'goto']
-    run_command(cmd, 'build.txt', 'build-err.txt', 'build-ps.txt', opts)
+    usage = run_command(cmd, 'build.txt', 'build-err.txt', 'build-ps.txt',
+                        opts)
     print("Finished Build")
-    put_buckets(opts)
+    write_resources(opts, 'build', [usage])
+    return [usage]
 
-def launch_property(opts):
-    """Launch the property step"""
+def run_property(opts):
+    """Run the property step in the workspace
+
+    The properties are checked and listed concurrently.
+    """
 
-    install_cbmc(opts)
-    get_buckets(opts, copysrc=False)
     print("Launching Property")
 
     cmd = ['cbmc', opts['goto']]
     cmd += options.options_dict2words(opts['cbmcflags'])
     cmd += ['--trace']
-    run_command(cmd, 'cbmc.txt', 'cbmc-err.txt', 'cbmc-ps.txt', opts)
+    if opts.get('portfolio'):
+        with futures.ThreadPoolExecutor(max_workers=1) as pool:
+            listing = pool.submit(run_show_properties, opts)
+            usage = run_portfolio(opts, cmd, ranked_solvers(opts))
+        usages = [usage, listing.result()]
+    else:
+        usages = run_commands([
+            (cmd, 'cbmc.txt', 'cbmc-err.txt', 'cbmc-ps.txt'),
+            show_properties_command(opts)
+        ], opts)
+
+    print("Finished Property")
+    for usage in usages:
+        print("  {:.1f}s: {}".format(usage['seconds'], usage['command']))
+    write_resources(opts, 'property', usages)
+    return usages
+
+def solver_words(solver):
+    """The CBMC flags selecting a solver in the portfolio."""
+
+    if solver.strip() in ['', 'default']:
+        return []
+    return shlex.split(solver)
+
+def ranked_solvers(opts):
+    """The solvers in the portfolio, those that won past runs first."""
+
+    try:
+        histories = history.phase_histories(
+            opts['bucket'], opts['taskname'], ['property', 'fused'],
+            region=opts['region'])
+    except s3.S3Exception as error:
+        print("Failed to read solver history: {}".format(error))
+        return opts['portfolio']
+    return history.rank_solvers(histories['property'] + histories['fused'],
+                                opts['portfolio'])
+
+def run_portfolio(opts, command, solvers):
+    """Race the command with each solver in the portfolio
+
+    The runs start in the order of the solvers, at most one per vCPU
+    of the job at a time, and the first run to complete wins: the
+    other runs are killed, and the output of the winner is copied to
+    cbmc.txt.  Return the usage of the winner naming its solver, with
+    the peak memory of the runs that overlapped and the CPU time of
+    all the runs together.  If no run
+    completes, return the usage of the first run, and the usage does
+    not count as a win.
+    """
+
+    done = threading.Event()
+    lock = threading.Lock()
+    winners = []
+
+    def race(index, solver):
+        """Run the command with a solver unless the race is over."""
+        if done.is_set():
+            return None
+        name = 'cbmc-portfolio{}'.format(index)
+        try:
+            usage = run_command(command + solver_words(solver),
+                                name + '.txt', name + '-err.txt',
+                                name + '-ps.txt', opts, cancel=done)
+        except ResourceExhausted:
+            # Stop the other runs sharing the memory of the container
+            done.set()
+            raise
+        usage['solver'] = solver
+        usage['name'] = name
+        with lock:
+            if (usage['returncode'] in resultcache.CBMC_COMPLETED and
+                    not winners):
+                winners.append(usage)
+                done.set()
+        return usage
+
+    print("Racing solvers: {}".format(', '.join(solvers)))
+    workers = min(len(solvers), job_vcpus(opts))
+    with futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        runs = [pool.submit(race, index, solver)
+                for index, solver in enumerate(solvers)]
+    usages = [run.result() for run in runs if run.result() is not None]
+
+    usage = dict(winners[0] if winners else usages[0])
+    usage['won'] = bool(winners)
+    print("Solver {} {}".format(usage['solver'],
+                                'won' if winners else 'failed'))
+    for (src, dst) in [('.txt', 'cbmc.txt'), ('-err.txt', 'cbmc-err.txt'),
+                       ('-ps.txt', 'cbmc-ps.txt')]:
+        shutil.copyfile(os.path.join(opts['wsdir'], usage['name'] + src),
+                        os.path.join(opts['wsdir'], dst))
+    usage['peak_mb'] = peak_memory(usages)
+    usage['cpu_seconds'] = round(sum(run['cpu_seconds'] for run in usages), 3)
+    usage['portfolio'] = [dict((key, run[key]) for key in
+                               ['solver', 'returncode', 'seconds', 'peak_mb'])
+                          for run in usages]
+    return usage
+
+def job_vcpus(opts):
+    """The vCPUs of the job: the vcpus option, or those of the job definition
+
+    The CPUs of the host running the container may be many more.  A
+    job whose vCPUs are unknown has one.
+    """
+
+    if opts.get('vcpus'):
+        return opts['vcpus']
+    jobid = os.environ.get('AWS_BATCH_JOB_ID')
+    if jobid:
+        try:
+            client = clientpool.client('batch', opts['region'])
+            jobs = client.describe_jobs(jobs=[jobid])['jobs']
+            if jobs and jobs[0]['container'].get('vcpus'):
+                return jobs[0]['container']['vcpus']
+        except (ClientError, KeyError) as error:
+            print("Failed to read the vCPUs of job {}: {}"
+                  .format(jobid, error))
+    return 1
+
+def show_properties_command(opts):
+    """The command listing the properties of the goto program
+
+    The command is a tuple of arguments to run_command.
+    """
 
     cmd = ['cbmc', opts['goto']]
     cmd += options.options_dict2words(opts['cbmcflags'])
     cmd += ['--show-properties', '--xml-ui']
-    run_command(cmd, 'property.xml', 'property-err.txt', 'property-ps.txt',
-                opts)
+    return (cmd, 'property.xml', 'property-err.txt', 'property-ps.txt')
 
-    print("Finished Property")
-    put_buckets(opts)
+def run_show_properties(opts):
+    """List the properties of the goto program in property.xml"""
 
-def launch_coverage(opts):
-    """Launch the coverage step"""
+    return run_command(*show_properties_command(opts), opts=opts)
+
+def run_shard(opts):
+    """Run the property step for one shard of the properties
+
+    The shard writes its results to SHARD-cbmc.txt.  A shard with no
+    properties to check runs nothing.
+    """
+
+    name = shards.shard_name(opts['shard'])
+    names = shards.read_properties(os.path.join(opts['wsdir'],
+                                                'property.xml'))
+    if names is None:
+        abort("Failed to read the properties listed in property.xml")
+    names = shards.shard_properties(names, opts['shard'],
+                                    opts['property_shards'])
+    print("Launching Property {}: {} properties".format(name, len(names)))
+    if not names:
+        return []
+
+    cmd = ['cbmc', opts['goto']]
+    cmd += options.options_dict2words(opts['cbmcflags'])
+    cmd += ['--trace']
+    for prop in names:
+        cmd += ['--property', prop]
+    usage = run_command(cmd, '{}-cbmc.txt'.format(name),
+                        '{}-cbmc-err.txt'.format(name),
+                        '{}-cbmc-ps.txt'.format(name), opts)
+
+    print("Finished Property {}".format(name))
+    write_resources(opts, name, [usage])
+    return [usage]
+
+def merge_shards(opts):
+    """Merge the results of the property shards into cbmc.txt"""
+
+    names = shards.read_properties(os.path.join(opts['wsdir'],
+                                                'property.xml'))
+    if names is None:
+        abort("Failed to read the properties listed in property.xml")
+
+    results = []
+    for index in range(opts['property_shards']):
+        if not shards.shard_properties(names, index, opts['property_shards']):
+            continue
+        path = os.path.join(opts['wsdir'], '{}-cbmc.txt'.format(
+            shards.shard_name(index)))
+        try:
+            with open(path) as handle:
+                result = shards.Results(handle.read())
+        except (IOError, OSError):
+            abort("Failed to read the results of shard {}".format(index))
+        if result.verdict is None:
+            abort("Shard {} did not finish checking its properties"
+                  .format(index))
+        results.append(result)
+
+    text = shards.merge(results, names)
+    with open(os.path.join(opts['wsdir'], 'cbmc.txt'), 'w') as handle:
+        handle.write(text)
+    print("Merged {} property shards: {}"
+          .format(len(results), text.splitlines()[-1]))
+
+def run_coverage(opts):
+    """Run the coverage step in the workspace"""
 
-    install_cbmc(opts)
-    get_buckets(opts, copysrc=False)
     print("Launching Coverage")
 
     cmd = ['cbmc', opts['goto']]
@@ -221,18 +872,16 @@ def launch_coverage(opts):
                            '--trace',
                            '--stop-on-fail']]
     cmd += ['--cover', 'location', '--xml-ui']
-    run_command(cmd, 'coverage.xml', 'coverage-err.txt', 'coverage-ps.txt',
-                opts)
+    usage = run_command(cmd, 'coverage.xml', 'coverage-err.txt',
+                        'coverage-ps.txt', opts)
 
     print("Finished Coverage")
-    put_buckets(opts)
+    write_resources(opts, 'coverage', [usage])
+    return [usage]
 
-def launch_report(opts):
-    """Launch the report step"""
+def run_report(opts):
+    """Run the report step in the workspace"""
 
-    install_cbmc(opts)
-    install_viewer(opts)
-    get_buckets(opts)
     print("Launching Report")
 
     cmd = ['cbmc-viewer',
@@ -245,10 +894,15 @@ def launch_report(opts):
            '--blddir', opts['blddir'],
            '--json-summary', 'summary.json'
           ]
-    run_command(cmd, 'report.txt', 'report-err.txt', 'report-ps.txt', opts)
+    usage = run_command(cmd, 'report.txt', 'report-err.txt', 'report-ps.txt',
+                        opts)
 
     print("Finished Report")
-    put_buckets(opts)
+    write_resources(opts, 'report', [usage])
+    return [usage]
+
+def report_metrics(opts):
+    """Write the coverage summary of the report to CloudWatch"""
 
     summary = None
     with open(os.path.join(opts['wsdir'], 'summary.json'), 'r') as j:
@@ -262,7 +916,7 @@ def launch_report(opts):
         float(summary['coverage']['statically-reachable']['hit']) /
         float(lines))
     taskname = opts['taskname']
-    client = boto3.client('cloudwatch', region_name=opts['region'])
+    client = clientpool.client('cloudwatch', opts['region'])
     client.put_metric_data(
         Namespace='CBMC-Batch',
         MetricData=[
@@ -280,6 +934,162 @@ def launch_report(opts):
             }
         ])
 
+def run_cached(opts, phase, step):
+    """Run a step unless its results are found in the result cache
+
+    Return the resources used by the commands run (none on a hit).
+    """
+
+    if not opts.get('result_cache', True):
+        return step(opts)
+
+    key = resultcache.result_key(opts)
+    if key is None:
+        print("No result cache key for {}".format(phase))
+        return step(opts)
+    hit = resultcache.restore(opts, key, phase)
+    resultcache.record_lookup(opts, phase, hit)
+    if hit:
+        print("Restored {} results from result cache".format(phase))
+        return []
+
+    usages = step(opts)
+    resultcache.store(opts, key, phase, usages)
+    return usages
+
+def launch_build(opts):
+    """Launch the build step"""
+
+    install_cbmc(opts)
+    get_buckets(opts, 'build')
+    usages = run_build(opts)
+    if opts['property_shards'] > 1:
+        # List the properties once for the property shards
+        usages.append(run_show_properties(opts))
+    put_buckets(opts, 'build')
+    record_history(opts, 'build', usages)
+
+def launch_property(opts):
+    """Launch the property step"""
+
+    install_cbmc(opts)
+    get_buckets(opts, 'property')
+    usages = run_cached(opts, 'property', run_property)
+    put_buckets(opts, 'property')
+    record_history(opts, 'property', usages)
+
+def launch_coverage(opts):
+    """Launch the coverage step"""
+
+    install_cbmc(opts)
+    get_buckets(opts, 'coverage')
+    usages = run_cached(opts, 'coverage', run_coverage)
+    put_buckets(opts, 'coverage')
+    record_history(opts, 'coverage', usages)
+
+def launch_shard(opts):
+    """Launch the property step for one shard of the properties"""
+
+    install_cbmc(opts)
+    get_buckets(opts, 'shard')
+    run_shard(opts)
+    put_buckets(opts, 'shard')
+
+def launch_merge(opts):
+    """Launch the merge of the results of the property shards"""
+
+    get_buckets(opts, 'merge')
+    merge_shards(opts)
+    put_buckets(opts, 'merge')
+
+def launch_report(opts):
+    """Launch the report step"""
+
+    install_packages(opts, ['cbmc', 'cbmc-viewer'])
+    get_buckets(opts, 'report')
+    usages = run_report(opts)
+    put_buckets(opts, 'report')
+    record_history(opts, 'report', usages)
+    report_metrics(opts)
+
+def launch_fused(opts):
+    """Launch the build, property, coverage, and report steps together
+
+    The steps run in one container: the property and coverage steps
+    run concurrently after the build, and the report after both.  The
+    goto binary and other intermediate files stay in the workspace,
+    and the workspace is copied to the output bucket once at the end.
+    The phases disabled in the options are skipped.
+    """
+
+    start = time.time()
+    install_packages(opts, ['cbmc', 'cbmc-viewer'] if opts.get('report', True)
+                     else ['cbmc'])
+    get_buckets(opts, 'fused')
+
+    usages = []
+    if opts.get('build', True):
+        usages += run_build(opts)
+
+    steps = [(phase, step) for phase, step in [('property', run_property),
+                                               ('coverage', run_coverage)]
+             if opts.get(phase, True)]
+    if steps:
+        with futures.ThreadPoolExecutor(max_workers=len(steps)) as pool:
+            results = [pool.submit(run_cached, opts, phase, step)
+                       for phase, step in steps]
+        for result in results:
+            usages += result.result()
+
+    if opts.get('report', True):
+        usages += run_report(opts)
+
+    put_buckets(opts, 'fused')
+    record_history(opts, 'fused', usages, seconds=time.time() - start)
+    if opts.get('report', True):
+        report_metrics(opts)
+
+def manifest_options(opts):
+    """Options for the proof run by this child of an array job.
+
+    Child i of an array job runs the proof given by entry i of the
+    manifest.  Return None if the phase is disabled for that proof.
+    """
+
+    index = int(os.environ.get('AWS_BATCH_JOB_ARRAY_INDEX', '0'))
+    data = s3.read_object(opts['manifest'], region=opts['region'])
+    if data is None:
+        abort("Failed to read manifest {}".format(opts['manifest']))
+    proofs = json.loads(data.decode('utf-8'))
+    if index >= len(proofs):
+        abort("No proof {} in manifest {} of {} proofs"
+              .format(index, opts['manifest'], len(proofs)))
+
+    proof = proofs[index]
+    print("Array job child {} running proof {}"
+          .format(index, proof['jobname']))
+    proof['manifest'] = opts['manifest']
+    for phase in ['build', 'property', 'coverage', 'report', 'fused']:
+        doflag = 'do{}'.format(phase)
+        proof[doflag] = opts[doflag]
+        if proof[doflag] and not proof.get(phase, True):
+            print("Phase {} disabled for proof {}"
+                  .format(phase, proof['jobname']))
+            return None
+    for flag in ['doshard', 'domerge', 'shard']:
+        proof[flag] = opts[flag]
+    return proof
+
+def launch(opts, phase, launcher):
+    """Launch a phase, exiting with RESOURCE_EXHAUSTED_EXIT if memory runs out"""
+
+    try:
+        launcher(opts)
+    except ResourceExhausted as error:
+        print("Stopped {}: {}".format(phase, error))
+        record_exhausted(opts, phase, error.details)
+        sys.stdout.flush()
+        sys.exit(RESOURCE_EXHAUSTED_EXIT)
 
 def main():
     """Run the job"""
@@ -293,32 +1103,53 @@ def main():
 
     opts = options.docker_options()
 
+    if opts['manifest']:
+        opts = manifest_options(opts)
+        if opts is None:
+            return
+
     print("docker options")
     pprint(opts)
 
     if more_than_one([opts['dobuild'], opts['doproperty'],
-                      opts['docoverage'], opts['doreport']]):
+                      opts['docoverage'], opts['doreport'],
+                      opts['dofused'], opts['doshard'], opts['domerge']]):
         print("Too many commands passed to docker container.")
         return
 
+    if opts['dofused']:
+        print("docker doing fused build, property, coverage, and report")
+        launch(opts, 'fused', launch_fused)
+        return
+
     if opts['dobuild']:
         print("docker doing build")
-        launch_build(opts)
+        launch(opts, 'build', launch_build)
         return
 
     if opts['doproperty']:
         print("docker doing property")
-        launch_property(opts)
+        launch(opts, 'property', launch_property)
+        return
+
+    if opts['doshard']:
+        print("docker doing property shard {}".format(opts['shard']))
+        launch(opts, 'shard', launch_shard)
+        return
+
+    if opts['domerge']:
+        print("docker doing property merge")
+        launch(opts, 'merge', launch_merge)
         return
 
     if opts['docoverage']:
         print("docker doing coverage")
-        launch_coverage(opts)
+        launch(opts, 'coverage', launch_coverage)
         return
 
     if opts['doreport']:
         print("docker doing report")
-        launch_report(opts)
+        launch(opts, 'report', launch_report)
         return
 
     print("docker done")
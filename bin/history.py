@@ -0,0 +1,255 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+"""A history of the resources used by each phase of each proof.
+
+The container records the peak memory and the running time of each
+run of each phase of each proof in a small JSON object in the bucket, and
+cbmc-batch reads these records to size the memory requested for each
+phase from what the proof has actually used in the past, and to choose
+the proofs small enough to run every phase in one fused job.
+"""
+
+import collections
+import json
+import math
+import time
+import uuid
+
+from concurrent import futures
+
+import s3
+
+################################################################
+
+# Records are stored one per run under
+# BUCKET/HISTORY_PREFIX/TASKNAME/PHASE/TIME-ID.json, so concurrent runs
+# of a phase never overwrite each other's records
+HISTORY_PREFIX = 'history'
+
+# The number of recent records kept for each phase of each proof
+HISTORY_LENGTH = 20
+
+# Memory estimates are rounded up to a multiple of MEMORY_QUANTUM MB
+MEMORY_QUANTUM = 128
+
+# Memory estimates are never smaller than MEMORY_MINIMUM MB
+MEMORY_MINIMUM = 512
+
+# Default percentile of peak memory and headroom factor for estimates
+MEMORY_PERCENTILE = 95
+MEMORY_HEADROOM = 1.25
+
+# A run that ran out of memory needs this many times the memory it had
+EXHAUSTED_GROWTH = 2
+
+# The phases of a proof, and the fused phase doing them all in one job
+PHASES = ['build', 'property', 'coverage', 'report', 'fused']
+
+################################################################
+
+def history_path(bucket, taskname, phase):
+    """The S3 path to the history of a phase of a proof."""
+
+    return "{}/{}/{}/{}".format(s3.path_url(bucket), HISTORY_PREFIX,
+                                taskname, phase)
+
+def record_keys(bucket, taskname, phase, region=None):
+    """The keys of the records for a phase of a proof, oldest first."""
+
+    path = history_path(bucket, taskname, phase)
+    return sorted(obj['Key'] for obj in
+                  s3.list_objects(s3.bucket_name(path),
+                                  s3.key_name(path) + '/',
+                                  region=region, delimiter='/'))
+
+def read_record(name, key, region=None):
+    """The record stored under key in bucket name (None if missing or corrupt)."""
+
+    data = s3.read_object(s3.path_url("{}/{}".format(name, key)),
+                          region=region)
+    if data is None:
+        return None
+    try:
+        entry = json.loads(data.decode('utf-8'))
+    except ValueError:
+        print("Ignoring corrupt history record {}".format(key))
+        return None
+    return entry if isinstance(entry, dict) else None
+
+def read_history(bucket, taskname, phase, region=None):
+    """The list of recent records for a phase of a proof (empty if none).
+
+    The records are the last HISTORY_LENGTH records, oldest first.
+    """
+
+    keys = record_keys(bucket, taskname, phase, region)[-HISTORY_LENGTH:]
+    if not keys:
+        return []
+    name = s3.bucket_name(history_path(bucket, taskname, phase))
+    with futures.ThreadPoolExecutor(max_workers=len(keys)) as pool:
+        records = list(pool.map(lambda key: read_record(name, key, region),
+                                keys))
+    return [entry for entry in records if entry is not None]
+
+def prune_history(bucket, taskname, phase, region=None):
+    """Delete all but the last HISTORY_LENGTH records for a phase of a proof."""
+
+    keys = record_keys(bucket, taskname, phase, region)[:-HISTORY_LENGTH]
+    if keys:
+        s3.delete_keys(s3.bucket_name(history_path(bucket, taskname, phase)),
+                       keys, region=region)
+
+def record(bucket, taskname, phase, peak_mb, seconds, memory=None,
+           region=None, **fields):
+    """Append a record of the resources used by a phase of a proof.
+
+    The peak memory is in MB, and memory is the memory in MB that was
+    requested for the job.  Any other fields are stored in the record
+    as given.  The record is a new object, and the oldest records
+    beyond HISTORY_LENGTH are deleted.
+    """
+    # pylint: disable=too-many-arguments
+
+    now = time.time()
+    entry = {'time': int(now),
+             'peak_mb': int(math.ceil(peak_mb)),
+             'seconds': int(round(seconds)),
+             'memory': memory}
+    entry.update(fields)
+
+    s3.write_object("{}/{:013d}-{}.json".format(
+        history_path(bucket, taskname, phase), int(now * 1000),
+        uuid.uuid4().hex[:8]), json.dumps(entry), region=region)
+    prune_history(bucket, taskname, phase, region)
+    return entry
+
+################################################################
+
+def percentile(values, pct):
+    """The nearest-rank percentile of a list of values."""
+
+    if not values:
+        return None
+    values = sorted(values)
+    rank = int(math.ceil(pct / 100.0 * len(values)))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+def estimate_memory(records, pct=MEMORY_PERCENTILE, headroom=MEMORY_HEADROOM):
+    """The memory in MB to request given the records of past runs.
+
+    The estimate is the percentile of the peak memory used by past
+    runs scaled by the headroom, and at least EXHAUSTED_GROWTH times
+    the memory of any past run that ran out of memory, rounded up to
+    MEMORY_QUANTUM.  Return None if there are no records.
+    """
+
+    peak = percentile([entry['peak_mb'] for entry in records
+                       if entry.get('peak_mb')], pct)
+    if peak is None:
+        return None
+    peak *= headroom
+    for entry in records:
+        if entry.get('exhausted'):
+            peak = max(peak, EXHAUSTED_GROWTH *
+                       max(entry.get('peak_mb') or 0, entry.get('memory') or 0))
+    memory = int(math.ceil(peak / MEMORY_QUANTUM)) * MEMORY_QUANTUM
+    return max(memory, MEMORY_MINIMUM)
+
+def estimate_seconds(records):
+    """The median running time in seconds of past runs (None if none).
+
+    Runs stopped because they ran out of memory are not counted.
+    """
+
+    return percentile([entry['seconds'] for entry in records
+                       if entry.get('seconds') is not None and
+                       not entry.get('exhausted')], 50)
+
+def rank_solvers(records, solvers):
+    """The solvers of a portfolio ordered by their wins in past runs.
+
+    Solvers that won more of the past runs come first, and solvers
+    with equal wins keep their order in the portfolio.  Only records
+    of runs that a solver won count.
+    """
+
+    wins = collections.Counter(entry.get('solver') for entry in records
+                               if entry.get('won'))
+    return sorted(solvers, key=lambda solver: -wins[solver])
+
+def phase_histories(bucket, taskname, phases=None, region=None):
+    """The records for each phase of a proof read concurrently."""
+
+    phases = phases or PHASES
+    with futures.ThreadPoolExecutor(max_workers=len(phases)) as pool:
+        reads = {phase: pool.submit(read_history, bucket, taskname, phase,
+                                    region)
+                 for phase in phases}
+    return {phase: read.result() for phase, read in reads.items()}
+
+def size_memory(opts, histories, quiet=False):
+    """Set the memory for each phase in opts from the history.
+
+    Phases of proofs with no history keep the memory configured in
+    opts.  Return the dictionary of memory estimates used.
+    """
+
+    estimates = {}
+    for phase in PHASES:
+        memory = estimate_memory(histories[phase],
+                                 opts['memory_percentile'],
+                                 opts['memory_headroom'])
+        if memory is None:
+            continue
+        key = '{}_memory'.format(phase)
+        if not quiet:
+            print("Sizing {} memory for {} from history: {} MB (was {})"
+                  .format(phase, opts['taskname'], memory, opts[key]))
+        opts[key] = memory
+        estimates[phase] = memory
+    return estimates
+
+def choose_fused(opts, histories, quiet=False):
+    """Fuse the phases of a proof whose past runs took little time.
+
+    The running time of a proof is the median running time of its past
+    fused runs, or the sum of the median running times of its past
+    phases.  A proof is fused if this time is less than the fused
+    threshold in opts.  Proofs with no history are not fused.
+    """
+
+    seconds = estimate_seconds(histories['fused'])
+    if seconds is None:
+        times = [estimate_seconds(histories[phase])
+                 for phase in PHASES if phase != 'fused']
+        if None in times[:2]:
+            return False
+        seconds = sum(sec for sec in times if sec is not None)
+
+    opts['fused'] = seconds < opts['fused_threshold']
+    if opts['fused'] and not quiet:
+        print("Fusing phases for {}: past runs took {}s"
+              .format(opts['taskname'], seconds))
+    return opts['fused']
+
+def apply(opts, quiet=False):
+    """Use the history of a proof to set the options for running it.
+
+    With auto_memory, set the memory for each phase from the history.
+    With a fused threshold and fused unset, fuse the phases of a proof
+    whose past runs took less time than the threshold.
+    """
+
+    size = opts['auto_memory']
+    fuse = opts['fused'] is None and opts['fused_threshold'] > 0
+    if not (size or fuse):
+        return
+    histories = phase_histories(opts['bucket'], opts['taskname'],
+                                region=opts['region'])
+    if size:
+        size_memory(opts, histories, quiet)
+    if fuse:
+        choose_fused(opts, histories, quiet)
+
+################################################################
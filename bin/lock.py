@@ -5,9 +5,15 @@
 
 import re
 import sys
+import time
+import json
+import random
+import uuid
 
-import boto3
+from botocore.exceptions import ClientError
 
+import clienterror
+import clientpool
 import s3
 
 ################################################################
@@ -58,6 +64,14 @@ COVERAGE = 'coverage.txt'
 REPORT = 'report.txt'
 LOCKS = [BUILD, PROPERTY, COVERAGE, REPORT]
 
+# A lock set by acquire is a lease: it records in its metadata the
+# time at which it expires, and an expired lease counts as unset.  Only
+# a lease that expires has a body, so a listing tells the locks that
+# never expire (empty objects) from the leases whose metadata must be
+# read.
+LEASE_EXPIRES = 'lease-expires'
+LEASE_HOLDER = 'lease-holder'
+
 class Lock:
     """A lock to control CBMC job dependencies."""
 
@@ -69,9 +83,11 @@ class Lock:
         self.bucket = s3.bucket_name(path)
         self.prefix = s3.key_name(path)
         self.locks = LOCKS
-        self.client = boto3.client('s3', region_name=region)
+        self.client = clientpool.client('s3', region)
         if not s3.bucket_exists(self.bucket, client=self.client):
             raise LockException("Bucket does not exist: {}".format(self.bucket))
+        # Lease expiration times of the lock objects in the last listing
+        self.expiration = {}
 
     def get_lock_set(self):
         """The set of locks mantained."""
@@ -85,6 +101,13 @@ class Lock:
             return "{}/{}".format(self.bucket, lock)
         return "{}/{}/{}".format(self.bucket, self.prefix, lock)
 
+    def lock_key(self, lock):
+        """The object key for a lock"""
+
+        if not self.prefix:
+            return lock
+        return "{}/{}".format(self.prefix, lock)
+
     def validate_lock(self, lock):
         """Validate that lock is a known lock."""
 
@@ -108,28 +131,214 @@ class Lock:
         """Test if lock is set"""
 
         self.validate_lock(lock)
-        return s3.object_exists(self.lock_path(lock), client=self.client)
+        response = self.head(lock)
+        return response is not None and not lease_expired(response)
 
     def is_unset(self, lock):
         """Test is lock is unset"""
 
+        return not self.is_set(lock)
+
+    def state(self):
+        """The state of every lock in the lock set (True if set).
+
+        The state comes from a single listing of the lock prefix.
+        """
+
+        prefix = "{}/".format(self.prefix) if self.prefix else ""
+        objects = {}
+        for obj in s3.list_objects(self.bucket, prefix, client=self.client,
+                                   delimiter='/'):
+            lock = obj['Key'][len(prefix):]
+            if lock in self.locks:
+                objects[lock] = obj
+
+        versions = dict((lock, lock_version(lock, obj))
+                        for lock, obj in objects.items())
+        self.expiration = dict((version, expiration) for version, expiration
+                               in self.expiration.items()
+                               if version in versions.values())
+        return dict((lock, lock in objects and not self.expired(lock,
+                                                                objects[lock]))
+                    for lock in self.locks)
+
+    def expired(self, lock, obj):
+        """Test if the lock object obj found by a listing is an expired lease.
+
+        A listing omits object metadata, so the expiration time of each
+        lease that expires is read once and remembered.  An empty lock
+        object never expires.
+        """
+
+        if not obj.get('Size'):
+            return False
+        version = lock_version(lock, obj)
+        if version not in self.expiration:
+            response = self.head(lock)
+            if response is None:
+                return True
+            self.expiration[version] = lease_expiration(response)
+        expiration = self.expiration[version]
+        return expiration is not None and expiration <= time.time()
+
+    def head(self, lock):
+        """The head_object response for a lock (None if lock is unset)."""
+
+        try:
+            return self.client.head_object(Bucket=self.bucket,
+                                           Key=self.lock_key(lock))
+        except ClientError as exc:
+            if clienterror.is_not_found(exc) or clienterror.is_forbidden(exc):
+                return None
+            raise LockException("Can't read lock {}: {}"
+                                .format(self.lock_path(lock), exc))
+
+    def acquire(self, lock, ttl=None, holder=None):
+        """Set lock as a lease unless it is already set.
+
+        Return True if the lock was acquired.  A lock held with a ttl (a
+        bound like 30m or a number of seconds) expires after ttl, and
+        an expired lease is broken and acquired.
+        """
+
         self.validate_lock(lock)
-        return not s3.object_exists(self.lock_path(lock), client=self.client)
+        expires = time.time() + (parse_bound(ttl)
+                                 if isinstance(ttl, str) else ttl or 0)
+        metadata = {}
+        if ttl is not None:
+            metadata[LEASE_EXPIRES] = str(expires)
+        if holder is not None:
+            metadata[LEASE_HOLDER] = str(holder)
+        # The body makes the ETag of each lease that expires unique
+        body = ''
+        if ttl is not None:
+            body = json.dumps({'holder': holder,
+                               'expires': metadata[LEASE_EXPIRES],
+                               'lease': uuid.uuid4().hex})
+
+        for _ in range(2):
+            try:
+                self.client.put_object(Bucket=self.bucket,
+                                       Key=self.lock_key(lock),
+                                       Body=body.encode('utf-8'),
+                                       Metadata=metadata, IfNoneMatch='*')
+                return True
+            except ClientError as exc:
+                if not (clienterror.is_precondition_failed(exc) or
+                        clienterror.is_conditional_conflict(exc)):
+                    raise LockException("Can't acquire lock {}: {}"
+                                        .format(self.lock_path(lock), exc))
+            if not self.break_lease(lock):
+                return False
+        return False
+
+    def release(self, lock):
+        """Release a lock acquired as a lease"""
+
+        self.unset(lock)
+
+    def break_lease(self, lock):
+        """Delete lock if it is an expired lease.
+
+        Return True if lock is now unset.  The delete is conditional on
+        the lease being unchanged, so a lease just acquired by another
+        waiter is never broken.
+        """
+
+        response = self.head(lock)
+        if response is None:
+            return True
+        if not lease_expired(response):
+            return False
+        try:
+            self.client.delete_object(Bucket=self.bucket,
+                                      Key=self.lock_key(lock),
+                                      IfMatch=response['ETag'])
+        except ClientError as exc:
+            if (clienterror.is_precondition_failed(exc) or
+                    clienterror.is_conditional_conflict(exc)):
+                return False
+            raise LockException("Can't break lease {}: {}"
+                                .format(self.lock_path(lock), exc))
+        return True
 
     def wait_for_set(self, lock, interval=15, bound=None):
         """Wait for lock to be set"""
 
         self.validate_lock(lock)
-        attempts = (parse_bound(bound) // interval) + 1
-        s3.wait_for_object(self.lock_path(lock), client=self.client,
-                           interval=interval, attempts=attempts)
+        self.wait_for_all([lock], True, interval, bound)
 
     def wait_for_unset(self, lock, interval=15, bound=None):
         """Wait for lock to be unset"""
 
         self.validate_lock(lock)
-        attempts = (parse_bound(bound) // interval) + 1
-        s3.wait_for_no_object(self.lock_path(lock), client=self.client,
-                              interval=interval, attempts=attempts)
+        self.wait_for_all([lock], False, interval, bound)
+
+    def wait_for_all(self, locks=None, value=True, interval=15, bound=None):
+        """Wait for every lock in locks to be set (or unset if value=False)
+
+        Locks default to the lock set.  Return the state of the lock
+        set once the condition holds.
+        """
+
+        return self.wait_for(locks, value, interval, bound, any_lock=False)
+
+    def wait_for_any(self, locks=None, value=True, interval=15, bound=None):
+        """Wait for some lock in locks to be set (or unset if value=False)
+
+        Locks default to the lock set.  Return the state of the lock
+        set once the condition holds.
+        """
+
+        return self.wait_for(locks, value, interval, bound, any_lock=True)
+
+    def wait_for(self, locks, value, interval, bound, any_lock):
+        """Wait for all or any of the locks to have the value value.
+
+        Poll the state of the lock set, backing off from
+        s3.BACKOFF_INITIAL to interval seconds between polls, for at
+        most bound.
+        """
+        # pylint: disable=too-many-arguments
+
+        locks = locks or self.locks
+        for lock in locks:
+            self.validate_lock(lock)
+
+        deadline = time.time() + parse_bound(bound)
+        delay = min(s3.BACKOFF_INITIAL, interval)
+        while True:
+            state = self.state()
+            done = [lock for lock in locks if state[lock] == value]
+            if done and (any_lock or len(done) == len(locks)):
+                return state
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise LockException("Timed out waiting for locks to be {}: {}"
+                                    .format("set" if value else "unset",
+                                            ', '.join(locks)))
+            time.sleep(min(random.uniform(delay / 2.0, delay), remaining))
+            delay = min(delay * s3.BACKOFF_FACTOR, interval)
+
+def lock_version(lock, obj):
+    """The version of a lock object found by a listing."""
+
+    return (lock, obj.get('ETag'), obj.get('LastModified'))
+
+def lease_expiration(response):
+    """The expiration time of a lease from its head_object response.
+
+    Return None if the lock was set without a ttl.
+    """
+
+    expires = response.get('Metadata', {}).get(LEASE_EXPIRES)
+    return float(expires) if expires else None
+
+def lease_expired(response):
+    """The lease with the given head_object response has expired."""
+
+    expiration = lease_expiration(response)
+    return expiration is not None and expiration <= time.time()
 
 ################################################################
@@ -6,18 +6,21 @@ Parse and validate options from command line arguments and configuration files.
 """
 
 import argparse
+import copy
 import json
 import os
 import time
 import re
 import yaml
 
-import boto3
-
+import clientpool
 import s3
 
 ################################################################
 
+# Buckets and packages are checked once for all the proofs in a run
+EXISTS = {}
+
 def abort(msg):
     """Abort option parsing."""
     raise Exception(msg)
@@ -26,7 +29,11 @@ def abort(msg):
 # The main methods of this module
 
 def batch_options():
-    """Parse options for cbmc-batch"""
+    """Parse options for cbmc-batch
+
+    With --proofs-dir or --proof-list, return the options for the
+    whole run with the options for each proof under the key 'proofs'.
+    """
 
     parser = argparse.ArgumentParser(description='Run CBMC on AWS Batch')
     parser = directory_parser(parser)
@@ -36,16 +43,25 @@ def batch_options():
     parser = cbmcflags_parser(parser)
     parser = build_parser(parser)
     parser = aws_batch_parser(parser)
+    parser = proofs_parser(parser)
     parser = other_parser(parser)
     parser = config_parser(parser)
 
     args = parser.parse_args()
     config = parse_config(args)
 
-    opts = {}
+    if (args.proofs_dir or args.proof_list or
+            config.get('proofs_dir') or config.get('proof_list')):
+        return proofs_merge({}, args, config)
+    return batch_merge({}, args, config)
+
+def batch_merge(opts, args, config):
+    """Merge options for cbmc-batch"""
+
     # Do aws_batch before bucket
     opts = aws_batch_merge(opts, args, config)
     opts = directory_merge(opts, args, config)
+    opts = task_name_merge(opts, args, config)
     opts = bucket_merge(opts, args, config)
     opts = package_merge(opts, args, config)
     opts = phase_merge(opts, args, config)
@@ -61,6 +77,7 @@ def status_options():
     parser = argparse.ArgumentParser(description='Monitor status of CBMC jobs '
                                      'running on AWS Batch.')
     parser = cbmc_status_parser(parser)
+    parser = jobs_file_parser(parser)
     parser = region_parser(parser)
     parser = config_parser(parser)
 
@@ -70,6 +87,7 @@ def status_options():
     opts = {}
     opts = region_merge(opts, args, config)
     opts = cbmc_status_merge(opts, args, config)
+    opts = jobs_file_merge(opts, args, config)
 
     return opts
 
@@ -79,6 +97,7 @@ def kill_options():
     parser = argparse.ArgumentParser(description='Kill CBMC jobs '
                                      'running on AWS Batch.')
     parser = cbmc_status_parser(parser)
+    parser = jobs_file_parser(parser)
     parser = region_parser(parser)
     parser = config_parser(parser)
 
@@ -88,6 +107,7 @@ def kill_options():
     opts = {}
     opts = region_merge(opts, args, config)
     opts = cbmc_status_merge(opts, args, config)
+    opts = jobs_file_merge(opts, args, config)
 
     return opts
 
@@ -127,6 +147,22 @@ def docker_options():
 # parsing and merging into a handful of methods because different
 # commands want different options.
 
+def bucket_exists(bucket, region):
+    """Test for the existence of a bucket, remembering the answer."""
+
+    key = ('bucket', bucket, region)
+    if key not in EXISTS:
+        EXISTS[key] = s3.bucket_exists(bucket, region=region)
+    return EXISTS[key]
+
+def path_exists(path, region):
+    """Test for the existence of an S3 path, remembering the answer."""
+
+    key = ('path', path, region)
+    if key not in EXISTS:
+        EXISTS[key] = s3.path_exists(path, region=region)
+    return EXISTS[key]
+
 def merge(val1, val2, val3):
     """Compute first defined source of options."""
 
@@ -188,6 +224,10 @@ def bucket_parser(parser):
                         help='S3 path to bucket for output directory')
     parser.add_argument('--srctarfile', metavar="OBJ",
                         help='S3 path to tar file for source directory')
+    parser.add_argument('--srctarmember', metavar="PATH", action="append",
+                        help='Path of a file or directory in the source tar '
+                        'file to extract (default: extract everything); '
+                        'may be repeated')
     return parser
 
 def bucket_merge(opts, args, config):
@@ -201,6 +241,8 @@ def bucket_merge(opts, args, config):
     opts['outbucket'] = (args.outbucket or config.get('outbucket', None) or
                          "{}/{}/out".format(opts['bucket'], opts['jobname']))
     opts['srctarfile'] = args.srctarfile or config.get('srctarfile', None)
+    opts['srctarmembers'] = (args.srctarmember or
+                             config.get('srctarmembers', None))
 
     if not s3.is_path(opts['srcbucket']):
         abort("Not a valid S3 bucket or object: {}"
@@ -213,13 +255,13 @@ def bucket_merge(opts, args, config):
               .format(opts['outbucket']))
 
     bkt = s3.bucket_name(opts['srcbucket'])
-    if not s3.bucket_exists(bkt, region=opts['region']):
+    if not bucket_exists(bkt, opts['region']):
         abort("Bucket does not exist: {}".format(bkt))
     bkt = s3.bucket_name(opts['wsbucket'])
-    if not s3.bucket_exists(bkt, region=opts['region']):
+    if not bucket_exists(bkt, opts['region']):
         abort("Bucket does not exist: {}".format(bkt))
     bkt = s3.bucket_name(opts['outbucket'])
-    if not s3.bucket_exists(bkt, region=opts['region']):
+    if not bucket_exists(bkt, opts['region']):
         abort("Bucket does not exist: {}".format(bkt))
 
     opts['srcbucket'] = s3.path_url(opts['srcbucket'])
@@ -256,7 +298,7 @@ def package_merge(opts, args, config):
               .format(opts['pkgbucket']))
 
     bkt = s3.bucket_name(opts['pkgbucket'])
-    if not s3.bucket_exists(bkt, region=opts['region']):
+    if not bucket_exists(bkt, opts['region']):
         abort("Bucket does not exist: {}".format(bkt))
     opts['pkgbucket'] = s3.path_url(opts['pkgbucket'])
 
@@ -275,13 +317,13 @@ def package_merge(opts, args, config):
         opts['viewerpkg'] += ".tar.gz"
 
     path = '{}/{}'.format(opts['pkgbucket'], opts['cbmcpkg'])
-    if not s3.path_exists(path, region=opts['region']):
+    if not path_exists(path, opts['region']):
         abort("S3 package not found: {}".format(path))
     path = '{}/{}'.format(opts['pkgbucket'], opts['batchpkg'])
-    if not s3.path_exists(path, region=opts['region']):
+    if not path_exists(path, opts['region']):
         abort("S3 package not found: {}".format(path))
     path = '{}/{}'.format(opts['pkgbucket'], opts['viewerpkg'])
-    if not s3.path_exists(path, region=opts['region']):
+    if not path_exists(path, opts['region']):
         abort("S3 package not found: {}".format(path))
 
     return opts
@@ -397,28 +439,68 @@ def aws_batch_parser(parser):
     parser.add_argument('--report-memory', metavar='MB',
                         dest='report_memory',
                         help="Memory in MB for the CBMC report phase")
+    parser.add_argument('--fused-memory', metavar='MB',
+                        dest='fused_memory',
+                        help="Memory in MB for all CBMC phases in a single "
+                        "job (default: enough for property and coverage "
+                        "together)")
+    parser.add_argument('--auto-memory', dest='auto_memory', default=None,
+                        action="store_true",
+                        help="Size the memory for each phase from the "
+                        "memory used by past runs of the proof")
+    parser.add_argument('--memory-percentile', metavar='PCT',
+                        dest='memory_percentile',
+                        help="Percentile of past peak memory used by "
+                        "--auto-memory (default: 95)")
+    parser.add_argument('--memory-headroom', metavar='FACTOR',
+                        dest='memory_headroom',
+                        help="Factor scaling past peak memory used by "
+                        "--auto-memory (default: 1.25)")
 
     region_parser(parser)
 
     return parser
 
-def job_name_merge(opts, args, config):
-    """Merge AWS Batch job name options"""
+def timestamp():
+    """Generate a printable timestamp for job names"""
 
-    def timestamp():
-        """Generate a printable timestamp for job names"""
+    gmt = time.gmtime()
+    return ("{:04d}{:02d}{:02d}-{:02d}{:02d}{:02d}"
+            .format(gmt.tm_year, gmt.tm_mon, gmt.tm_mday,
+                    gmt.tm_hour, gmt.tm_min, gmt.tm_sec))
 
-        gmt = time.gmtime()
-        return ("{:04d}{:02d}{:02d}-{:02d}{:02d}{:02d}"
-                .format(gmt.tm_year, gmt.tm_mon, gmt.tm_mday,
-                        gmt.tm_hour, gmt.tm_min, gmt.tm_sec))
+def job_name_merge(opts, args, config):
+    """Merge AWS Batch job name options"""
 
     opts['jobprefix'] = (args.jobprefix or config.get('jobprefix', None) or
                          'cbmc')
     opts['jobname'] = (args.jobname or config.get('jobname', None) or
                        '{}-{}'.format(opts['jobprefix'], timestamp()))
     opts['taskname'] = (args.taskname or config.get('taskname') or
-                        opts['jobname'])
+                        task_name(opts['jobname']))
+    return opts
+
+def task_name(jobname):
+    """The default task name of a job: its job name without a timestamp.
+
+    Runs of the same proof share a task name, and so share the history
+    of the resources used by past runs.
+    """
+
+    return re.sub(r'-?[0-9]{8}-[0-9]{6}$', '', jobname) or jobname
+
+def task_name_merge(opts, args, config):
+    """Merge the default task name of a job given no job name
+
+    The default job name is the job prefix and a timestamp, so the
+    default task name is the job prefix and the name of the workspace
+    directory of the proof.
+    """
+
+    if not (args.taskname or config.get('taskname') or
+            args.jobname or config.get('jobname')):
+        opts['taskname'] = '{}-{}'.format(
+            opts['jobprefix'], os.path.basename(opts['wsdir'].rstrip('/')))
     return opts
 
 def job_definition_merge(opts, args, config):
@@ -458,7 +540,7 @@ def job_queue_merge(opts, args, config):
 def region_merge(opts, args, config):
     """Merge AWS region options"""
 
-    default_region = boto3.session.Session().region_name
+    default_region = clientpool.session().region_name
     if default_region is None:
         default_region = 'us-east-1'
     opts['region'] = merge(args.region, config.get('region'), default_region)
@@ -484,6 +566,26 @@ def aws_batch_merge(opts, args, config):
     opts['report_memory'] = int(merge(args.report_memory,
                                       config.get('report_memory'),
                                       8000))
+    # The default memory for fused jobs is computed by CBMC.phase_job
+    opts['fused_memory'] = merge(args.fused_memory,
+                                 config.get('fused_memory'), None)
+    if opts['fused_memory'] is not None:
+        opts['fused_memory'] = int(opts['fused_memory'])
+
+    opts['auto_memory'] = merge(args.auto_memory,
+                                config.get('auto_memory'), False)
+    opts['memory_percentile'] = float(merge(args.memory_percentile,
+                                            config.get('memory_percentile'),
+                                            95))
+    opts['memory_headroom'] = float(merge(args.memory_headroom,
+                                          config.get('memory_headroom'),
+                                          1.25))
+    if not 0 < opts['memory_percentile'] <= 100:
+        abort("Memory percentile must be between 0 and 100: {}"
+              .format(opts['memory_percentile']))
+    if opts['memory_headroom'] < 1:
+        abort("Memory headroom must be at least 1: {}"
+              .format(opts['memory_headroom']))
 
     opts = region_merge(opts, args, config)
 
@@ -516,6 +618,11 @@ def cbmc_status_parser(parser):
                         help='Monitor job status continuously until done')
     parser.add_argument('--jobid', metavar="ID",
                         help='AWS Batch job id')
+    parser.add_argument('--prefix', default=False, action="store_true",
+                        help='Match --jobname as a prefix of job names '
+                        '(default: search job names for --jobname); '
+                        'a literal prefix is looked up on the server, '
+                        'which is faster on a long job queue')
     job_name_parser(parser)
     job_queue_parser(parser)
     return parser
@@ -525,10 +632,26 @@ def cbmc_status_merge(opts, args, config):
 
     opts['monitor'] = merge(args.monitor, config.get('monitor', None), False)
     opts['jobid'] = args.jobid or config.get('jobid', None)
+    opts['prefix'] = merge(args.prefix, config.get('prefix', None), False)
     opts = job_name_merge(opts, args, config)
     opts = job_queue_merge(opts, args, config)
     return opts
 
+def jobs_file_parser(parser):
+    """Parse options giving files listing jobs"""
+
+    parser.add_argument('--jobs', metavar="FILE", action="append",
+                        help='JSON file of jobs, such as the '
+                        'JSON job options written by cbmc-batch '
+                        '(may be repeated)')
+    return parser
+
+def jobs_file_merge(opts, args, config):
+    """Merge options giving files listing jobs"""
+
+    opts['jobs'] = args.jobs or config.get('jobs', None)
+    return opts
+
 ################
 # Options specific to the docker script run in the container
 # Options should be renamed from dobuild to dockerbuild, etc.
@@ -544,6 +667,17 @@ def container_parser(parser):
                         help='Do the CBMC coverage phase')
     parser.add_argument('--doreport', action="store_true", default=None,
                         help='Do the CBMC report phase')
+    parser.add_argument('--dofused', action="store_true", default=None,
+                        help='Do all CBMC phases')
+    parser.add_argument('--doshard', action="store_true", default=None,
+                        help='Do one shard of the CBMC property phase')
+    parser.add_argument('--domerge', action="store_true", default=None,
+                        help='Merge the shards of the CBMC property phase')
+    parser.add_argument('--shard', metavar="INDEX", type=int,
+                        help='The shard of the CBMC property phase to do')
+    parser.add_argument('--manifest', metavar="OBJ",
+                        help='S3 path to the manifest of proofs for an '
+                        'array job')
 
     return parser
 
@@ -563,10 +697,22 @@ def container_merge(opts, args, config):
     opts['docoverage'] = merge(args.docoverage,
                                config.get('docoverage', None), False)
     opts['doreport'] = merge(args.doreport, config.get('doreport', None), False)
+    opts['dofused'] = merge(args.dofused, config.get('dofused', None), False)
+    opts['doshard'] = merge(args.doshard, config.get('doshard', None), False)
+    opts['domerge'] = merge(args.domerge, config.get('domerge', None), False)
+    opts['shard'] = merge(args.shard, config.get('shard', None), None)
+    opts['property_shards'] = config.get('property_shards', None) or 1
+    opts['portfolio'] = config.get('portfolio', None) or []
+    opts['vcpus'] = config.get('vcpus', None)
+    opts['manifest'] = args.manifest or config.get('manifest', None)
 
     if more_than_one_set([opts['dobuild'], opts['doproperty'],
-                          opts['docoverage'], opts['doreport']]):
+                          opts['docoverage'], opts['doreport'],
+                          opts['dofused'], opts['doshard'],
+                          opts['domerge']]):
         abort("Too many commands passed to docker container.")
+    if opts['doshard'] and opts['shard'] is None:
+        abort("No shard given for the CBMC property phase.")
 
     return opts
 
@@ -599,6 +745,40 @@ def phase_parser(parser):
     parser.add_argument('--no-report', dest='report', default=None,
                         action="store_false",
                         help="Don't the CBMC report phase")
+    parser.add_argument('--fused', dest='fused', default=None,
+                        action="store_true",
+                        help='Do all CBMC phases in a single job')
+    parser.add_argument('--no-fused', dest='fused', default=None,
+                        action="store_false",
+                        help="Don't do all CBMC phases in a single job")
+    parser.add_argument('--fused-threshold', metavar='SECONDS',
+                        dest='fused_threshold',
+                        help='Do all CBMC phases in a single job if past '
+                        'runs of the proof took less than SECONDS '
+                        '(unless --fused or --no-fused is given)')
+    parser.add_argument('--property-shards', metavar='N', type=int,
+                        dest='property_shards',
+                        help='Split the CBMC property phase into N jobs '
+                        'checking disjoint sets of properties, and merge '
+                        'their results (default: 1)')
+    parser.add_argument('--portfolio', metavar='FLAGS', action="append",
+                        help='Race the CBMC property check with the solver '
+                        'given by these extra CBMC flags against the other '
+                        'solvers in the portfolio, keeping the first to '
+                        'finish; may be repeated, written as '
+                        '--portfolio="--external-sat-solver kissat", and '
+                        '"default" is the default solver')
+    parser.add_argument('--vcpus', metavar='N', type=int,
+                        help='vCPUs for the jobs checking properties; the '
+                        'portfolio races at most N solvers at once '
+                        '(default: the vCPUs of the job definition)')
+    parser.add_argument('--result-cache', dest='result_cache', default=None,
+                        action="store_true",
+                        help='Reuse CBMC results for an unchanged goto '
+                        'program and CBMC flags (default)')
+    parser.add_argument('--no-result-cache', dest='result_cache',
+                        default=None, action="store_false",
+                        help="Always run CBMC")
 
     parser.add_argument('--copysrc', dest='copysrc', default=None,
                         action="store_true",
@@ -628,6 +808,24 @@ def phase_merge(opts, args, config):
     opts['property'] = merge(args.property, config.get('property', None), True)
     opts['coverage'] = merge(args.coverage, config.get('coverage', None), True)
     opts['report'] = merge(args.report, config.get('report', None), True)
+    opts['fused'] = merge(args.fused, config.get('fused', None), None)
+    opts['result_cache'] = merge(args.result_cache,
+                                 config.get('result_cache', None), True)
+    opts['fused_threshold'] = float(merge(args.fused_threshold,
+                                          config.get('fused_threshold', None),
+                                          0))
+    opts['portfolio'] = args.portfolio or config.get('portfolio', None) or []
+    opts['vcpus'] = merge(args.vcpus, config.get('vcpus', None), None)
+    if opts['vcpus'] is not None and opts['vcpus'] < 1:
+        abort("The number of vCPUs must be at least 1: {}"
+              .format(opts['vcpus']))
+    opts['property_shards'] = merge(args.property_shards,
+                                    config.get('property_shards', None), 1)
+    # The merge job depends on every shard, and Batch jobs depend on at
+    # most 20 jobs
+    if not 1 <= opts['property_shards'] <= 20:
+        abort("The number of property shards must be between 1 and 20: {}"
+              .format(opts['property_shards']))
     opts['copysrc'] = merge(args.copysrc, config.get('copysrc', None),
                             opts['build'] or opts['report'])
     opts['copyws'] = merge(args.copyws, config.get('copyws', None), True)
@@ -637,6 +835,147 @@ def phase_merge(opts, args, config):
 
 ################################################################
 
+################
+# Options to run many proofs at once
+
+# The file in a proof directory giving the options for the proof
+PROOF_YAML = 'cbmc-batch.yaml'
+
+def proofs_parser(parser):
+    """Parse options for running many proofs at once"""
+
+    parser.add_argument('--proofs-dir', metavar="DIR", dest='proofs_dir',
+                        help='Run every proof under DIR (every directory '
+                        'containing a {})'.format(PROOF_YAML))
+    parser.add_argument('--proof-list', metavar="FILE", dest='proof_list',
+                        help='Run every proof directory listed in FILE '
+                        '(one per line)')
+    parser.add_argument('--array', action="store_true", default=None,
+                        help='Submit the proofs as one array job per phase')
+    parser.add_argument('--workers', metavar="N", type=int,
+                        help='Number of proof directories to upload '
+                        'concurrently')
+    return parser
+
+def find_proofs(topdir):
+    """Find the proof directories under topdir."""
+
+    return sorted(path for path, _, files in os.walk(topdir)
+                  if PROOF_YAML in files)
+
+def read_proof_list(filename):
+    """Read the proof directories listed in a file.
+
+    Relative paths are relative to the directory containing the file.
+    Blank lines and lines starting with '#' are ignored.
+    """
+
+    topdir = os.path.dirname(os.path.abspath(filename))
+    with open(filename) as handle:
+        lines = [line.strip() for line in handle]
+    return [os.path.join(topdir, line) for line in lines
+            if line and not line.startswith('#')]
+
+def proof_paths(config, proofdir):
+    """Make the directories in the config file of a proof absolute.
+
+    Relative directories are relative to the proof directory.
+    """
+
+    config = dict(config)
+    for key in ['srcdir', 'outdir', 'blddir']:
+        if config.get(key) and not os.path.isabs(config[key]):
+            config[key] = os.path.normpath(os.path.join(proofdir,
+                                                        config[key]))
+    return config
+
+def proof_taskname(proofdir, topdir):
+    """The task name of a proof: its path under topdir with '/' as '-'."""
+
+    path = os.path.relpath(proofdir, topdir)
+    if path == os.curdir or path.startswith(os.pardir):
+        path = os.path.basename(os.path.abspath(proofdir))
+    return path.replace(os.path.sep, '-')
+
+def proofs_merge(opts, args, config):
+    """Merge options for running many proofs at once
+
+    Each proof is run with the options given on the command line and
+    in the configuration file, overridden by the options in the
+    proof's own cbmc-batch.yaml file.  Directories in that file are
+    relative to the proof directory.  The workspace of a proof is its proof
+    directory, and its job name is its task name followed by a
+    timestamp.  Proofs with the same source directory share one copy
+    of the source directory in the bucket.
+    """
+
+    stamp = timestamp()
+    jobprefix = args.jobprefix or config.get('jobprefix', None) or 'cbmc'
+    opts['jobname'] = (args.jobname or config.get('jobname', None) or
+                       '{}-{}'.format(jobprefix, stamp))
+    opts['array'] = merge(args.array, config.get('array', None), False)
+    opts['workers'] = merge(args.workers, config.get('workers', None), 8)
+    opts['proofs_dir'] = args.proofs_dir or config.get('proofs_dir', None)
+    opts['proof_list'] = args.proof_list or config.get('proof_list', None)
+
+    proofdirs = []
+    if opts['proofs_dir']:
+        opts['proofs_dir'] = os.path.abspath(opts['proofs_dir'])
+        proofdirs += [(path, opts['proofs_dir'])
+                      for path in find_proofs(opts['proofs_dir'])]
+    if opts['proof_list']:
+        opts['proof_list'] = os.path.abspath(opts['proof_list'])
+        topdir = os.path.dirname(opts['proof_list'])
+        proofdirs += [(path, topdir)
+                      for path in read_proof_list(opts['proof_list'])]
+    if not proofdirs:
+        abort("No proofs found")
+
+    srcbuckets = {}
+    tasknames = set()
+    opts['proofs'] = []
+    for proofdir, topdir in proofdirs:
+        taskname = proof_taskname(proofdir, topdir)
+        if taskname in tasknames:
+            abort("Two proofs have the task name {}".format(taskname))
+        tasknames.add(taskname)
+
+        proof_config = dict((key, val) for key, val in config.items()
+                            if key not in ['proofs', 'tasks'])
+        proof_yaml = os.path.join(proofdir, PROOF_YAML)
+        proof_config.update(proof_paths(parse_yaml_config(proof_yaml) or {},
+                                        proofdir))
+        proof_config['jobname'] = '{}-{}'.format(taskname, stamp)
+        proof_config['taskname'] = taskname
+
+        proof_args = copy.copy(args)
+        proof_args.jobname = None
+        proof_args.taskname = None
+        proof_args.wsdir = proofdir
+
+        srcdir = args.srcdir or proof_config.get('srcdir')
+        if srcdir and not (args.srcbucket or proof_config.get('srcbucket')):
+            srcdir = os.path.abspath(srcdir)
+            if srcdir not in srcbuckets:
+                bucket = (args.bucket or proof_config.get('bucket', None) or
+                          'cbmc')
+                suffix = '-{}'.format(len(srcbuckets)) if srcbuckets else ''
+                srcbuckets[srcdir] = "{}/{}/src{}".format(
+                    bucket, opts['jobname'], suffix)
+            proof_config['srcbucket'] = srcbuckets[srcdir]
+
+        opts['proofs'].append(batch_merge({}, proof_args, proof_config))
+
+    first = opts['proofs'][0]
+    for key in ['bucket', 'region', 'jobqueue', 'auto_memory',
+                'no-file-output']:
+        opts[key] = first[key]
+
+    return opts
+
+################
+# Other options
+
 def other_parser(parser):
     """Parse other miscellaneous options"""
 
@@ -674,7 +1013,7 @@ def parse_yaml_config(config):
     """Parse command line arguments from a YAML config file."""
 
     with open(config, 'r') as fptr:
-        return cleanup_config(yaml.load(fptr))
+        return cleanup_config(yaml.safe_load(fptr))
 
 def parse_json_config(config):
     """Parse command line arguments from a JSON config file."""
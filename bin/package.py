@@ -1,33 +1,61 @@
 # Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: Apache-2.0
 
-"""Copy and install packages from S3 into a docker container"""
+"""Copy and install packages from S3 into a docker container
 
-import sys
-import subprocess
+A package already installed in the image is not installed again if
+it is the version in S3 (the installed package has the same ETag).
+When CBMC_PACKAGE_CACHE names a directory shared by the containers on
+a host (a volume mounted from the host), each package is unpacked into
+the cache once, keyed by its name and S3 ETag, and the container links
+to the unpacked package in the cache.
+"""
+
+import fcntl
+import json
 import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from concurrent import futures
+
+import s3
+
+# The directory caching unpacked packages (None for no cache)
+PACKAGE_CACHE = os.environ.get('CBMC_PACKAGE_CACHE')
+
+# The file in an installed package naming the package installed
+PACKAGE_MARKER = '.cbmc-package.json'
 
 def abort(msg):
     """Abort package installation or launch"""
     raise RuntimeError(msg)
 
-def copy(pkg, bkt, tar):
-    """Copy package pkg from bucket bkt in file tar"""
-    cmd = ['aws', 's3', 'cp', '{}/{}'.format(bkt, tar), tar]
-    cmds = " ".join(cmd)
-    print("Copying package {} with '{}'".format(pkg, cmds))
+def copy(pkg, bkt, tar, filename=None, region=None):
+    """Copy package pkg from bucket bkt in file tar (or filename)"""
+    path = '{}/{}'.format(bkt, tar)
+    filename = filename or tar
+    print("Copying package {} from {} to {}".format(pkg, path, filename))
     sys.stdout.flush()
     try:
-        subprocess.check_call(cmd)
-    except Exception as exc:
-        print("Error copying package {} with '{}' ({})"
-              .format(pkg, cmds, exc))
+        s3.copy_object_to_file(path, filename, region=region)
+    except s3.S3Exception as exc:
+        print("Error copying package {} from {} ({})"
+              .format(pkg, path, exc))
         sys.stdout.flush()
         raise exc
 
-def install(pkg, tar, bindir):
-    """Intall package pkg from file tar into directory bindir"""
+def install(pkg, tar, bindir, directory=None):
+    """Intall package pkg from file tar into directory bindir
+
+    The package is unpacked in directory (default: the current directory)
+    and bindir is a path relative to the current directory.
+    """
     cmd = ['tar', 'fx', tar]
+    if directory:
+        cmd += ['-C', directory]
     cmds = " ".join(cmd)
     print("Installing package {} with '{}'".format(pkg, cmds))
     sys.stdout.flush()
@@ -60,3 +88,152 @@ def launch(bindir, script, options):
         raise exc
 
 ################################################################
+# Package markers
+#
+# An image built with a package can include the marker naming the
+# package file and its S3 ETag in the package directory to skip
+# installing that version of the package.
+
+def read_marker(bindir):
+    """The marker of the package installed in bindir (None if none)"""
+    try:
+        with open(os.path.join(bindir, PACKAGE_MARKER)) as handle:
+            marker = json.load(handle)
+    except (IOError, OSError, ValueError):
+        return None
+    return marker if isinstance(marker, dict) else None
+
+def write_marker(bindir, tar, etag=None):
+    """Mark bindir as holding the package in file tar"""
+    with open(os.path.join(bindir, PACKAGE_MARKER), 'w') as handle:
+        json.dump({'package': os.path.basename(tar), 'etag': etag}, handle)
+
+def is_installed(tar, bindir, etag):
+    """The package in file tar with ETag etag is installed in bindir"""
+    marker = read_marker(bindir)
+    return (marker is not None and
+            marker.get('package') == os.path.basename(tar) and
+            marker.get('etag') is not None and marker.get('etag') == etag)
+
+################################################################
+# Package cache
+#
+# A cache entry is created by unpacking the package into a temporary
+# directory in the cache and renaming it into place, so an entry is
+# either complete or missing.  Containers creating the same entry
+# serialize on a lock file next to the entry, and the containers
+# waiting for the lock find the entry complete when they get it.
+
+def cache_entry(cache, tar, etag):
+    """The directory in the cache holding the package in file tar"""
+    return os.path.join(cache, '{}-{}'.format(os.path.basename(tar), etag))
+
+def verify(pkg, filename, head):
+    """Check a downloaded package against the object metadata from S3
+
+    Only the ETag of an object uploaded in one part is the MD5 of its
+    content, so packages uploaded in several parts are checked by size.
+    """
+    etag = head['ETag'].strip('"')
+    if '-' in etag:
+        if os.path.getsize(filename) != head['ContentLength']:
+            abort("Size of package {} does not match {} bytes"
+                  .format(pkg, head['ContentLength']))
+    elif not s3.etag_matches(filename, etag):
+        abort("Checksum of package {} does not match ETag {}"
+              .format(pkg, etag))
+
+def fill_entry(pkg, bkt, tar, bindir, entry, head, region=None):
+    """Download and unpack package pkg into the cache entry"""
+    # pylint: disable=too-many-arguments
+
+    tmpdir = tempfile.mkdtemp(prefix='.tmp-', dir=os.path.dirname(entry))
+    try:
+        filename = os.path.join(tmpdir, os.path.basename(tar))
+        copy(pkg, bkt, tar, filename, region)
+        verify(pkg, filename, head)
+        tree = os.path.join(tmpdir, 'tree')
+        os.mkdir(tree)
+        install(pkg, filename, os.path.join(tree, bindir), tree)
+        write_marker(os.path.join(tree, bindir), tar, head['ETag'].strip('"'))
+        os.rename(tree, entry)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+def cache_install(pkg, bkt, tar, bindir, cache, head, region=None):
+    """Install package pkg into the cache and return its bindir in the cache
+
+    The head is the metadata of the package object in S3.
+    """
+    # pylint: disable=too-many-arguments
+
+    entry = cache_entry(cache, tar, head['ETag'].strip('"'))
+
+    if os.path.isdir(entry):
+        print("Using package {} cached in {}".format(pkg, entry))
+        sys.stdout.flush()
+        return os.path.join(entry, bindir)
+
+    try:
+        os.makedirs(cache)
+    except OSError:
+        if not os.path.isdir(cache):
+            raise
+    with open(entry + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if not os.path.isdir(entry):
+                fill_entry(pkg, bkt, tar, bindir, entry, head, region)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return os.path.join(entry, bindir)
+
+def link(source, bindir):
+    """Replace bindir with a symbolic link to directory source"""
+    if os.path.islink(bindir) or os.path.isfile(bindir):
+        os.remove(bindir)
+    elif os.path.isdir(bindir):
+        shutil.rmtree(bindir)
+    os.symlink(source, bindir)
+
+################################################################
+
+def install_package(pkg, bkt, tar, bindir, region=None, cache=PACKAGE_CACHE):
+    """Install package pkg from file tar in bucket bkt into directory bindir
+
+    The package is skipped if bindir already holds the version in S3.
+    With a cache directory, bindir is a link to the package unpacked
+    in the cache.
+    """
+    # pylint: disable=too-many-arguments
+
+    head = s3.object_head('{}/{}'.format(bkt, tar), region=region)
+    if head is None:
+        abort("Package {} not found at {}/{}".format(pkg, bkt, tar))
+    etag = head['ETag'].strip('"')
+    if is_installed(tar, bindir, etag):
+        print("Package {} is already installed in {}".format(pkg, bindir))
+        sys.stdout.flush()
+        return
+    if cache:
+        link(cache_install(pkg, bkt, tar, bindir, cache, head, region),
+             bindir)
+        return
+    copy(pkg, bkt, tar, region=region)
+    install(pkg, tar, bindir)
+    write_marker(bindir, tar, etag)
+
+def install_packages(packages, region=None, cache=PACKAGE_CACHE):
+    """Install independent packages concurrently
+
+    Each package is a tuple (pkg, bkt, tar, bindir) of arguments to
+    install_package.
+    """
+    with futures.ThreadPoolExecutor(max_workers=len(packages)) as pool:
+        installs = [pool.submit(install_package, *package,
+                                region=region, cache=cache)
+                    for package in packages]
+    for result in installs:
+        result.result()
+
+################################################################
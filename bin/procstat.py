@@ -0,0 +1,406 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+"""Sample the resources used by the process tree of a running command.
+
+The sampler reads /proc for the command and all of its descendants
+(make, goto-cc, cbmc, the solver) without forking, and keeps recent
+samples in a ring buffer.  Metrics derived from the samples are
+buffered and published to CloudWatch in batches, either with
+put_metric_data or as CloudWatch Embedded Metric Format log lines.
+The memory watchdog reads the memory cgroup of the container to warn
+before the container runs out of memory.
+"""
+
+import collections
+import datetime
+import json
+import os
+import sys
+import time
+
+import clientpool
+
+################################################################
+
+PROC = '/proc'
+CGROUP = '/sys/fs/cgroup'
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+# The number of recent samples kept in the ring buffer
+RING_SIZE = 360
+
+# CloudWatch accepts at most METRIC_BATCH datums per put_metric_data
+METRIC_BATCH = 1000
+
+# Buffered metrics are published at least every FLUSH_INTERVAL seconds
+FLUSH_INTERVAL = 60
+
+# Publish metrics with put_metric_data ('api') or as log lines ('emf')
+METRICS_MODE = os.environ.get('CBMC_BATCH_METRICS', 'api')
+
+NAMESPACE = 'CBMC-Batch'
+
+# The watchdog reports exhaustion when the memory in use reaches this
+# fraction of the memory limit
+MEMORY_FRACTION = 0.95
+
+MB = 1024.0 * 1024.0
+
+################################################################
+# Reading /proc
+
+def read_file(path):
+    """The content of a file in /proc (None if the process is gone)."""
+
+    try:
+        with open(path) as handle:
+            return handle.read()
+    except (IOError, OSError):
+        return None
+
+def proc_stat(pid):
+    """The parent, start time, and CPU ticks of a process (None if gone)."""
+
+    data = read_file(os.path.join(PROC, str(pid), 'stat'))
+    if data is None:
+        return None
+    # The command name in parentheses may contain spaces: field N of
+    # proc(5) is entry N-3 of the fields after the closing parenthesis
+    fields = data.rsplit(')', 1)[-1].split()
+    try:
+        return {'ppid': int(fields[1]),
+                'start': int(fields[19]),
+                'ticks': int(fields[11]) + int(fields[12])}
+    except (IndexError, ValueError):
+        return None
+
+def proc_status(pid):
+    """The current and peak resident memory in KB of a process."""
+
+    data = read_file(os.path.join(PROC, str(pid), 'status')) or ''
+    memory = {'VmRSS': 0, 'VmHWM': 0}
+    for line in data.splitlines():
+        key, _, value = line.partition(':')
+        if key in memory:
+            memory[key] = int(value.split()[0])
+    return memory
+
+def proc_io(pid):
+    """The bytes read and written by a process (zero if unreadable)."""
+
+    data = read_file(os.path.join(PROC, str(pid), 'io')) or ''
+    io = {'read_bytes': 0, 'write_bytes': 0}
+    for line in data.splitlines():
+        key, _, value = line.partition(':')
+        if key in io:
+            io[key] = int(value)
+    return io
+
+def proc_command(pid):
+    """The command line of a process."""
+
+    data = read_file(os.path.join(PROC, str(pid), 'cmdline')) or ''
+    return ' '.join(data.split('\0')).strip()
+
+def memory_total_kb():
+    """The total memory of the machine in KB."""
+
+    data = read_file(os.path.join(PROC, 'meminfo')) or ''
+    for line in data.splitlines():
+        if line.startswith('MemTotal:'):
+            return int(line.split()[1])
+    return None
+
+def process_tree(pid):
+    """The status of a process and all of its descendants, keyed by pid."""
+
+    stats = {}
+    for name in os.listdir(PROC):
+        if name.isdigit():
+            stat = proc_stat(int(name))
+            if stat is not None:
+                stats[int(name)] = stat
+
+    children = collections.defaultdict(list)
+    for child, stat in stats.items():
+        children[stat['ppid']].append(child)
+
+    tree = {}
+    pending = [pid] if pid in stats else []
+    while pending:
+        parent = pending.pop()
+        tree[parent] = stats[parent]
+        pending += children[parent]
+    return tree
+
+def cgroup_memory():
+    """The memory used and the memory limit in bytes of the container.
+
+    The memory used does not count inactive file pages, which the
+    kernel reclaims before running out of memory.  Both cgroup v2 and
+    cgroup v1 are supported.  The limit is None if the container has
+    no memory cgroup.
+    """
+
+    v2 = {'usage': 'memory.current', 'limit': 'memory.max',
+          'stat': 'memory.stat', 'inactive': ['inactive_file']}
+    v1 = {'usage': 'memory/memory.usage_in_bytes',
+          'limit': 'memory/memory.limit_in_bytes',
+          'stat': 'memory/memory.stat',
+          'inactive': ['total_inactive_file', 'inactive_file']}
+    for files in [v2, v1]:
+        usage = read_file(os.path.join(CGROUP, files['usage']))
+        limit = read_file(os.path.join(CGROUP, files['limit']))
+        if usage is None or limit is None:
+            continue
+        stat = dict(line.split()[:2] for line in
+                    (read_file(os.path.join(CGROUP, files['stat'])) or '')
+                    .splitlines() if len(line.split()) >= 2)
+        inactive = next((int(stat[key]) for key in files['inactive']
+                         if key in stat), 0)
+        limit = limit.strip()
+        return {'usage': max(int(usage) - inactive, 0),
+                'limit': None if limit == 'max' else int(limit)}
+    return {'usage': None, 'limit': None}
+
+class MemoryWatchdog(object):
+    """A watchdog for the memory used by the container.
+
+    The limit is the memory limit of the container, or the memory of
+    the machine if that is smaller.
+    """
+
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, fraction=MEMORY_FRACTION):
+        self.fraction = fraction
+        limits = [cgroup_memory()['limit']]
+        total_kb = memory_total_kb()
+        if total_kb:
+            limits.append(total_kb * 1024)
+        limits = [limit for limit in limits if limit]
+        self.limit = min(limits) if limits else None
+
+    def check(self):
+        """The memory used and limit in MB if near exhaustion (else None)."""
+
+        if self.limit is None:
+            return None
+        usage = cgroup_memory()['usage']
+        if usage is None or usage < self.fraction * self.limit:
+            return None
+        return {'usage_mb': round(usage / MB, 1),
+                'limit_mb': round(self.limit / MB, 1),
+                'fraction': self.fraction}
+
+################################################################
+
+class Sampler(object):
+    """Samples of the resources used by the process tree of a command.
+
+    CPU time and I/O are accumulated over every process seen in the
+    tree, so processes that have exited still count, up to their last
+    sample.
+    """
+
+    def __init__(self, pid, size=RING_SIZE):
+        self.pid = pid
+        self.samples = collections.deque(maxlen=size)
+        self.start = time.time()
+        self.memory_kb = memory_total_kb()
+        # Last CPU ticks and I/O of each process seen, keyed by pid and
+        # start time in case pids are reused
+        self.ticks = {}
+        self.io = {}
+        self.count = 0
+        self.peak_rss_kb = 0
+        self.peak_hwm_kb = 0
+        self.processes = []
+
+    def sample(self):
+        """Sample the process tree and add the sample to the buffer."""
+
+        now = time.time()
+        tree = process_tree(self.pid)
+        rss_kb = 0
+        self.processes = []
+        for pid, stat in tree.items():
+            key = (pid, stat['start'])
+            memory = proc_status(pid)
+            self.ticks[key] = max(self.ticks.get(key, 0), stat['ticks'])
+            self.io[key] = proc_io(pid)
+            rss_kb += memory['VmRSS']
+            self.peak_hwm_kb = max(self.peak_hwm_kb, memory['VmHWM'])
+            self.processes.append((pid, memory['VmRSS'], proc_command(pid)))
+        self.peak_rss_kb = max(self.peak_rss_kb, rss_kb)
+
+        cpu_seconds = sum(self.ticks.values()) / float(CLOCK_TICKS)
+        previous = self.samples[-1] if self.samples else None
+        if previous is None:
+            cpu = 0.0
+        else:
+            elapsed = max(now - previous['time'], 1e-3)
+            cpu = 100.0 * (cpu_seconds - previous['cpu_seconds']) / elapsed
+
+        sample = {
+            'time': now,
+            'processes': len(tree),
+            'cpu_percent': round(cpu, 1),
+            'cpu_seconds': cpu_seconds,
+            'rss_mb': rss_kb / 1024.0,
+            'peak_mb': max(self.peak_rss_kb, self.peak_hwm_kb) / 1024.0,
+            'read_mb': sum(io['read_bytes'] for io in self.io.values()) / MB,
+            'write_mb': sum(io['write_bytes'] for io in self.io.values()) / MB
+        }
+        if self.memory_kb:
+            sample['memory_percent'] = round(100.0 * rss_kb / self.memory_kb,
+                                             1)
+        self.samples.append(sample)
+        self.count += 1
+        return sample
+
+    def log(self, logobj, sample):
+        """Write a sample and the processes sampled to a log file."""
+
+        logobj.write("\n{} cpu {:.1f}% rss {:.1f} MB peak {:.1f} MB "
+                     "read {:.1f} MB write {:.1f} MB\n"
+                     .format(timestamp(sample['time']), sample['cpu_percent'],
+                             sample['rss_mb'], sample['peak_mb'],
+                             sample['read_mb'], sample['write_mb']))
+        for pid, rss_kb, command in sorted(self.processes):
+            logobj.write("{:>7} {:>10.1f} MB  {}\n"
+                         .format(pid, rss_kb / 1024.0, command))
+
+    def summary(self, end=None):
+        """A summary of the resources used by the command ending at end."""
+
+        last = self.samples[-1] if self.samples else {}
+        seconds = (end or time.time()) - self.start
+        cpu_seconds = last.get('cpu_seconds', 0.0)
+        return {
+            'seconds': round(seconds, 3),
+            'samples': self.count,
+            'cpu_seconds': round(cpu_seconds, 3),
+            'cpu_percent': round(100.0 * cpu_seconds / max(seconds, 1e-3), 1),
+            'peak_rss_mb': round(self.peak_rss_kb / 1024.0, 1),
+            'peak_hwm_mb': round(self.peak_hwm_kb / 1024.0, 1),
+            'peak_mb': round(max(self.peak_rss_kb, self.peak_hwm_kb) / 1024.0,
+                             1),
+            'read_mb': round(last.get('read_mb', 0.0), 3),
+            'write_mb': round(last.get('write_mb', 0.0), 3),
+        }
+
+def combine(samples):
+    """The sample of several process trees sampled together."""
+
+    combined = {'time': max(sample['time'] for sample in samples)}
+    for key in ['processes', 'cpu_percent', 'cpu_seconds', 'rss_mb',
+                'peak_mb', 'read_mb', 'write_mb', 'memory_percent']:
+        if all(key in sample for sample in samples):
+            combined[key] = sum(sample[key] for sample in samples)
+    return combined
+
+def timestamp(when):
+    """A printable timestamp in UTC."""
+
+    gmt = time.gmtime(when)
+    return ("{:04d}{:02d}{:02d}-{:02d}{:02d}{:02d}"
+            .format(gmt.tm_year, gmt.tm_mon, gmt.tm_mday,
+                    gmt.tm_hour, gmt.tm_min, gmt.tm_sec))
+
+################################################################
+
+# The metrics published for each sample: name, sample key, and unit
+METRICS = [
+    ('CPU [%]', 'cpu_percent', 'Percent'),
+    ('Memory [%]', 'memory_percent', 'Percent'),
+    ('Memory [MB]', 'rss_mb', 'Megabytes'),
+    ('Peak Memory [MB]', 'peak_mb', 'Megabytes'),
+    ('Read [MB]', 'read_mb', 'Megabytes'),
+    ('Write [MB]', 'write_mb', 'Megabytes'),
+]
+
+class MetricBuffer(object):
+    """A buffer of CloudWatch metrics for the samples of a job.
+
+    The metrics are published when the buffer holds a full batch, when
+    FLUSH_INTERVAL seconds have passed since the last publication, and
+    when the buffer is flushed.
+    """
+
+    def __init__(self, taskname, region, mode=METRICS_MODE):
+        self.taskname = taskname
+        self.region = region
+        self.mode = mode
+        self.samples = []
+        self.flushed = time.time()
+
+    def add(self, sample):
+        """Add the metrics for a sample to the buffer."""
+
+        self.samples.append(sample)
+        if (len(self.samples) * len(METRICS) >= METRIC_BATCH or
+                time.time() - self.flushed >= FLUSH_INTERVAL):
+            self.flush()
+
+    def flush(self):
+        """Publish the buffered metrics.
+
+        A failure to publish metrics is reported and ignored.
+        """
+
+        samples, self.samples = self.samples, []
+        self.flushed = time.time()
+        if not samples:
+            return
+        try:
+            if self.mode == 'emf':
+                for sample in samples:
+                    print(json.dumps(self.emf(sample)))
+                sys.stdout.flush()
+            else:
+                self.put(samples)
+        except Exception as error: # pylint: disable=broad-except
+            print("Failed to publish metrics: {}".format(error))
+
+    def put(self, samples):
+        """Publish metrics with put_metric_data in full batches."""
+
+        dimensions = [{'Name': 'Job', 'Value': self.taskname}]
+        data = [{'MetricName': name,
+                 'Dimensions': dimensions,
+                 'Timestamp': datetime.datetime.utcfromtimestamp(
+                     sample['time']),
+                 'Value': float(sample[key]),
+                 'Unit': unit}
+                for sample in samples
+                for name, key, unit in METRICS if key in sample]
+        client = clientpool.client('cloudwatch', self.region)
+        for idx in range(0, len(data), METRIC_BATCH):
+            client.put_metric_data(Namespace=NAMESPACE,
+                                   MetricData=data[idx:idx+METRIC_BATCH])
+
+    def emf(self, sample):
+        """A sample as a CloudWatch Embedded Metric Format log record."""
+
+        metrics = [(name, key, unit) for name, key, unit in METRICS
+                   if key in sample]
+        record = {
+            '_aws': {
+                'Timestamp': int(sample['time'] * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': NAMESPACE,
+                    'Dimensions': [['Job']],
+                    'Metrics': [{'Name': name, 'Unit': unit}
+                                for name, _, unit in metrics]
+                }]
+            },
+            'Job': self.taskname
+        }
+        for name, key, _ in metrics:
+            record[name] = sample[key]
+        return record
+
+################################################################
@@ -0,0 +1,201 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+"""A cache of CBMC results keyed by the goto program and CBMC flags.
+
+The results of the property and coverage phases depend only on the
+goto program, the CBMC flags, and the version of CBMC.  The results
+are stored in the bucket under a key that is a hash of these inputs,
+and a phase whose inputs have been seen before restores its results
+from the cache instead of running CBMC.
+"""
+
+import hashlib
+import json
+import os
+import subprocess
+import time
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+import clientpool
+import options
+import s3
+
+################################################################
+
+# Results are stored under BUCKET/CACHE_PREFIX/KEY/PHASE/
+CACHE_PREFIX = 'cache'
+
+# The object written last that marks a complete entry in the cache
+CACHE_MARKER = 'result.json'
+
+# The files produced by each phase that are stored in the cache
+CACHE_FILES = {
+    'property': ['cbmc.txt', 'property.xml'],
+    'coverage': ['coverage.xml'],
+}
+
+# The return codes of CBMC for a completed run: 10 means a property failed
+CBMC_COMPLETED = [0, 10]
+
+# Bytes read at a time when hashing the goto program
+HASH_BLOCK = 1024 * 1024
+
+# Cache keys computed, keyed by the goto program and its modification time
+KEYS = {}
+
+################################################################
+
+def cbmc_version():
+    """The version string of the installed CBMC (None if unknown)."""
+
+    try:
+        return subprocess.check_output(['cbmc', '--version'],
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def normalized_flags(cbmcflags):
+    """The CBMC flags as command line words in a canonical order.
+
+    These are the words given by options_dict2words with the flags and
+    the loops in the unwindset in sorted order.
+    """
+
+    flags = dict(cbmcflags or {})
+    unwindset = flags.get('--unwindset')
+    if isinstance(unwindset, dict):
+        flags['--unwindset'] = options.unwindset_words2str(
+            sorted(options.unwindset_dict2words(unwindset)))
+    words = []
+    for key in sorted(flags):
+        words.append(str(key))
+        if flags[key] is not None:
+            words.append(str(flags[key]))
+    return words
+
+def file_digest(path):
+    """The SHA-256 digest of the content of a file."""
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as handle:
+        for block in iter(lambda: handle.read(HASH_BLOCK), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def result_key(opts):
+    """The cache key for the results of CBMC on the goto program.
+
+    The key is a hash of the goto program, the CBMC flags, and the
+    CBMC package and version.  Return None if the goto program or
+    the CBMC version is missing.
+    """
+
+    goto = os.path.join(opts['wsdir'], opts['goto'])
+    try:
+        stat = os.stat(goto)
+    except OSError:
+        return None
+    flags = normalized_flags(opts['cbmcflags'])
+    memo = (goto, stat.st_size, stat.st_mtime, tuple(flags))
+    if memo in KEYS:
+        return KEYS[memo]
+
+    version = cbmc_version()
+    if version is None:
+        return None
+    digest = hashlib.sha256()
+    for part in [file_digest(goto), ' '.join(flags),
+                 opts['cbmcpkg'], version]:
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    KEYS[memo] = digest.hexdigest()
+    return KEYS[memo]
+
+def cache_path(opts, key, phase):
+    """The S3 path to the cache entry for a phase."""
+
+    return "{}/{}/{}/{}".format(s3.path_url(opts['bucket']), CACHE_PREFIX,
+                                key, phase)
+
+################################################################
+
+def restore(opts, key, phase):
+    """Restore the results of a phase from the cache into the workspace.
+
+    Return True on a cache hit.  A failure to read the cache is a miss.
+    """
+
+    if key is None:
+        return False
+    path = cache_path(opts, key, phase)
+    try:
+        marker = s3.read_object("{}/{}".format(path, CACHE_MARKER),
+                                region=opts['region'])
+        if marker is None:
+            return False
+        for name in json.loads(marker.decode('utf-8'))['files']:
+            s3.copy_object_to_file("{}/{}".format(path, name),
+                                   os.path.join(opts['wsdir'], name),
+                                   region=opts['region'])
+    except (s3.S3Exception, ValueError, KeyError) as error:
+        print("Failed to restore {} results from cache: {}"
+              .format(phase, error))
+        return False
+    return True
+
+def store(opts, key, phase, usages):
+    """Store the results of a phase from the workspace in the cache.
+
+    Results are stored only if every CBMC run completed.  A failure to
+    write the cache does not fail the phase.
+    """
+
+    if key is None:
+        return False
+    if any(usage['returncode'] not in CBMC_COMPLETED for usage in usages):
+        return False
+    path = cache_path(opts, key, phase)
+    names = CACHE_FILES[phase]
+    try:
+        for name in names:
+            s3.copy_file_to_object(os.path.join(opts['wsdir'], name),
+                                   "{}/{}".format(path, name),
+                                   region=opts['region'])
+        marker = {'files': names, 'time': int(time.time()),
+                  'taskname': opts['taskname'],
+                  'cbmcflags': normalized_flags(opts['cbmcflags'])}
+        s3.write_object("{}/{}".format(path, CACHE_MARKER),
+                        json.dumps(marker), region=opts['region'])
+    except s3.S3Exception as error:
+        print("Failed to store {} results in cache: {}".format(phase, error))
+        return False
+    return True
+
+def record_lookup(opts, phase, hit):
+    """Record a cache hit or miss as a CloudWatch metric.
+
+    The average of the metric is the cache hit rate.  A failure to
+    publish the metric is reported and ignored.
+    """
+
+    print("Result cache {} for {} {}"
+          .format('hit' if hit else 'miss', opts['taskname'], phase))
+    try:
+        client = clientpool.client('cloudwatch', opts['region'])
+        client.put_metric_data(
+            Namespace='CBMC-Batch',
+            MetricData=[
+                {
+                    'MetricName': 'Result Cache Hit',
+                    'Dimensions': [{'Name': 'Job', 'Value': opts['taskname']},
+                                   {'Name': 'Phase', 'Value': phase}],
+                    'Value': 1.0 if hit else 0.0,
+                    'Unit': 'Count'
+                }
+            ])
+    except (ClientError, BotoCoreError) as error:
+        print("Failed to publish result cache metric: {}".format(error))
+
+################################################################
@@ -10,13 +10,29 @@ import os
 import re
 import sys
 import errno
+import fnmatch
+import time
+import calendar
+import hashlib
+import mimetypes
+import random
+import tarfile
+import threading
 from pprint import pprint
+from concurrent import futures
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
-import boto3
 from botocore.exceptions import ClientError
 from botocore.exceptions import WaiterError
+from boto3.exceptions import Boto3Error
+from boto3.s3.transfer import TransferConfig
 
 import clienterror
+import clientpool
 
 ################################################################
 
@@ -62,11 +78,87 @@ def abort(msg1, msg2=None, data=None, verbose=False):
 BUCKET_NAME_REGEXP = '[a-z0-9][a-z0-9_-]*'
 KEY_WORD_REGEXP = '[a-z0-9][a-z0-9_.-]*'
 KEY_NAME_REGEXP = '{key}(/{key})*'.format(key=KEY_WORD_REGEXP)
-PATH_REGEXP = '^(s3://)?({})(/({}))?/?(?i)$'.format(BUCKET_NAME_REGEXP,
-                                                    KEY_NAME_REGEXP)
+PATH_REGEXP = '^(s3://)?({})(/({}))?/?$'.format(BUCKET_NAME_REGEXP,
+                                                KEY_NAME_REGEXP)
+PATH_PATTERN = re.compile(PATH_REGEXP, re.IGNORECASE)
 BUCKET_NAME_GROUP = 2
 KEY_NAME_GROUP = 4
 
+class S3Path(object):
+    """A parsed path for an S3 bucket or object.
+
+    An S3Path is immutable and can be passed to any method in this
+    module in place of the path it was parsed from.  The key is None
+    for the path of a bucket.
+    """
+
+    __slots__ = ('bucket', 'key', 'name', 'url')
+
+    def __init__(self, bucket, key=None):
+        name = bucket if key is None else '{}/{}'.format(bucket, key)
+        for (attr, value) in [('bucket', bucket), ('key', key),
+                              ('name', name), ('url', 's3://' + name)]:
+            object.__setattr__(self, attr, value)
+
+    def __setattr__(self, attr, value):
+        raise AttributeError("S3Path is immutable")
+
+    def __delattr__(self, attr):
+        raise AttributeError("S3Path is immutable")
+
+    def __eq__(self, other):
+        return (isinstance(other, S3Path) and
+                (self.bucket, self.key) == (other.bucket, other.key))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.bucket, self.key))
+
+    def __str__(self):
+        return self.url
+
+    def __repr__(self):
+        return "S3Path('{}')".format(self.url)
+
+    def is_bucket(self):
+        """The path is the path of a bucket."""
+        return self.key is None
+
+    def is_object(self):
+        """The path is the path of an object."""
+        return self.key is not None
+
+# Paths are parsed once and then looked up (see s3_path)
+PATH_CACHE = {}
+PATH_CACHE_SIZE = 4096
+
+def s3_path(path):
+    """Parse a path for an S3 bucket or object into an S3Path.
+
+    Return None if the path is not a valid path.  Results are
+    memoized, so parsing the same path again costs a lookup.
+    """
+
+    if isinstance(path, S3Path) or path is None:
+        return path
+    try:
+        return PATH_CACHE[path]
+    except KeyError:
+        pass
+
+    match = PATH_PATTERN.match(path.strip())
+    spath = None
+    if match is not None:
+        spath = S3Path(match.group(BUCKET_NAME_GROUP),
+                       match.group(KEY_NAME_GROUP))
+
+    if len(PATH_CACHE) >= PATH_CACHE_SIZE:
+        PATH_CACHE.clear()
+    PATH_CACHE[path] = spath
+    return spath
+
 def parse_path(path):
     """Parse a path for an S3 bucket or object for a bucket and a key.
 
@@ -74,67 +166,44 @@ def parse_path(path):
     is a path without s3:// and a path url is a path with s3://.
 
     """
-    path = path.strip()
-    match = re.match(PATH_REGEXP, path)
-    if match is None:
+    spath = s3_path(path)
+    if spath is None:
         return None
-    bkt = match.group(BUCKET_NAME_GROUP)
-    key = match.group(KEY_NAME_GROUP)
-    return (bkt, key)
+    return (spath.bucket, spath.key)
 
 def is_path(path):
     """The path is a valid path for an S3 bucket or object."""
-    pair = parse_path(path)
-    return pair is not None
+    return s3_path(path) is not None
 
 def is_bucket(path):
     """The path is a valid path for an S3 bucket."""
-    pair = parse_path(path)
-    if pair is None:
-        return False
-    (bkt, key) = pair
-    return bkt is not None and key is None
+    spath = s3_path(path)
+    return spath is not None and spath.key is None
 
 def is_object(path):
     """The path is a valid path for an S3 object."""
-    pair = parse_path(path)
-    if pair is None:
-        return False
-    (bkt, key) = pair
-    return bkt is not None and key is not None
+    spath = s3_path(path)
+    return spath is not None and spath.key is not None
 
 def path_name(path):
     """Extract a path name from a path."""
-    pair = parse_path(path)
-    if pair is None:
-        return None
-    (bkt, key) = pair
-    if key is None:
-        return '{}'.format(bkt)
-    return '{}/{}'.format(bkt, key)
+    spath = s3_path(path)
+    return spath.name if spath is not None else None
 
 def bucket_name(path):
     """Extract a bucket name from a path."""
-    pair = parse_path(path)
-    if pair is None:
-        return None
-    (bkt, _) = pair
-    return bkt
+    spath = s3_path(path)
+    return spath.bucket if spath is not None else None
 
 def key_name(path):
     """Extract an object key name from a path."""
-    pair = parse_path(path)
-    if pair is None:
-        return None
-    (_, key) = pair
-    return key
+    spath = s3_path(path)
+    return spath.key if spath is not None else None
 
 def path_url(path):
     """Form the url for a bucket or object given by a path."""
-    name = path_name(path)
-    if name is None:
-        return None
-    return 's3://{}'.format(name)
+    spath = s3_path(path)
+    return spath.url if spath is not None else None
 
 def bucket_url(path):
     """Form the url for a bucket given by a path."""
@@ -163,11 +232,12 @@ def bucket_exists(path, client=None, region=None):
     """Test that path names a bucket and the bucket exists"""
 
     if client is None:
-        client = boto3.client('s3', region_name=region)
+        client = clientpool.client('s3', region)
 
-    if not is_bucket(path):
+    spath = s3_path(path)
+    if spath is None or not spath.is_bucket():
         return False
-    bkt = bucket_name(path)
+    bkt = spath.bucket
 
     try:
         client.head_bucket(Bucket=bkt)
@@ -183,12 +253,13 @@ def object_exists(path, client=None, region=None):
     """Test that path names an object and the object exists"""
 
     if client is None:
-        client = boto3.client('s3', region_name=region)
+        client = clientpool.client('s3', region)
 
-    if not is_object(path):
+    spath = s3_path(path)
+    if spath is None or not spath.is_object():
         return False
-    bucket = bucket_name(path)
-    key = key_name(path)
+    bucket = spath.bucket
+    key = spath.key
 
     try:
         response = client.head_object(Bucket=bucket, Key=key)
@@ -202,6 +273,23 @@ def object_exists(path, client=None, region=None):
         return False
     return True
 
+def object_head(path, client=None, region=None):
+    """The metadata of an object from head_object (None if it does not exist)"""
+
+    if client is None:
+        client = clientpool.client('s3', region)
+
+    spath = s3_path(path)
+    if spath is None or not spath.is_object():
+        abort("Not an object name", path)
+
+    try:
+        return client.head_object(Bucket=spath.bucket, Key=spath.key)
+    except ClientError as exc:
+        if clienterror.is_not_found(exc):
+            return None
+        abort("Error reading object metadata", path, data=exc)
+
 ################################################################
 # Creation
 #
@@ -223,11 +311,12 @@ def create_bucket(path, quiet=True, client=None, region=None):
     """Create a bucket"""
 
     if client is None:
-        client = boto3.client('s3', region_name=region)
+        client = clientpool.client('s3', region)
 
-    if not is_bucket(path):
+    spath = s3_path(path)
+    if spath is None or not spath.is_bucket():
         abort("Not a bucket", path)
-    bkt = bucket_name(path)
+    bkt = spath.bucket
 
     try:
         client.create_bucket(Bucket=bkt)
@@ -239,12 +328,13 @@ def create_object(path, client=None, region=None, force=False):
     """Create an object"""
 
     if client is None:
-        client = boto3.client('s3', region_name=region)
+        client = clientpool.client('s3', region)
 
-    if not is_object(path):
+    spath = s3_path(path)
+    if spath is None or not spath.is_object():
         abort("Not an object name", path)
-    bucket = bucket_name(path)
-    key = key_name(path)
+    bucket = spath.bucket
+    key = spath.key
 
     if force:
         create_bucket(bucket, client=client, region=region)
@@ -257,40 +347,284 @@ def create_object(path, client=None, region=None, force=False):
     if not response.get('ETag', False):
         abort("Error creating object", key, data=response)
 
-def copy_file_to_object(filename, path, client=None, region=None):
-    """Copy local file to an S3 object"""
+# Managed transfers move objects larger than the multipart threshold
+# as parts of the given size, uploading parts or downloading byte
+# ranges concurrently.
+
+MB = 1024 * 1024
+MULTIPART_THRESHOLD = 16 * MB
+MULTIPART_PART_SIZE = 16 * MB
+TRANSFER_CONCURRENCY = 10
+
+def transfer_config(part_size=None, threshold=None, concurrency=None):
+    """Configuration for a managed (multipart, concurrent) transfer."""
+
+    return TransferConfig(
+        multipart_threshold=threshold or MULTIPART_THRESHOLD,
+        multipart_chunksize=part_size or MULTIPART_PART_SIZE,
+        max_concurrency=concurrency or TRANSFER_CONCURRENCY,
+        use_threads=True)
+
+TRANSFER_CONFIG = transfer_config()
+
+class Progress:
+    """A transfer callback printing progress in steps of a percentage."""
+
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, name, size, step=10):
+        self.name = name
+        self.size = size
+        self.step = step
+        self.done = 0
+        self.reported = 0
+        self.start = time.time()
+        self.lock = threading.Lock()
+
+    def __call__(self, count):
+        with self.lock:
+            self.done += count
+            percent = 100 * self.done // self.size if self.size else 100
+            if (percent < self.reported + self.step and
+                    self.done < self.size):
+                return
+            self.reported = percent
+            seconds = max(time.time() - self.start, 1e-3)
+            print("{}: {}% of {} bytes ({:.1f} MB/s)"
+                  .format(self.name, percent, self.size,
+                          self.done / seconds / MB))
+            sys.stdout.flush()
+
+def copy_file_to_object(filename, path, client=None, region=None,
+                        config=None, progress=False):
+    """Copy local file to an S3 object
+
+    The config is a managed transfer configuration (see
+    transfer_config), and progress is True to print progress or a
+    callback to invoke with the number of bytes moved by each part.
+    """
+    # pylint: disable=too-many-arguments
 
     if client is None:
-        client = boto3.client('s3', region_name=region)
+        client = clientpool.client('s3', region)
 
-    if not is_object(path):
+    spath = s3_path(path)
+    if spath is None or not spath.is_object():
         abort("Not an object name", path)
-    bucket = bucket_name(path)
-    key = key_name(path)
+    bucket = spath.bucket
+    key = spath.key
+
+    if progress is True:
+        progress = Progress(filename, os.path.getsize(filename))
 
     try:
-        client.upload_file(filename, bucket, key)
-    except ClientError as exc:
+        client.upload_file(filename, bucket, key,
+                           Config=config or TRANSFER_CONFIG,
+                           Callback=progress or None)
+    except (ClientError, Boto3Error) as exc:
         abort("Error copying file to object: {}, {}".format(filename, path),
               "", data=exc)
 
-def copy_object_to_file(objectname, filename, client=None, region=None):
-    """Copy an S3 object to a local file"""
+def copy_object_to_file(objectname, filename, client=None, region=None,
+                        config=None, progress=False):
+    """Copy an S3 object to a local file
+
+    The config and progress are as for copy_file_to_object.
+    """
+    # pylint: disable=too-many-arguments
 
     if client is None:
-        client = boto3.client('s3', region_name=region)
+        client = clientpool.client('s3', region)
 
-    if not is_object(objectname):
+    spath = s3_path(objectname)
+    if spath is None or not spath.is_object():
         abort("Not an object name", objectname)
-    bucket = bucket_name(objectname)
-    key = key_name(objectname)
+    bucket = spath.bucket
+    key = spath.key
 
     try:
-        client.download_file(bucket, key, filename)
-    except ClientError as exc:
+        if progress is True:
+            size = client.head_object(Bucket=bucket, Key=key)['ContentLength']
+            progress = Progress(objectname, size)
+        client.download_file(bucket, key, filename,
+                             Config=config or TRANSFER_CONFIG,
+                             Callback=progress or None)
+    except (ClientError, Boto3Error) as exc:
         abort("Error copying object {} to file {}".format(objectname, filename),
               "", data=exc)
 
+################################################################
+# Streaming
+#
+# A tar file in S3 can be extracted as it downloads: a background
+# thread reads the object body ahead into a bounded queue while a
+# streaming tarfile reader decompresses and writes the members already
+# read, so the tar file itself is never written to disk.
+
+STREAM_CHUNK = MB
+STREAM_READAHEAD = 16
+
+class ReadAhead(object):
+    """A file object reading a stream ahead in a background thread."""
+
+    def __init__(self, stream, chunk=STREAM_CHUNK, depth=STREAM_READAHEAD):
+        self.chunks = queue.Queue(maxsize=depth)
+        self.buffer = b''
+        self.offset = 0
+        self.done = False
+        self.closed = False
+        self.thread = threading.Thread(target=self.fill, args=(stream, chunk))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def fill(self, stream, chunk):
+        """Read the stream into the queue until the end or close."""
+        try:
+            while self.put(stream.read(chunk)):
+                pass
+        except Exception as exc: # pylint: disable=broad-except
+            self.put(exc)
+        finally:
+            stream.close()
+
+    def put(self, item):
+        """Queue a chunk, an exception, or b'' at the end of the stream.
+
+        Return False if there is nothing more to read.
+        """
+        while not self.closed:
+            try:
+                self.chunks.put(item, timeout=1)
+                return bool(item) and not isinstance(item, Exception)
+            except queue.Full:
+                continue
+        return False
+
+    def next_chunk(self):
+        """Make the next chunk of the stream the buffer (False at the end)."""
+        if self.done:
+            return False
+        item = self.chunks.get()
+        if isinstance(item, Exception):
+            self.done = True
+            raise item
+        if not item:
+            self.done = True
+            return False
+        self.buffer = item
+        self.offset = 0
+        return True
+
+    def read(self, size=-1):
+        """Read up to size bytes (all the rest if size is negative)."""
+        parts = []
+        while size != 0:
+            if self.offset >= len(self.buffer) and not self.next_chunk():
+                break
+            count = len(self.buffer) - self.offset
+            if size > 0:
+                count = min(count, size)
+                size -= count
+            parts.append(self.buffer[self.offset:self.offset+count])
+            self.offset += count
+        return b''.join(parts)
+
+    def close(self):
+        """Stop reading the stream."""
+        self.closed = True
+
+def member_selected(name, members):
+    """The tar file member name is one of members or under one of them."""
+
+    if members is None:
+        return True
+    name = os.path.normpath(name)
+    for member in members:
+        member = os.path.normpath(member)
+        if name == member or name.startswith(member + '/'):
+            return True
+    return False
+
+def extract_object(path, directory, members=None, client=None, region=None):
+    """Extract a tar file in S3 into a directory as it downloads
+
+    The tar file may be compressed.  Members is a list of paths in the
+    tar file: only the files and directories at or under these paths
+    are extracted (default: everything).  Return the number of members
+    extracted.
+    """
+    # pylint: disable=too-many-arguments
+
+    if client is None:
+        client = clientpool.client('s3', region)
+
+    spath = s3_path(path)
+    if spath is None or not spath.is_object():
+        abort("Not an object name", path)
+
+    try:
+        body = client.get_object(Bucket=spath.bucket, Key=spath.key)['Body']
+    except ClientError as exc:
+        abort("Error reading object", path, data=exc)
+
+    stream = ReadAhead(body)
+    count = 0
+    try:
+        with tarfile.open(fileobj=stream, mode='r|*') as tar:
+            if hasattr(tarfile, 'tar_filter'):
+                tar.extraction_filter = tarfile.tar_filter
+            for member in tar:
+                if not member_selected(member.name, members):
+                    continue
+                if (os.path.isabs(member.name) or
+                        '..' in member.name.split('/')):
+                    abort("Unsafe path in tar file {}".format(path),
+                          member.name)
+                tar.extract(member, directory)
+                count += 1
+    except (tarfile.TarError, IOError, OSError) as exc:
+        abort("Error extracting object {} into {}".format(path, directory),
+              str(exc), data=exc)
+    finally:
+        stream.close()
+    return count
+
+def read_object(path, client=None, region=None):
+    """Read the content of an S3 object (None if the object does not exist)"""
+
+    if client is None:
+        client = clientpool.client('s3', region)
+
+    spath = s3_path(path)
+    if spath is None or not spath.is_object():
+        abort("Not an object name", path)
+
+    try:
+        response = client.get_object(Bucket=spath.bucket, Key=spath.key)
+        return response['Body'].read()
+    except ClientError as exc:
+        if clienterror.is_nosuchkey(exc) or clienterror.is_not_found(exc):
+            return None
+        abort("Error reading object", path, data=exc)
+
+def write_object(path, data, client=None, region=None, metadata=None):
+    """Write data (a string or bytes) to an S3 object"""
+
+    if client is None:
+        client = clientpool.client('s3', region)
+
+    spath = s3_path(path)
+    if spath is None or not spath.is_object():
+        abort("Not an object name", path)
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+
+    try:
+        client.put_object(Bucket=spath.bucket, Key=spath.key, Body=data,
+                          Metadata=metadata or {})
+    except ClientError as exc:
+        abort("Error writing object", path, data=exc)
+
 ################################################################
 # Deletion
 #
@@ -320,13 +654,14 @@ def delete_bucket(path, recursive=False, client=None, region=None,
     # pylint: disable=too-many-arguments
 
     if client is None:
-        client = boto3.client('s3', region_name=region)
+        client = clientpool.client('s3', region)
 
-    if not is_bucket(path):
+    spath = s3_path(path)
+    if spath is None or not spath.is_bucket():
         if force:
             return
         abort("Not a bucket", path)
-    bkt = bucket_name(path)
+    bkt = spath.bucket
 
     if recursive:
         delete_object(
@@ -346,14 +681,15 @@ def delete_object(path, recursive=False, client=None, region=None,
     # pylint: disable=too-many-branches
 
     if client is None:
-        client = boto3.client('s3', region_name=region)
+        client = clientpool.client('s3', region)
 
-    if not is_path(path):  # not "is_object(path)" for recursive to work !!!
+    spath = s3_path(path)
+    if spath is None:  # not "is_object(path)" for recursive to work !!!
         if force:
             return
         abort("Not an object name", path)
-    bucket = bucket_name(path)
-    prefix = key_name(path) or ""
+    bucket = spath.bucket
+    prefix = spath.key or ""
 
     if not bucket_exists(bucket, client, region):
         if force:
@@ -361,38 +697,88 @@ def delete_object(path, recursive=False, client=None, region=None,
         abort("No such bucket", path)
 
     if recursive:
-        while True:
-            try:
-                response = client.list_objects(Bucket=bucket, Prefix=prefix)
-            except ClientError as exc:
-                # not to fail here can induce an infinite loop
-                abort("Error deleting objects", path,
-                      data=exc, verbose=not quiet)
-
-            objects = response.get('Contents', None)
-            if objects is None:
-                break
-
-            for obj in objects:
-                key = obj.get('Key', None)
-                if key is None:
-                    # not to fail here can induce an infinite loop
-                    abort("Error deleting objects", path, data=obj,
-                          verbose=not quiet)
-                if not quiet:
-                    print("Deleting object {}".format(key))
-                try:
-                    client.delete_object(Bucket=bucket, Key=key)
-                except ClientError as exc:
-                    # deleting a nonexistent object does not generate an error
-                    abort("Error deleting object", key,
-                          data=exc, verbose=not quiet)
+        keys = [obj['Key'] for obj in list_objects(
+            bucket, prefix, client=client, quiet=quiet)]
+        delete_keys(bucket, keys, client=client, quiet=quiet)
     else:
         try:
             response = client.delete_object(Bucket=bucket, Key=prefix)
         except ClientError as exc:
             # deleting a nonexistent object does not generate an error
-            abort("Error deleting object", key, data=exc, verbose=not quiet)
+            abort("Error deleting object", prefix, data=exc, verbose=not quiet)
+
+# A single DeleteObjects request accepts at most 1000 keys
+DELETE_BATCH = 1000
+DELETE_WORKERS = 8
+
+def list_objects(bucket, prefix="", client=None, region=None, quiet=True,
+                 delimiter=None):
+    """Generate the object summaries for every key under prefix in bucket.
+
+    With a delimiter, omit keys containing the delimiter after the prefix.
+    """
+    # pylint: disable=too-many-arguments
+
+    if client is None:
+        client = clientpool.client('s3', region)
+
+    args = {'Bucket': bucket, 'Prefix': prefix}
+    if delimiter:
+        args['Delimiter'] = delimiter
+
+    paginator = client.get_paginator('list_objects_v2')
+    try:
+        for page in paginator.paginate(**args):
+            for obj in page.get('Contents', []):
+                if obj.get('Key') is None:
+                    abort("Error listing objects", bucket, data=obj,
+                          verbose=not quiet)
+                yield obj
+    except ClientError as exc:
+        abort("Error listing objects", "{}/{}".format(bucket, prefix),
+              data=exc, verbose=not quiet)
+
+def delete_keys(bucket, keys, client=None, region=None, quiet=True,
+                workers=DELETE_WORKERS):
+    """Delete keys from bucket in batches run on a pool of threads."""
+    # pylint: disable=too-many-arguments
+
+    if client is None:
+        client = clientpool.client('s3', region)
+
+    def delete_batch(batch):
+        """Delete a batch of keys and return the keys that failed."""
+        if not quiet:
+            for key in batch:
+                print("Deleting object {}".format(key))
+        try:
+            response = client.delete_objects(
+                Bucket=bucket,
+                Delete={'Objects': [{'Key': key} for key in batch],
+                        'Quiet': True})
+        except ClientError as exc:
+            return [{'Key': key, 'Code': clienterror.code(exc),
+                     'Message': clienterror.message(exc)} for key in batch]
+        return response.get('Errors', [])
+
+    batches = [keys[idx:idx+DELETE_BATCH]
+               for idx in range(0, len(keys), DELETE_BATCH)]
+    if not batches:
+        return
+
+    errors = []
+    with futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        for failed in pool.map(delete_batch, batches):
+            errors.extend(failed)
+
+    if errors:
+        for error in errors:
+            print("Error deleting object {}: {} ({})"
+                  .format(error.get('Key'), error.get('Message'),
+                          error.get('Code')))
+        abort("Error deleting objects",
+              "{} of {} keys in {}".format(len(errors), len(keys), bucket),
+              data=errors, verbose=not quiet)
 
 ################################################################
 # Synchronization
@@ -458,11 +844,12 @@ def wait_for_bucket_condition(path, condition, client=None, region=None,
     # pylint: disable=too-many-arguments
 
     if client is None:
-        client = boto3.client('s3', region_name=region)
+        client = clientpool.client('s3', region)
 
-    if not is_bucket(path):
+    spath = s3_path(path)
+    if spath is None or not spath.is_bucket():
         return
-    bkt = bucket_name(path)
+    bkt = spath.bucket
 
     try:
         waiter = client.get_waiter(condition)
@@ -487,12 +874,13 @@ def wait_for_object_condition(path, condition, client=None, region=None,
     # pylint: disable=too-many-arguments
 
     if client is None:
-        client = boto3.client('s3', region_name=region)
+        client = clientpool.client('s3', region)
 
-    if not is_object(path):
+    spath = s3_path(path)
+    if spath is None or not spath.is_object():
         return
-    bkt = bucket_name(path)
-    key = key_name(path)
+    bkt = spath.bucket
+    key = spath.key
 
     try:
         waiter = client.get_waiter(condition)
@@ -507,12 +895,371 @@ def wait_for_object_condition(path, condition, client=None, region=None,
         abort("Failed to wait for object: {} {}".format(condition, path),
               data=exc)
 
+# Waiting for many objects polls each bucket with one listing per
+# round instead of polling each object, and backs off exponentially
+# with jitter between rounds.
+
+BACKOFF_INITIAL = 1
+BACKOFF_MAXIMUM = 30
+BACKOFF_FACTOR = 2
+
+def wait_for_objects(paths, client=None, region=None, exist=True,
+                     any_object=False, timeout=INTERVAL*ATTEMPTS,
+                     interval=BACKOFF_INITIAL, max_interval=BACKOFF_MAXIMUM):
+    """Wait for every object (or any object) in paths to exist.
+
+    With exist=False, wait for the objects to no longer exist.  Each
+    round lists each bucket once under the longest prefix common to
+    the keys in that bucket.  Return the paths for which the condition
+    holds once it holds for all of them (or, with any_object=True, for
+    at least one of them), and abort if the timeout expires first.
+    """
+    # pylint: disable=too-many-arguments
+    # pylint: disable=too-many-locals
+
+    if client is None:
+        client = clientpool.client('s3', region)
+
+    spaths = []
+    for path in paths:
+        spath = s3_path(path)
+        if spath is None or not spath.is_object():
+            abort("Not an object name", path)
+        spaths.append((path, spath))
+    if not spaths:
+        return []
+
+    groups = {}
+    for (_, spath) in spaths:
+        groups.setdefault(spath.bucket, set()).add(spath.key)
+    prefixes = dict((bkt, os.path.commonprefix(sorted(keys)))
+                    for bkt, keys in groups.items())
+
+    deadline = time.time() + timeout
+    delay = interval
+    while True:
+        found = set()
+        for bkt in sorted(groups):
+            found.update((bkt, obj['Key'])
+                         for obj in list_objects(bkt, prefixes[bkt],
+                                                 client=client)
+                         if obj['Key'] in groups[bkt])
+
+        done = [path for (path, spath) in spaths
+                if ((spath.bucket, spath.key) in found) == exist]
+        if done and (any_object or len(done) == len(spaths)):
+            return done
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            abort("Wait for objects timed out",
+                  "{} of {} objects {}".format(
+                      len(spaths) - len(done), len(spaths),
+                      "missing" if exist else "remaining"),
+                  data=[path for (path, _) in spaths if path not in done])
+        time.sleep(min(random.uniform(delay / 2.0, delay), remaining))
+        delay = min(delay * BACKOFF_FACTOR, max_interval)
+
 ################################################################
 
 # boto3 api omits a sync which is just too useful not to use
+#
+# The native sync engine lists the S3 prefix once, walks the local
+# directory once, and transfers the files that differ concurrently
+# using a single client.  A file differs if its size differs or if the
+# source is newer than the destination and its content does not match
+# the object's ETag.  The aws cli is still available with native=False.
+
+SYNC_WORKERS = 10
+
+def sync_directory_to_bucket(directory, bucket, quiet=False, delete=False,
+                             metadata=None, client=None, region=None,
+                             native=True, include=None, exclude=None):
+    """Synchronize a directory to a path (a bucket or bucket and prefix).
+
+    Only the files selected by the include and exclude patterns are
+    synchronized (see name_selected).  Return the number of files and
+    bytes transferred, the number of objects deleted, and the time
+    taken.
+    """
+    # pylint: disable=too-many-arguments
+    # pylint: disable=too-many-locals
 
-def sync_directory_to_bucket(directory, bucket, quiet=False, delete=False, metadata=None):
-    """Synchronize a directory to a path (a bucket or bucket and prefix)."""
+    if not native:
+        return sync_directory_to_bucket_cli(directory, bucket, quiet,
+                                            delete, metadata, include,
+                                            exclude)
+
+    if client is None:
+        client = clientpool.client('s3', region)
+
+    if not os.path.isdir(directory):
+        abort("Directory does not exist", directory)
+
+    url = path_url(bucket)
+    if url is None:
+        abort("Not a bucket", bucket)
+    bkt = bucket_name(bucket)
+    prefix = sync_prefix(bucket)
+
+    start = time.time()
+    if not quiet:
+        print("Copying directory {} to bucket {}".format(directory, url))
+    local = select_files(local_files(directory), include, exclude)
+    remote = select_files(remote_files(bkt, prefix, client), include, exclude)
+
+    extra = {}
+    if metadata:
+        extra['Metadata'] = dict((str(k), str(v)) for k, v in metadata.items())
+
+    def upload(name):
+        """Upload a file from the directory to the bucket."""
+        filename = os.path.join(directory, name)
+        key = prefix + name
+        args = dict(extra)
+        content_type = mimetypes.guess_type(filename)[0]
+        if content_type:
+            args['ContentType'] = content_type
+        if not quiet:
+            print("upload: {} to s3://{}/{}".format(filename, bkt, key))
+        client.upload_file(filename, bkt, key, ExtraArgs=args,
+                           Config=TRANSFER_CONFIG)
+        return local[name][0]
+
+    names = [name for name in sorted(local)
+             if file_differs(local[name], remote.get(name),
+                             os.path.join(directory, name))]
+    (files, size) = run_transfers(upload, names, "Error copying directory {} "
+                                  "to bucket {}".format(directory, url))
+
+    deleted = 0
+    if delete:
+        keys = [prefix + name for name in sorted(remote) if name not in local]
+        delete_keys(bkt, keys, client=client, quiet=quiet)
+        deleted = len(keys)
+
+    stats = sync_stats(files, size, deleted, start)
+    if not quiet:
+        print("Copied directory {} to bucket {}: {}".format(directory, url,
+                                                            stats))
+    sys.stdout.flush()
+    return stats
+
+def sync_bucket_to_directory(bucket, directory, quiet=False, delete=False,
+                             client=None, region=None, native=True,
+                             include=None, exclude=None):
+    """Synchronize a path (a bucket or bucket and prefix) to a directory.
+
+    Only the files selected by the include and exclude patterns are
+    synchronized (see name_selected).  Return the number of files and
+    bytes transferred, the number of files deleted, and the time taken.
+    """
+    # pylint: disable=too-many-arguments
+    # pylint: disable=too-many-locals
+
+    if not native:
+        return sync_bucket_to_directory_cli(bucket, directory, quiet, delete,
+                                            include, exclude)
+
+    if client is None:
+        client = clientpool.client('s3', region)
+
+    make_directory(directory)
+
+    url = path_url(bucket)
+    if url is None:
+        abort("Not a bucket", bucket)
+    bkt = bucket_name(bucket)
+    prefix = sync_prefix(bucket)
+
+    start = time.time()
+    if not quiet:
+        print("Copying bucket {} to directory {}".format(url, directory))
+    local = select_files(local_files(directory), include, exclude)
+    remote = select_files(remote_files(bkt, prefix, client), include, exclude)
+
+    def download(name):
+        """Download an object from the bucket to the directory."""
+        filename = os.path.join(directory, *name.split('/'))
+        key = prefix + name
+        if not quiet:
+            print("download: s3://{}/{} to {}".format(bkt, key, filename))
+        make_directory(os.path.dirname(filename))
+        client.download_file(bkt, key, filename, Config=TRANSFER_CONFIG)
+        mtime = remote[name][1]
+        os.utime(filename, (mtime, mtime))
+        return remote[name][0]
+
+    names = [name for name in sorted(remote)
+             if file_differs(remote[name], local.get(name),
+                             os.path.join(directory, *name.split('/')),
+                             remote[name][2])]
+    (files, size) = run_transfers(download, names, "Error copying bucket {} "
+                                  "to directory {}".format(url, directory))
+
+    deleted = 0
+    if delete:
+        for name in sorted(local):
+            if name not in remote:
+                os.remove(os.path.join(directory, *name.split('/')))
+                deleted += 1
+
+    stats = sync_stats(files, size, deleted, start)
+    if not quiet:
+        print("Copied bucket {} to directory {}: {}".format(url, directory,
+                                                            stats))
+    sys.stdout.flush()
+    return stats
+
+def sync_prefix(path):
+    """The key prefix under which a sync path stores its files."""
+
+    key = key_name(path)
+    if not key:
+        return ""
+    return key.rstrip('/') + '/'
+
+def name_selected(name, include=None, exclude=None):
+    """The file name is selected by the include and exclude patterns.
+
+    Names are relative to the directory or prefix being synchronized,
+    and patterns are shell-style patterns in which * matches /.  A name
+    is selected if it matches a pattern in include (or include is None)
+    and matches no pattern in exclude.
+    """
+
+    if include is not None and not any(fnmatch.fnmatchcase(name, pattern)
+                                       for pattern in include):
+        return False
+    return not any(fnmatch.fnmatchcase(name, pattern)
+                   for pattern in exclude or [])
+
+def select_files(files, include=None, exclude=None):
+    """The files in a dictionary keyed by name selected by the patterns."""
+
+    if include is None and not exclude:
+        return files
+    return dict((name, value) for name, value in files.items()
+                if name_selected(name, include, exclude))
+
+def filter_words(include=None, exclude=None):
+    """The aws s3 sync options selecting files like name_selected."""
+
+    words = []
+    if include is not None:
+        words += ['--exclude', '*']
+        for pattern in include:
+            words += ['--include', pattern]
+    for pattern in exclude or []:
+        words += ['--exclude', pattern]
+    return words
+
+def make_directory(directory):
+    """Create a directory if it does not already exist."""
+
+    try:
+        os.makedirs(directory)
+    except OSError as exc:
+        if not (exc.errno == errno.EEXIST and os.path.isdir(directory)):
+            abort("Error creating directory", directory)
+
+def local_files(directory):
+    """Map each file under a directory to its size and modification time.
+
+    Files are named by their path relative to directory using '/' as
+    the separator, as they are in S3 keys.
+    """
+
+    files = {}
+    for root, _, names in os.walk(directory, followlinks=True):
+        for name in names:
+            filename = os.path.join(root, name)
+            if not os.path.isfile(filename):
+                continue
+            stat = os.stat(filename)
+            relname = os.path.relpath(filename, directory)
+            files[relname.replace(os.sep, '/')] = (stat.st_size,
+                                                   int(stat.st_mtime), None)
+    return files
+
+def remote_files(bucket, prefix, client):
+    """Map each object under a prefix to its size, modification time and ETag.
+
+    Objects are named by their key relative to the prefix.
+    """
+
+    files = {}
+    for obj in list_objects(bucket, prefix, client=client):
+        name = obj['Key'][len(prefix):]
+        if not name or name.endswith('/'):
+            continue
+        mtime = calendar.timegm(obj['LastModified'].utctimetuple())
+        files[name] = (obj['Size'], mtime, obj.get('ETag', '').strip('"'))
+    return files
+
+def file_differs(source, destination, filename, etag=None):
+    """The source file must be copied over the destination file.
+
+    Source and destination are (size, mtime, etag) triples describing
+    the same file on the two sides of a sync, and filename is the local
+    copy of the file.  The etag of the object in S3 is in whichever of
+    the two triples describes the object.
+    """
+
+    if destination is None:
+        return True
+    if source[0] != destination[0]:
+        return True
+    if source[1] <= destination[1]:
+        return False
+    etag = etag or destination[2]
+    return not etag_matches(filename, etag)
+
+def etag_matches(filename, etag):
+    """The content of a local file has the given S3 ETag.
+
+    Only ETags of objects uploaded in a single part are the MD5 of
+    their content, so multipart ETags never match.
+    """
+
+    if not etag or '-' in etag or not os.path.isfile(filename):
+        return False
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as fileobj:
+        for block in iter(lambda: fileobj.read(1024*1024), b''):
+            md5.update(block)
+    return md5.hexdigest() == etag
+
+def run_transfers(transfer, names, msg, workers=SYNC_WORKERS):
+    """Run transfer on each name concurrently and total the bytes moved."""
+
+    files = 0
+    size = 0
+    errors = []
+    with futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        jobs = dict((pool.submit(transfer, name), name) for name in names)
+        for job in futures.as_completed(jobs):
+            try:
+                size += job.result()
+                files += 1
+            except (ClientError, Boto3Error, IOError, OSError) as exc:
+                print("{}: {} ({})".format(msg, jobs[job], exc))
+                errors.append(jobs[job])
+    sys.stdout.flush()
+    if errors:
+        abort(msg, "{} of {} files failed".format(len(errors), len(names)))
+    return (files, size)
+
+def sync_stats(files, size, deleted, start):
+    """Summarize a sync."""
+
+    return {'files': files, 'bytes': size, 'deleted': deleted,
+            'seconds': round(time.time() - start, 3)}
+
+def sync_directory_to_bucket_cli(directory, bucket, quiet=False, delete=False,
+                                 metadata=None, include=None, exclude=None):
+    """Synchronize a directory to a path with the aws cli."""
+    # pylint: disable=too-many-arguments
 
     if not os.path.isdir(directory):
         abort("Directory does not exist", directory)
@@ -523,6 +1270,7 @@ def sync_directory_to_bucket(directory, bucket, quiet=False, delete=False, metad
 
     try:
         cmd = ['aws', 's3', 'sync', directory, url]
+        cmd += filter_words(include, exclude)
         if delete:
             cmd.append('--delete')
         if quiet:
@@ -546,14 +1294,12 @@ def sync_directory_to_bucket(directory, bucket, quiet=False, delete=False, metad
         sys.stdout.flush()
         raise exc
 
-def sync_bucket_to_directory(bucket, directory, quiet=False, delete=False):
-    """Synchronize a path (a bucket or bucket and prefix) to a directory."""
+def sync_bucket_to_directory_cli(bucket, directory, quiet=False, delete=False,
+                                 include=None, exclude=None):
+    """Synchronize a path to a directory with the aws cli."""
+    # pylint: disable=too-many-arguments
 
-    try:
-        os.makedirs(directory)
-    except OSError as exc:
-        if not (exc.errno == errno.EEXIST and os.path.isdir(directory)):
-            abort("Error creating directory", directory)
+    make_directory(directory)
 
     url = path_url(bucket)
     if url is None:
@@ -561,6 +1307,7 @@ def sync_bucket_to_directory(bucket, directory, quiet=False, delete=False):
 
     try:
         cmd = ['aws', 's3', 'sync', url, directory]
+        cmd += filter_words(include, exclude)
         if delete:
             cmd.append('--delete')
         if quiet:
@@ -583,14 +1330,13 @@ def sync_bucket_to_directory(bucket, directory, quiet=False, delete=False):
 def versioning_enabled(bucket, client=None, region=None):
     """Object versioning is enabled in the S3 bucket."""
     if client is None:
-        client = boto3.client('s3', region_name=region)
+        client = clientpool.client('s3', region)
 
-    bucket = bucket.strip()
     if not is_bucket(bucket):
         return False
 
     try:
-        response = client.get_bucket_versioning(Bucket=bucket)
+        response = client.get_bucket_versioning(Bucket=bucket_name(bucket))
     except ClientError:
         return False
 
@@ -0,0 +1,141 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+"""Split the property phase of a proof into shards and merge the results.
+
+The build phase lists the properties of the goto program once in
+property.xml.  Shard i of N checks every Nth property starting with
+property i, and the merge step combines the output of the shards into
+the cbmc.txt that CBMC would have written checking every property.
+"""
+
+import re
+import xml.etree.ElementTree as ElementTree
+
+################################################################
+
+RESULTS_HEADER = '** Results:'
+TRACE_HEADER = 'Trace for '
+VERIFICATION = 'VERIFICATION '
+SUCCESSFUL = 'VERIFICATION SUCCESSFUL'
+FAILED = 'VERIFICATION FAILED'
+
+# A result line: [NAME] DESCRIPTION: STATUS
+RESULT_PATTERN = re.compile(r'^\[(\S+)\] .*: ([A-Z]+)$')
+
+# The summary line after the results and traces
+SUMMARY_PATTERN = re.compile(r'^\*\* \d+ of \d+ failed')
+
+################################################################
+
+def shard_name(index):
+    """The prefix of the files written by a shard."""
+
+    return 'shard{}'.format(index)
+
+def read_properties(path):
+    """The names of the properties in the output of --show-properties."""
+
+    try:
+        root = ElementTree.parse(path).getroot()
+    except (IOError, OSError, ElementTree.ParseError):
+        return None
+    return [prop.get('name') for prop in root.iter('property')
+            if prop.get('name')]
+
+def shard_properties(names, index, count):
+    """The properties checked by shard index of count shards.
+
+    Properties are dealt to the shards in turn so that the properties
+    of each function are spread over the shards.
+    """
+
+    return names[index::count]
+
+################################################################
+
+class Results(object):
+    """The results in the text output of CBMC with --trace."""
+
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, text):
+        self.preamble = []
+        self.results = []
+        self.traces = {}
+        self.verdict = None
+
+        state = 'preamble'
+        header = None
+        trace = None
+        for line in text.splitlines():
+            if state == 'preamble':
+                if line.strip() == RESULTS_HEADER:
+                    state = 'results'
+                else:
+                    self.preamble.append(line)
+            elif SUMMARY_PATTERN.match(line):
+                state = 'summary'
+            elif state == 'summary':
+                if line.startswith(VERIFICATION):
+                    self.verdict = line.strip()
+            elif line.startswith(TRACE_HEADER):
+                state = 'traces'
+                trace = line[len(TRACE_HEADER):].strip().rstrip(':')
+                self.traces[trace] = [line]
+            elif state == 'traces':
+                self.traces[trace].append(line)
+            else:
+                match = RESULT_PATTERN.match(line)
+                if match:
+                    self.results.append((match.group(1), match.group(2),
+                                         header, line))
+                elif line.strip():
+                    header = line
+
+def merge(shards, names=None):
+    """Merge the Results of the shards into the output of one CBMC run.
+
+    The results and traces are listed in the order of the property
+    names (default: the order of the shards).  The verdict is failure
+    if any shard failed, and success if every shard succeeded.  Every
+    shard must have a verdict.
+    """
+
+    order = dict((name, idx) for idx, name in enumerate(names or []))
+    results = sorted([result for shard in shards for result in shard.results],
+                     key=lambda result: order.get(result[0], len(order)))
+
+    preamble = next((shard.preamble for shard in shards if shard.preamble),
+                    [])
+    lines = preamble + [RESULTS_HEADER]
+    header = None
+    for (_, _, result_header, line) in results:
+        if result_header != header and result_header is not None:
+            lines.append(result_header)
+        header = result_header
+        lines.append(line)
+    lines.append('')
+
+    for (name, _, _, _) in results:
+        for shard in shards:
+            if name in shard.traces:
+                trace = shard.traces[name]
+                while trace and not trace[-1].strip():
+                    trace = trace[:-1]
+                lines += trace + ['']
+
+    failures = len([result for result in results if result[1] == 'FAILURE'])
+    verdicts = [shard.verdict for shard in shards]
+    if failures or FAILED in verdicts:
+        verdict = FAILED
+    elif all(verdict == SUCCESSFUL for verdict in verdicts):
+        verdict = SUCCESSFUL
+    else:
+        verdict = next(verdict for verdict in verdicts
+                       if verdict != SUCCESSFUL)
+    lines.append('** {} of {} failed'.format(failures, len(results)))
+    lines.append(verdict)
+    return '\n'.join(lines) + '\n'
+
+################################################################
@@ -8,6 +8,20 @@ Monitor the status of CBMC jobs running under AWS Batch.
 import sys
 import time
 import datetime
+import json
+
+from batch import JOB_STATUSES
+
+################################################################
+
+# Statuses of jobs that will not change
+FINISHED = ['SUCCEEDED', 'FAILED']
+
+# Seconds between polls: the interval grows by POLL_FACTOR while no
+# job changes status, and returns to POLL_MINIMUM when one does
+POLL_MINIMUM = 5
+POLL_MAXIMUM = 60
+POLL_FACTOR = 1.5
 
 ################################################################
 
@@ -19,12 +33,12 @@ def abort(msg):
 
 ################################################################
 
-def job_status(batch, jobname=None, jobid=None):
+def job_status(batch, jobname=None, jobid=None, prefix=False):
     """
     Get job status of CBMC jobs running under AWS Batch.
     """
 
-    results = batch.job_status(jobname=jobname, jobid=jobid)
+    results = batch.job_status(jobname=jobname, jobid=jobid, prefix=prefix)
     return results
 
 def display(jobs):
@@ -35,49 +49,137 @@ def display(jobs):
     for job in jobs:
         print("{}: {}".format(job['jobName'], job['status']))
 
-def current_status(batch, jobname=None, jobid=None):
+def current_status(batch, jobname=None, jobid=None, jobids=None,
+                   prefix=False):
     """Display current status of job"""
 
-    jobs = job_status(batch, jobname, jobid)
+    if jobids is not None:
+        jobs = batch.job_status(jobids=jobids)
+    else:
+        jobs = job_status(batch, jobname, jobid, prefix)
     display(jobs)
+    if jobids is not None:
+        display_counts(jobs)
 
-def monitor_status(batch, jobname=None, jobid=None):
-    """Monitor status of job"""
+def monitor_status(batch, jobname=None, jobid=None, prefix=False):
+    """Monitor status of job
 
-    status = {}
+    The jobs are found once, and then monitored with monitor_jobs.
+    """
+
+    jobs = job_status(batch, jobname, jobid, prefix)
+    if not jobs:
+        print("No jobs found")
+        return {}
+    return monitor_jobs(batch, [job['jobId'] for job in jobs])
+
+def monitor_jobs(batch, jobids, interval=POLL_MINIMUM,
+                 max_interval=POLL_MAXIMUM):
+    """Monitor the status of a set of jobs until they are all finished.
 
-    def job_list(status):
-        """Turn a dictionary of jobs into a list of jobs"""
-        result = []
-        for jid in status:
-            result.append(status[jid])
-        return result
+    Only the unfinished jobs are polled, using describe_jobs, and only
+    the jobs whose status has changed since the last poll are
+    displayed, together with the number of jobs in each status.
+    Return the final status of each job.
+    """
 
-    while True:
-        jobs = job_status(batch, jobname, jobid)
+    status = {}
+    unfinished = list(jobids)
+    delay = interval
+    while unfinished:
+        jobs = batch.job_status(jobids=unfinished)
 
-        change = False
+        changes = []
         for job in jobs:
-            jobid = job['jobId']
-            jobstatus = job['status']
-            current = status.get(jobid, None)
-            if current is None or jobstatus != current['status']:
-                change = True
-                status[jobid] = job
-                continue
-        if change:
+            current = status.get(job['jobId'])
+            if current is None or job['status'] != current['status']:
+                changes.append((current, job))
+                status[job['jobId']] = job
+        for missing in set(unfinished) - set(job['jobId'] for job in jobs):
+            print("Job not found: {}".format(missing))
+            status[missing] = {'jobId': missing, 'jobName': missing,
+                               'status': 'UNKNOWN'}
+        if changes:
             print()
             print(str(datetime.datetime.now()))
-            print()
-            display(job_list(status))
+            display_changes(changes)
+            display_counts(status.values())
 
-        stop = True
-        for jid in status:
-            stop = stop and status[jid]['status'] in ['SUCCEEDED', 'FAILED']
+        unfinished = [jid for jid in unfinished
+                      if status[jid]['status'] not in FINISHED + ['UNKNOWN']]
+        if not unfinished:
+            break
 
-        if stop:
-            return
+        delay = interval if changes else min(delay * POLL_FACTOR,
+                                             max_interval)
+        time.sleep(delay)
+
+    return status
+
+def display_changes(changes):
+    """Display the jobs whose status has changed."""
+
+    for current, job in changes:
+        if current is None:
+            print("{}: {}".format(job['jobName'], job['status']))
+        else:
+            print("{}: {} -> {}".format(job['jobName'], current['status'],
+                                        job['status']))
+
+def display_counts(jobs):
+    """Display the number of jobs in each status."""
+
+    counts = {}
+    for job in jobs:
+        counts[job['status']] = counts.get(job['status'], 0) + 1
+    order = JOB_STATUSES + sorted(set(counts) - set(JOB_STATUSES))
+    print("Jobs: {} ({} total)".format(
+        ", ".join("{} {}".format(stat, counts[stat])
+                  for stat in order if stat in counts),
+        sum(counts.values())))
+
+################################################################
+
+def read_jobs_file(filename):
+    """The job ids in a JSON file of jobs.
+
+    The file can be any JSON data mentioning job ids, such as the job
+    options written by cbmc-batch (whose tasks give the job ids of
+    the tasks), or a list of such data.  Every value of a 'jobid' or
+    'jobId' key in the data is taken to be a job id.
+    """
 
-        time.sleep(5)
+    try:
+        with open(filename) as handle:
+            data = json.load(handle)
+    except (IOError, OSError, ValueError) as error:
+        abort("Can't read jobs from {}: {}".format(filename, error))
+
+    jobids = []
+    def collect(data):
+        """Collect the job ids in the data."""
+        if isinstance(data, dict):
+            for key, value in data.items():
+                if key in ['jobid', 'jobId'] and value:
+                    jobids.append(value)
+                else:
+                    collect(value)
+        elif isinstance(data, list):
+            for value in data:
+                collect(value)
+    collect(data)
+    return jobids
+
+def read_jobs_files(filenames):
+    """The distinct job ids in a list of JSON files of jobs."""
+
+    jobids = []
+    seen = set()
+    for filename in filenames:
+        for jid in read_jobs_file(filename):
+            if jid not in seen:
+                seen.add(jid)
+                jobids.append(jid)
+    return jobids
 
 ################################################################
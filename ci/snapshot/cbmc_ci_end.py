@@ -18,6 +18,12 @@ bkt = os.environ['S3_BUCKET_PROOFS']
 PROPERTY = "property"
 REPORT = "report"
 
+# A phase that ran out of memory exits with this status and writes this
+# file to its output directory (see RESOURCE_EXHAUSTED_EXIT and
+# EXHAUSTED_FILE in bin/docker.py)
+RESOURCE_EXHAUSTED_EXIT = 75
+RESOURCE_EXHAUSTED_FILE = "out/resource-exhausted.json"
+
 def read_from_s3(s3_path):
     """Read from a file in S3 Bucket
 
@@ -26,6 +32,16 @@ def read_from_s3(s3_path):
     s3 = boto3.client('s3')
     return s3.get_object(Bucket=bkt, Key=s3_path)['Body'].read()
 
+def read_resource_exhausted(s3_dir):
+    """Read the description of a phase that ran out of memory (None if none)"""
+    s3 = boto3.client('s3')
+    try:
+        data = s3.get_object(Bucket=bkt,
+                             Key=s3_dir + "/" + RESOURCE_EXHAUSTED_FILE)
+    except s3.exceptions.NoSuchKey:
+        return None
+    return json.loads(data['Body'].read())
+
 
 class Job_name_info:
 
@@ -123,6 +139,38 @@ class CbmcResponseHandler:
         else:
             self.response['status'] = clog_writert.FAILED
 
+def handle_resource_exhausted(event, job_name, job_name_info):
+    """Report a proof whose job ran out of memory as a CBMC error.
+
+    A job that ran out of memory exits with RESOURCE_EXHAUSTED_EXIT,
+    and the property and report jobs depending on it fail, too.  The
+    proof is reported as an error asking for more memory instead of a
+    failed job.  Return True if the job ran out of memory.
+    """
+    if not (job_name_info.is_cbmc_property_job() or
+            job_name_info.is_cbmc_report_job()):
+        return False
+    s3_dir = job_name_info.get_s3_dir()
+    exit_code = event["detail"].get("container", {}).get("exitCode")
+    exhausted = read_resource_exhausted(s3_dir)
+    if exhausted is None and exit_code != RESOURCE_EXHAUSTED_EXIT:
+        return False
+    exhausted = exhausted or {}
+
+    # GitHub status descriptions are at most 140 characters
+    desc = "Out of memory"
+    if exhausted.get("phase"):
+        desc += " in {} ({} of {} MB)".format(
+            exhausted["phase"], exhausted.get("usage_mb"),
+            exhausted.get("limit_mb"))
+    desc += "; rerun with more memory"
+    print("CBMC Batch job {}: {}".format(job_name, desc))
+    repo_id = int(read_from_s3(s3_dir + "/repo_id.txt"))
+    sha = read_from_s3(s3_dir + "/sha.txt").decode('ascii')
+    update_status("error", job_name_info.get_job_dir(), s3_dir, desc,
+                  repo_id, sha, False)
+    return True
+
 def lambda_handler(event, context):
     """
     Update the status of the GitHub commit appropriately depending on CBMC
@@ -132,7 +180,9 @@ def lambda_handler(event, context):
 
     While the lambda function gets triggered after any Batch job changes
     status, it should only perform an action when the status is "SUCCEEDED" or
-    "FAILED" for a "-property" job generated by CBMC Batch.
+    "FAILED" for a "-property" job generated by CBMC Batch.  A property or
+    report job that failed because a phase ran out of memory is reported
+    as a CBMC error asking for more memory.
 
     The event format from AWS Batch Event is here:
     https://docs.aws.amazon.com/batch/latest/userguide/batch_cwe_events.html
@@ -147,6 +197,9 @@ def lambda_handler(event, context):
     job_id = event["detail"]["jobId"]
     status = event["detail"]["status"]
     job_name_info = Job_name_info(job_name)
+    if (status in ["FAILED"] and job_name_info.is_cbmc_batch_job and
+            handle_resource_exhausted(event, job_name, job_name_info)):
+        return
     if status in ["FAILED"]:
         print(f"ERROR: The following job has failed: {job_name} with status {status}")
         raise Exception(f"The following job has failed: {job_name} with status {status}")